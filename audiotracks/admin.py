@@ -1,7 +1,14 @@
 from django.contrib import admin
-from audiotracks.models import Track
+from audiotracks.models import Track, Job
 
 class TrackAdmin(admin.ModelAdmin):
     pass
 
 admin.site.register(Track, TrackAdmin)
+
+
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('task', 'key', 'status', 'attempts', 'created_at')
+    list_filter = ('status', 'task')
+
+admin.site.register(Job, JobAdmin)
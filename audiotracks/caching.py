@@ -0,0 +1,236 @@
+"""
+Cache helpers shared by views and feeds.
+
+Every listing scope (all tracks, or the tracks of a single user) has a stamp
+recording the last time a track in that scope changed. Cached documents are
+keyed on that stamp, so bumping it when a track is saved or deleted is enough
+to make every stale copy unreachable. Touching the global scope also drops the
+cached number of tracks, see ``get_track_count``. Stamps must be seen by every
+process serving the site, which requires a shared cache backend such as
+memcached rather than the default local memory cache.
+
+Single tracks are cached by ``get_track`` under their username and slug, and
+deleted from the cache when they change.
+
+Full feed archive pages only change when a track is edited or deleted, since
+new tracks are always added after them. They are keyed on an archive
+generation which is only bumped by those changes, and kept much longer.
+"""
+import datetime
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.db.models import Max
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.hashcompat import md5_constructor
+
+CACHE_PREFIX = getattr(settings, 'AUDIOTRACKS_CACHE_PREFIX', 'audiotracks')
+FEED_CACHE_TIMEOUT = getattr(settings, 'AUDIOTRACKS_FEED_CACHE_TIMEOUT',
+                             60 * 60)
+PAGE_CACHE_TIMEOUT = getattr(settings, 'AUDIOTRACKS_PAGE_CACHE_TIMEOUT',
+                             60 * 60)
+DETAIL_CACHE_TIMEOUT = getattr(settings, 'AUDIOTRACKS_DETAIL_CACHE_TIMEOUT',
+                               60 * 60)
+ARCHIVE_CACHE_TIMEOUT = getattr(settings, 'AUDIOTRACKS_ARCHIVE_CACHE_TIMEOUT',
+                                60 * 60 * 24 * 365)
+# How long to remember that a track doesn't exist
+NOT_FOUND_CACHE_TIMEOUT = getattr(settings,
+        'AUDIOTRACKS_NOT_FOUND_CACHE_TIMEOUT', 30)
+STAMP_TIMEOUT = 60 * 60 * 24 * 30
+
+# How long a process may take to reload a track while others serve the stale
+# copy or wait for it
+LOCK_TIMEOUT = 10
+LOCK_WAIT = 0.05
+LOCK_WAIT_ATTEMPTS = 10
+
+# Stamp used for scopes that don't contain any track yet
+EMPTY_SCOPE_STAMP = datetime.datetime(1970, 1, 1)
+
+
+def make_key(*parts):
+    return ':'.join([CACHE_PREFIX] + [unicode(part) for part in parts]
+                   ).encode('utf-8')
+
+
+def get_scope_stamp(username=None):
+    """
+    Return the time of the last change in the scope of ``username``, or in
+    the global scope if ``username`` is None
+    """
+    key = make_key('stamp', username or '')
+    stamp = cache.get(key)
+    if stamp is None:
+        from audiotracks.models import Track, TrackStats
+        tracks = Track.objects.all()
+        if username:
+            # The statistics of the user record the time of the last change
+            stamps = TrackStats.objects.filter(user__username=username
+                    ).values_list('updated_at', flat=True)
+            if stamps:
+                stamp = stamps[0]
+            tracks = tracks.filter(user__username=username)
+        if stamp is None:
+            stamp = tracks.aggregate(Max('updated_at'))['updated_at__max'] \
+                    or EMPTY_SCOPE_STAMP
+        cache.add(key, stamp, STAMP_TIMEOUT)
+    return stamp
+
+
+def touch_scope(username=None):
+    cache.set(make_key('stamp', username or ''), datetime.datetime.now(),
+              STAMP_TIMEOUT)
+    if username is None:
+        cache.delete(make_key('count'))
+
+
+def get_track_count():
+    """
+    Return the number of tracks of all users, counted once after each change
+    to the global scope rather than by every feed and archive request
+    """
+    key = make_key('count')
+    count = cache.get(key)
+    if count is None:
+        from audiotracks.models import Track
+        count = Track.objects.count()
+        cache.add(key, count, STAMP_TIMEOUT)
+    return count
+
+
+def get_scope_etag(username=None, *extra):
+    stamp = get_scope_stamp(username)
+    parts = [username or '', stamp.isoformat()] + [unicode(e) for e in extra]
+    return md5_constructor('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def get_archive_generation(username=None):
+    """
+    Return the generation of the feed archive pages of the scope of
+    ``username``. A lost generation is replaced by a new one, never by a
+    previous one, so that stale pages can't become reachable again.
+    """
+    key = make_key('archive', username or '')
+    generation = cache.get(key)
+    if generation is None:
+        generation = repr(time.time())
+        if not cache.add(key, generation, ARCHIVE_CACHE_TIMEOUT):
+            # Another process got there first
+            generation = cache.get(key) or generation
+    return generation
+
+
+def touch_archive(username=None):
+    cache.set(make_key('archive', username or ''), repr(time.time()),
+              ARCHIVE_CACHE_TIMEOUT)
+
+
+def get_track_key(username, slug):
+    # Slugs may contain characters memcached doesn't accept in keys
+    return make_key('track', username,
+                    md5_constructor(slug.encode('utf-8')).hexdigest())
+
+
+def load_track(username, slug):
+    from audiotracks.models import Track
+    try:
+        return Track.objects.select_related('user').get(
+                user__username=username, slug=slug)
+    except Track.DoesNotExist:
+        return None
+
+
+def get_track(username, slug):
+    """
+    Return the track of ``username`` whose slug is ``slug``, along with its
+    user, or None if it doesn't exist.
+
+    Cache entries hold the track and the time after which it should be
+    reloaded, and outlive that time. The first process finding an entry
+    stale reloads it while the others keep serving the stale copy, so that
+    a popular track never sends a burst of queries to the database.
+    """
+    key = get_track_key(username, slug)
+    entry = cache.get(key)
+    if entry is not None:
+        reload_after, track = entry
+        if reload_after > time.time() or \
+                not cache.add(key + ':lock', 1, LOCK_TIMEOUT):
+            return track
+    elif not cache.add(key + ':lock', 1, LOCK_TIMEOUT):
+        # Another process is loading the track, give it a chance to finish
+        for attempt in range(LOCK_WAIT_ATTEMPTS):
+            time.sleep(LOCK_WAIT)
+            entry = cache.get(key)
+            if entry is not None:
+                return entry[1]
+        return load_track(username, slug)
+    try:
+        track = load_track(username, slug)
+        if track is None:
+            timeout = NOT_FOUND_CACHE_TIMEOUT
+        else:
+            timeout = DETAIL_CACHE_TIMEOUT
+        cache.set(key, (time.time() + timeout, track), timeout * 2)
+    finally:
+        cache.delete(key + ':lock')
+    return track
+
+
+def forget_track(username, *slugs):
+    cache.delete_many([get_track_key(username, slug) for slug in slugs
+                       if slug])
+
+
+def track_changed(sender, instance, **kwargs):
+    """
+    Signal handler connected to post_save and post_delete of the Track model
+    """
+    # Creating a track doesn't change full archive pages
+    archived = not kwargs.get('created')
+    touch_scope()
+    if archived:
+        touch_archive()
+    if instance.user_id:
+        username = instance.user.username
+        touch_scope(username)
+        if archived:
+            touch_archive(username)
+        # The track may have been cached under its previous slug, and its new
+        # slug may have been cached as not found
+        forget_track(username, instance.slug, instance._original_slug)
+
+
+def cache_anonymous_page(view):
+    """
+    Cache the pages rendered by ``view`` for anonymous users until a track
+    changes in the scope of the ``username`` argument of the view. Pages
+    showing messages or setting cookies are specific to the visitor, so they
+    are neither served from nor stored in the cache.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET' or request.user.is_authenticated() or \
+                len(messages.get_messages(request)):
+            return view(request, *args, **kwargs)
+        username = kwargs.get('username')
+        key = make_key('page', username or '',
+                       get_scope_etag(username,
+                                      getattr(request, 'LANGUAGE_CODE', ''),
+                                      request.get_full_path()))
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+        else:
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.cookies:
+                cache.set(key, (response.content, response['Content-Type']),
+                          PAGE_CACHE_TIMEOUT)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+    return wrapper
@@ -0,0 +1,100 @@
+"""
+Content-addressed storage of audio files.
+
+When ``AUDIOTRACKS_CONTENT_ADDRESSED_STORAGE`` is True, audio files are stored
+under a name derived from the SHA-1 hash of their content instead of the name
+they were uploaded with. Uploading a file which is already stored doesn't store
+it again: both tracks point to the same blob, which is only deleted along with
+the last track referencing it.
+
+References are counted in the ``AudioBlob`` table, in the transaction saving or
+deleting the track, so that a blob can't be deleted while another track starts
+using it. Its file is deleted once its last reference is released, by
+``AbstractTrack.save`` and ``AbstractTrack.delete``. Tracks deleted with
+``QuerySet.delete()`` release their references but leave the files of
+unreferenced blobs in the storage.
+
+Blobs are never modified in place. Writing tags into the audio file of a track
+stores a new blob, see ``AbstractTrack.write_tags``.
+"""
+import os
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils.hashcompat import sha_constructor
+
+ENABLED = getattr(settings, 'AUDIOTRACKS_CONTENT_ADDRESSED_STORAGE', False)
+BLOB_DIR = 'audiotracks/blobs/'
+
+
+def blob_name(content_hash, filename):
+    """
+    Return the storage name of the blob of hash ``content_hash``. The
+    extension of ``filename`` is kept, as formats are recognized by it.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    return '%s%s/%s%s' % (BLOB_DIR, content_hash[:2], content_hash, extension)
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_DIR)
+
+
+def hash_file(f):
+    """
+    Return the SHA-1 hash of a File object, read chunk by chunk
+    """
+    content_hash = sha_constructor()
+    f.seek(0)
+    for chunk in f.chunks():
+        content_hash.update(chunk)
+    f.seek(0)
+    return content_hash.hexdigest()
+
+
+def acquire(name):
+    """
+    Add a reference to the stored blob ``name``. Return False if the blob
+    isn't referenced, in which case its file may be about to be deleted and
+    the content must be stored again.
+    """
+    from audiotracks.models import AudioBlob
+    return bool(AudioBlob.objects.filter(name=name, reference_count__gt=0)
+                .update(reference_count=F('reference_count') + 1))
+
+
+def add_reference(name):
+    """
+    Count a reference to the blob ``name``, creating its counter when the
+    blob has just been stored. Must run in a managed transaction.
+    """
+    from audiotracks.models import AudioBlob
+    if acquire(name):
+        return
+    sid = transaction.savepoint()
+    try:
+        AudioBlob.objects.create(name=name, reference_count=1)
+    except IntegrityError:
+        # Created by another upload of the same content in the meantime
+        transaction.savepoint_rollback(sid)
+        acquire(name)
+    else:
+        transaction.savepoint_commit(sid)
+
+
+def release(name):
+    """
+    Remove a reference to the blob ``name``. Return True if it was the last
+    one, in which case the file of the blob is to be deleted once the
+    transaction is committed.
+    """
+    from audiotracks.models import AudioBlob
+    blobs = AudioBlob.objects.filter(name=name)
+    blobs.update(reference_count=F('reference_count') - 1)
+    # The row is locked by the update until the end of the transaction
+    unreferenced = blobs.filter(reference_count__lte=0)
+    if not unreferenced.exists():
+        return False
+    unreferenced.delete()
+    return True
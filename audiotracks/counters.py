@@ -0,0 +1,272 @@
+"""
+Play and download counters.
+
+Counting a hit doesn't write to the database: increments are collected in a
+buffer and flushed ``AUDIOTRACKS_COUNTER_FLUSH_INTERVAL`` seconds after the
+first hit, with a single UPDATE per track, by a timer of the process which
+counted them, and when the process exits. Counts are stored in the ``TrackCounters`` table
+rather than along with tracks, which are saved with all their columns.
+``AUDIOTRACKS_COUNTER_BUFFER`` chooses the buffer:
+
+* ``'memory'`` keeps increments in the memory of the process. This is the
+  default.
+* ``'cache'`` keeps them in the Django cache, which should be local to the
+  server; increments survive the restart of the process which collected them
+  until the next flush of the same counter.
+* ``None`` disables counting.
+"""
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+
+from audiotracks.caching import make_key
+
+logger = logging.getLogger('audiotracks.counters')
+
+FLUSH_INTERVAL = getattr(settings, 'AUDIOTRACKS_COUNTER_FLUSH_INTERVAL', 60)
+# How long unflushed increments are kept in the cache
+CACHE_TIMEOUT = 60 * 60 * 24
+COUNTER_FIELDS = ('play_count', 'download_count')
+
+
+class MemoryBuffer(object):
+
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, count=1):
+        self.lock.acquire()
+        try:
+            self.counts[key] = self.counts.get(key, 0) + count
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        """
+        Return the buffered increments, a dictionary of counts by
+        ``(track_id, field)`` pairs, and empty the buffer
+        """
+        self.lock.acquire()
+        try:
+            counts, self.counts = self.counts, {}
+        finally:
+            self.lock.release()
+        return counts
+
+    def get_many(self, keys):
+        """
+        Return the buffered increments of ``keys``, without draining them
+        """
+        counts = self.counts
+        return dict((key, counts[key]) for key in keys if key in counts)
+
+
+class CacheBuffer(object):
+    """
+    Buffer in the Django cache. Each process flushes the counters it
+    incremented, leaving the increments of other processes alone.
+    """
+
+    def __init__(self):
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def get_cache_key(self, key):
+        return make_key('counter', *key)
+
+    def add(self, key, count=1):
+        cache_key = self.get_cache_key(key)
+        try:
+            cache.incr(cache_key, count)
+        except ValueError:
+            if not cache.add(cache_key, count, CACHE_TIMEOUT):
+                cache.incr(cache_key, count)
+        self.lock.acquire()
+        try:
+            self.keys.add(key)
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        self.lock.acquire()
+        try:
+            keys, self.keys = self.keys, set()
+        finally:
+            self.lock.release()
+        cache_keys = dict((self.get_cache_key(key), key) for key in keys)
+        counts = {}
+        for cache_key, count in cache.get_many(cache_keys.keys()).items():
+            if count:
+                # Increments made since get_many are left for the next flush
+                cache.decr(cache_key, count)
+                counts[cache_keys[cache_key]] = count
+        return counts
+
+    def get_many(self, keys):
+        cache_keys = dict((self.get_cache_key(key), key) for key in keys)
+        return dict((cache_keys[cache_key], count) for cache_key, count in
+                    cache.get_many(cache_keys.keys()).items())
+
+
+BUFFERS = {
+    'memory': MemoryBuffer,
+    'cache': CacheBuffer,
+}
+
+_buffer = None
+_timer = None
+_timer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    if _buffer is None:
+        name = getattr(settings, 'AUDIOTRACKS_COUNTER_BUFFER', 'memory')
+        if name is None:
+            return None
+        _buffer = BUFFERS[name]()
+    return _buffer
+
+
+def increment(track, field):
+    """
+    Count a hit on ``track``. ``field`` is one of COUNTER_FIELDS.
+    """
+    buffer = get_buffer()
+    if buffer is None:
+        return
+    buffer.add((track.pk, field))
+    schedule_flush()
+
+
+def schedule_flush():
+    """
+    Start the timer flushing the buffer unless it is already running. A job
+    wouldn't do: the buffer of a process can only be flushed by the process
+    itself.
+    """
+    global _timer
+    _timer_lock.acquire()
+    try:
+        if _timer is None:
+            _timer = start_timer(FLUSH_INTERVAL, flush_from_timer)
+    finally:
+        _timer_lock.release()
+
+
+def start_timer(interval, function):
+    timer = threading.Timer(interval, function)
+    timer.setDaemon(True)
+    timer.start()
+    return timer
+
+
+def flush_from_timer():
+    global _timer
+    _timer_lock.acquire()
+    try:
+        _timer = None
+    finally:
+        _timer_lock.release()
+    try:
+        flush()
+    except Exception:
+        logger.exception("Could not flush counters")
+    finally:
+        # The timer thread has its own database connection
+        connection.close()
+
+
+def add_counts(track_id, counts):
+    """
+    Add ``counts``, a dictionary of increments by field, to the counters of a
+    track, creating them on the first hit
+    """
+    from audiotracks.models import TrackCounters, managed_transaction
+    increments = dict((field, F(field) + count)
+                      for field, count in counts.items())
+    if TrackCounters.objects.filter(track=track_id).update(**increments):
+        return
+    with managed_transaction():
+        sid = transaction.savepoint()
+        try:
+            TrackCounters.objects.create(track_id=track_id, **counts)
+        except IntegrityError:
+            # Created by another process in the meantime
+            transaction.savepoint_rollback(sid)
+            TrackCounters.objects.filter(track=track_id).update(**increments)
+        else:
+            transaction.savepoint_commit(sid)
+
+
+def get_stored_key(track_id):
+    return make_key('counters', track_id)
+
+
+def flush():
+    """
+    Write the buffered increments to the database, one UPDATE per track.
+    Return the number of tracks updated.
+    """
+    buffer = get_buffer()
+    if buffer is None:
+        return 0
+    counts = buffer.drain()
+    by_track = {}
+    for (track_id, field), count in counts.items():
+        by_track.setdefault(track_id, {})[field] = count
+    for track_id, fields in by_track.items():
+        try:
+            add_counts(track_id, fields)
+        except Exception:
+            logger.exception("Could not flush the counters of track %s",
+                             track_id)
+            for field, count in fields.items():
+                buffer.add((track_id, field), count)
+        else:
+            cache.delete(get_stored_key(track_id))
+    return len(by_track)
+
+
+def get_counts(track):
+    """
+    Return the play and download counts of ``track`` as a dictionary by
+    field: the stored counts, cached until the next flush of the track, plus
+    the increments buffered by the current process, or by all processes
+    sharing the cache with the ``'cache'`` buffer.
+    """
+    from audiotracks.models import TrackCounters
+    key = get_stored_key(track.pk)
+    counts = cache.get(key)
+    if counts is None:
+        stored = TrackCounters.objects.filter(track=track.pk).values(
+                *COUNTER_FIELDS)
+        if stored:
+            counts = stored[0]
+        else:
+            counts = dict((field, 0) for field in COUNTER_FIELDS)
+        # Flushes from other processes delete it, unless the cache is local
+        cache.set(key, counts, FLUSH_INTERVAL)
+    buffer = get_buffer()
+    if buffer is not None:
+        buffered = buffer.get_many([(track.pk, field)
+                                    for field in COUNTER_FIELDS])
+        counts = dict((field, count + buffered.get((track.pk, field), 0))
+                      for field, count in counts.items())
+    return counts
+
+
+def flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception("Could not flush counters at exit")
+
+
+atexit.register(flush_at_exit)
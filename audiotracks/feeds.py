@@ -1,35 +1,168 @@
 #!/usr/bin/env python
 # -*- coding: UTF-8 -*-
 
-import mimetypes
-
 from django.conf import settings
-from django.contrib.syndication.views import Feed
+from django.contrib.syndication.views import Feed, add_domain
 from django.contrib.auth.models import User
+from django.core import urlresolvers
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404
+from django.views.decorators.http import condition
+from django.utils.feedgenerator import Enclosure, Rss201rev2Feed
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.sites.models import Site
 
 from audiotracks.models import Track
+from audiotracks import caching, staticfeeds
+from audiotracks.instrumentation import timer
+from audiotracks.feedwriter import StreamingFeedMixin
+from audiotracks.pagination import CursorPaginator, InvalidCursor
+from audiotracks.stats import get_stats
 
 ITEMS_PER_FEED = getattr(settings, 'AUDIOTRACKS_PODCAST_LIMIT', 10)
 
 
+# Link relations of RFC 5005 (Feed Paging and Archiving), and the keyword
+# arguments of the feed generators holding their URL
+LINK_RELATIONS = (
+    (u"next", 'next_url'),
+    (u"current", 'current_url'),
+    (u"prev-archive", 'prev_archive_url'),
+    (u"next-archive", 'next_archive_url'),
+)
+
+
+class PagedRssFeed(Rss201rev2Feed):
+    """
+    RSS feed linking to the next page of older items and to archive pages
+    """
+
+    def add_root_elements(self, handler):
+        super(PagedRssFeed, self).add_root_elements(handler)
+        for rel, name in LINK_RELATIONS:
+            if self.feed.get(name):
+                handler.addQuickElement(u"atom:link", None,
+                        {u"rel": rel, u"href": self.feed[name]})
+
+
+class ArchiveRssFeed(StreamingFeedMixin, PagedRssFeed):
+    """
+    Archive page of a feed, marked as such as specified by RFC 5005
+    """
+
+    def rss_attributes(self):
+        attrs = super(ArchiveRssFeed, self).rss_attributes()
+        attrs[u"xmlns:fh"] = u"http://purl.org/syndication/history/1.0"
+        return attrs
+
+    def add_root_elements(self, handler):
+        super(ArchiveRssFeed, self).add_root_elements(handler)
+        handler.addQuickElement(u"fh:archive")
+
+
 class AllTracks(Feed):
-    def link(self):
+    feed_type = PagedRssFeed
+
+    def link(self, user=None):
         return self.request.build_absolute_uri("/")
 
-    def title(self):
+    def title(self, user=None):
         return _("%s Podcast") % self._get_site_name()
 
-    def description(self):
+    def description(self, user=None):
         return _("All audio tracks posted on %s") % self._get_site_name()
 
     def get_object(self, request):
         self.request = request
+        self._page = None
+
+    def get_tracks(self, user):
+        return Track.objects.select_related('user')
+
+    def count_tracks(self, user):
+        return caching.get_track_count()
+
+    def get_page(self, user):
+        if self._page is None:
+            paginator = CursorPaginator(self.get_tracks(user), ITEMS_PER_FEED)
+            try:
+                self._page = paginator.page(self.request.GET.get('cursor'))
+            except InvalidCursor:
+                self._page = paginator.page()
+        return self._page
+
+    def feed_extra_kwargs(self, user):
+        kwargs = {}
+        page = self.get_page(user)
+        if page.has_next():
+            kwargs['next_url'] = self.request.build_absolute_uri("%s?cursor=%s"
+                    % (urlquote(self.request.path), page.next_cursor))
+        archived = self.count_tracks(user) // ITEMS_PER_FEED
+        if archived:
+            kwargs['prev_archive_url'] = self.get_archive_url(user,
+                                                              archived - 1)
+        return kwargs
+
+    def get_archive_url(self, user, number):
+        args = [number]
+        if user is not None:
+            args.insert(0, user.username)
+        return self.request.build_absolute_uri(
+                urlresolvers.reverse('tracks_feed_archive', args=args))
+
+    def get_current_url(self, user):
+        args = []
+        if user is not None:
+            args.append(user.username)
+        return self.request.build_absolute_uri(
+                urlresolvers.reverse('tracks_feed', args=args))
+
+    def stream_archive(self, user, number, total):
+        """
+        Return an iterator over the chunks of archive page ``number``, out of
+        ``total`` tracks. Archive pages are numbered from the oldest one.
+        """
+        end = total - number * ITEMS_PER_FEED
+        tracks = self.get_tracks(user).order_by('-created_at', '-pk')[
+                end - ITEMS_PER_FEED:end]
+        kwargs = {'current_url': self.get_current_url(user)}
+        if number > 0:
+            kwargs['prev_archive_url'] = self.get_archive_url(user,
+                                                              number - 1)
+        if number + 1 < total // ITEMS_PER_FEED:
+            kwargs['next_archive_url'] = self.get_archive_url(user,
+                                                              number + 1)
+        feed = ArchiveRssFeed(title=self.title(user), link=self.link(user),
+                              description=self.description(user),
+                              language=settings.LANGUAGE_CODE.decode(),
+                              feed_url=self.request.build_absolute_uri(),
+                              **kwargs)
+        return feed.stream(self.item_kwargs(track)
+                           for track in tracks.iterator())
+
+    def item_kwargs(self, item):
+        """
+        Return the ``add_item`` keyword arguments of a track, the same as
+        the ones of the items of the subscription feed
+        """
+        link = add_domain(Site.objects.get_current().domain,
+                          item.get_absolute_url(), self.request.is_secure())
+        return {
+            'title': self.item_title(item),
+            'link': link,
+            'description': self.item_description(item),
+            'unique_id': link,
+            'enclosure': Enclosure(
+                url=self.item_enclosure_url(item),
+                length=unicode(self.item_enclosure_length(item)),
+                mime_type=unicode(self.item_enclosure_mime_type(item))),
+        }
 
     def items(self, user):
-        return Track.objects.order_by('-created_at')[:ITEMS_PER_FEED]
+        return self.get_page(user).object_list
 
     def item_title(self, item):
         return _('"%(title)s" posted by %(username)s') % {
@@ -54,10 +187,12 @@ class AllTracks(Feed):
         return self.request.build_absolute_uri(item.audio_file.url)
 
     def item_enclosure_length(self, item):
+        if item.audio_size is not None:
+            return item.audio_size
         return item.audio_file.size
 
     def item_enclosure_mime_type(self, item):
-        return mimetypes.guess_type(item.audio_file.path)[0]
+        return item.mimetype
 
     def _get_site_name(self):
         return Site.objects.get_current().name
@@ -67,6 +202,7 @@ class UserTracks(AllTracks):
 
     def get_object(self, request, username):
         self.request = request
+        self._page = None
         return get_object_or_404(User, username=username)
 
     def link(self, user):
@@ -84,18 +220,98 @@ class UserTracks(AllTracks):
             'username': user.username
             })
 
-    def items(self, user):
-        return Track.objects.filter(user=user).order_by("-created_at")[:ITEMS_PER_FEED]
+    def get_tracks(self, user):
+        return Track.objects.select_related('user').filter(user=user)
+
+    def count_tracks(self, user):
+        return get_stats(user).track_count
 
 
 all_tracks = AllTracks()
 user_tracks = UserTracks()
 
 
+def feed_etag(request, *args, **kwargs):
+    return caching.get_scope_etag(kwargs.get('username'),
+                                  request.GET.get('cursor', ''))
+
+
+def feed_last_modified(request, *args, **kwargs):
+    return caching.get_scope_stamp(kwargs.get('username'))
+
+
+@condition(etag_func=feed_etag, last_modified_func=feed_last_modified)
 def choose_feed(request, *args, **kwargs):
     """
     Pick up the user feed or the global feed depending on whether or not the URL
     contains a username parameter
+
+    Rendered feeds are cached until a track in their scope changes, and
+    clients sending If-None-Match or If-Modified-Since get a 304 response
+    when nothing changed since their last poll.
+
+    When AUDIOTRACKS_STATIC_FEEDS is True, the first page of feeds is served
+    from the static files published by ``staticfeeds`` once they exist.
     """
+    if staticfeeds.ENABLED and 'cursor' not in request.GET:
+        response = staticfeeds.serve_feed(kwargs.get('username'))
+        if response is not None:
+            return response
+    # Feeds contain absolute URLs built from the host of the request
+    cache_key = caching.make_key('feed', request.get_host(),
+                                 kwargs.get('username', ''),
+                                 feed_etag(request, *args, **kwargs))
+    cached = cache.get(cache_key)
+    if cached is not None:
+        content, content_type = cached
+        return HttpResponse(content, content_type=content_type)
     feed = user_tracks if 'username' in kwargs else all_tracks
-    return feed.__call__(request, *args, **kwargs)
+    with timer('feeds.render'):
+        response = feed.__call__(request, *args, **kwargs)
+    cache.set(cache_key, (response.content, response['Content-Type']),
+              caching.FEED_CACHE_TIMEOUT)
+    return response
+
+
+def archive_etag(request, number, username=None):
+    return md5_constructor(caching.make_key(
+            caching.get_archive_generation(username), username or '',
+            number)).hexdigest()
+
+
+def cache_archive(key, chunks):
+    content = []
+    with timer('feeds.archive'):
+        for chunk in chunks:
+            content.append(chunk)
+            yield chunk
+    cache.set(key, ''.join(content), caching.ARCHIVE_CACHE_TIMEOUT)
+
+
+@condition(etag_func=archive_etag)
+def archive_feed(request, number, username=None):
+    """
+    Archive page of the user feed or of the global feed, as specified by RFC
+    5005. Pages are numbered from the oldest one and only served once they
+    are full, after which they don't change unless a track is edited or
+    deleted, so they are cached for AUDIOTRACKS_ARCHIVE_CACHE_TIMEOUT.
+    """
+    number = int(number)
+    cache_key = caching.make_key('archive-page', request.get_host(),
+                                 username or '',
+                                 caching.get_archive_generation(username),
+                                 number)
+    content = cache.get(cache_key)
+    if content is not None:
+        return HttpResponse(content, content_type=ArchiveRssFeed.mime_type)
+    if username:
+        feed, user = UserTracks(), get_object_or_404(User, username=username)
+    else:
+        feed, user = AllTracks(), None
+    feed.request = request
+    total = feed.count_tracks(user)
+    if number >= total // ITEMS_PER_FEED:
+        raise Http404
+    chunks = feed.stream_archive(user, number, total)
+    return HttpResponse(cache_archive(cache_key, chunks),
+                        content_type=ArchiveRssFeed.mime_type)
@@ -0,0 +1,49 @@
+"""
+Streaming RSS writer.
+
+Django's feed generators write a whole document at once from a list of items.
+``StreamingFeedMixin`` writes the same document as a sequence of chunks, one
+per item, with items produced by an iterable as they are written, so that a
+feed never needs to be held in memory.
+"""
+from cStringIO import StringIO
+
+from django.utils.xmlutils import SimplerXMLGenerator
+
+
+def drain(buffer):
+    value = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return value
+
+
+class StreamingFeedMixin(object):
+    """
+    Mixin for ``django.utils.feedgenerator.RssFeed`` subclasses
+    """
+
+    def stream(self, items, encoding='utf-8'):
+        """
+        Yield the document chunk by chunk. ``items`` is an iterable of
+        dictionaries of ``add_item`` keyword arguments. As items aren't known
+        before the root elements are written, the build date of the feed is
+        the current time.
+        """
+        buffer = StringIO()
+        handler = SimplerXMLGenerator(buffer, encoding)
+        handler.startDocument()
+        handler.startElement(u"rss", self.rss_attributes())
+        handler.startElement(u"channel", self.root_attributes())
+        self.add_root_elements(handler)
+        yield drain(buffer)
+        for kwargs in items:
+            self.add_item(**kwargs)
+            item = self.items.pop()
+            handler.startElement(u"item", self.item_attributes(item))
+            self.add_item_elements(handler, item)
+            handler.endElement(u"item")
+            yield drain(buffer)
+        self.endChannelElement(handler)
+        handler.endElement(u"rss")
+        yield drain(buffer)
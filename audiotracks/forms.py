@@ -7,6 +7,17 @@ class TrackUploadForm(forms.ModelForm):
         model = Track
         fields = ('audio_file',)
 
+    def __init__(self, *args, **kwargs):
+        # Reason why the upload handler rejected the file, if it did
+        self.upload_error = kwargs.pop('upload_error', None)
+        super(TrackUploadForm, self).__init__(*args, **kwargs)
+
+    def clean(self):
+        if self.upload_error:
+            self._errors['audio_file'] = self.error_class([self.upload_error])
+            self.cleaned_data.pop('audio_file', None)
+        return self.cleaned_data
+
 
 class TrackEditForm(forms.ModelForm):
 
@@ -0,0 +1,114 @@
+"""
+Indexes spanning several columns.
+
+Django doesn't know about them, so track models declare them in their
+``COMPOSITE_INDEXES`` attribute, a tuple of tuples of field names. They are
+created when syncdb creates the table of the model, and the
+``audiotracks_indexes`` management command adds the missing ones to existing
+databases.
+"""
+import re
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.backends.util import truncate_name
+from django.utils.hashcompat import md5_constructor
+
+# Queries listing the names of the indexes of a table, by database vendor
+INDEX_NAME_QUERIES = {
+    'sqlite': "SELECT name FROM sqlite_master WHERE type = 'index' "
+              "AND tbl_name = %s",
+    'postgresql': "SELECT indexname FROM pg_indexes WHERE tablename = %s",
+    'mysql': "SELECT index_name FROM information_schema.statistics "
+             "WHERE table_schema = DATABASE() AND table_name = %s",
+    'oracle': "SELECT index_name FROM user_indexes "
+              "WHERE table_name = UPPER(%s)",
+}
+
+CREATE_INDEX_RE = re.compile(r'^CREATE (?:UNIQUE )?INDEX (\S+) ON (\S+)',
+                             re.IGNORECASE)
+
+
+def sql_composite_indexes(model, style=None):
+    """
+    Return the CREATE INDEX statements of the composite indexes of ``model``
+    """
+    if style is None:
+        style = no_style()
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    output = []
+    for field_names in getattr(model, 'COMPOSITE_INDEXES', ()):
+        columns = [model._meta.get_field(name).column for name in field_names]
+        digest = md5_constructor(','.join(columns)).hexdigest()[:8]
+        name = '%s_%s' % (table, digest)
+        output.append(
+            style.SQL_KEYWORD('CREATE INDEX') + ' ' +
+            style.SQL_TABLE(qn(truncate_name(name,
+                    connection.ops.max_name_length()))) + ' ' +
+            style.SQL_KEYWORD('ON') + ' ' + style.SQL_TABLE(qn(table)) +
+            ' (%s);' % ', '.join([style.SQL_FIELD(qn(column))
+                                  for column in columns]))
+    return output
+
+
+def sql_all_indexes(model, style=None):
+    """
+    Return the CREATE INDEX statements of all the indexes of ``model``
+    """
+    if style is None:
+        style = no_style()
+    return connection.creation.sql_indexes_for_model(model, style) + \
+            sql_composite_indexes(model, style)
+
+
+def parse_statement(statement):
+    """
+    Return the names of the index and of the table of a CREATE INDEX
+    statement, unquoted and in lower case
+    """
+    names = CREATE_INDEX_RE.match(statement).groups()
+    return tuple([name.strip('"`').lower() for name in names])
+
+
+def get_index_names(table):
+    """
+    Return the names of the indexes of ``table`` in lower case, or None if
+    the database vendor isn't supported
+    """
+    query = INDEX_NAME_QUERIES.get(connection.vendor)
+    if query is None:
+        return None
+    cursor = connection.cursor()
+    cursor.execute(query, [table])
+    return set([row[0].lower() for row in cursor.fetchall()])
+
+
+def create_indexes(statements):
+    """
+    Run CREATE INDEX statements, skipping indexes which already exist. Return
+    the statements which created an index.
+    """
+    cursor = connection.cursor()
+    existing = {}
+    created = []
+    for statement in statements:
+        name, table = parse_statement(statement)
+        if table not in existing:
+            existing[table] = get_index_names(table)
+        if existing[table] is not None and name in existing[table]:
+            continue
+        cursor.execute(statement)
+        created.append(statement)
+    return created
+
+
+def create_composite_indexes(sender, created_models, **kwargs):
+    """
+    Handler of the post_syncdb signal creating the composite indexes of the
+    track models which have just been created
+    """
+    for model in created_models:
+        if getattr(model, 'COMPOSITE_INDEXES', None):
+            create_indexes(sql_composite_indexes(model))
+            transaction.commit_unless_managed()
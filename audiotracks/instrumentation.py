@@ -0,0 +1,221 @@
+"""
+Timings and counters of the costly stages of uploads, edits, thumbnailing and
+feed rendering.
+
+Measures are sent to the sinks listed in ``AUDIOTRACKS_METRICS_SINKS``:
+
+* ``'logging'`` logs them to the ``audiotracks.metrics`` logger.
+* ``'memory'`` keeps histograms in the memory of the process, readable by
+  staff members through the ``metrics`` view.
+* ``'statsd'`` sends them to a StatsD server over UDP, see
+  ``AUDIOTRACKS_STATSD_HOST``, ``AUDIOTRACKS_STATSD_PORT`` and
+  ``AUDIOTRACKS_STATSD_PREFIX``.
+
+Dotted paths to other sink classes are accepted too. No sink is enabled by
+default, in which case measuring does nothing.
+"""
+import logging
+import socket
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('audiotracks.metrics')
+
+# Upper bounds of the buckets of histograms, in milliseconds
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                    10000)
+
+
+class LoggingSink(object):
+
+    def timing(self, name, ms):
+        logger.info("%s: %.1f ms", name, ms)
+
+    def incr(self, name, count):
+        logger.info("%s: +%d", name, count)
+
+
+class MemorySink(object):
+    """
+    Histograms of timings and totals of counters
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.timings = {}
+        self.counters = {}
+
+    def timing(self, name, ms):
+        self.lock.acquire()
+        try:
+            stats = self.timings.get(name)
+            if stats is None:
+                stats = self.timings[name] = {
+                    'count': 0, 'total': 0.0, 'min': ms, 'max': ms,
+                    'buckets': [0] * (len(HISTOGRAM_BOUNDS) + 1)}
+            stats['count'] += 1
+            stats['total'] += ms
+            stats['min'] = min(stats['min'], ms)
+            stats['max'] = max(stats['max'], ms)
+            for index, bound in enumerate(HISTOGRAM_BOUNDS):
+                if ms <= bound:
+                    break
+            else:
+                index = len(HISTOGRAM_BOUNDS)
+            stats['buckets'][index] += 1
+        finally:
+            self.lock.release()
+
+    def incr(self, name, count):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + count
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        """
+        Return a copy of the histograms and counters, along with the bounds
+        of the buckets of histograms
+        """
+        self.lock.acquire()
+        try:
+            timings = {}
+            for name, stats in self.timings.items():
+                stats = dict(stats, buckets=list(stats['buckets']))
+                stats['mean'] = stats['total'] / stats['count']
+                timings[name] = stats
+            return {'bounds': list(HISTOGRAM_BOUNDS), 'timings': timings,
+                    'counters': dict(self.counters)}
+        finally:
+            self.lock.release()
+
+
+class StatsdSink(object):
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (
+            host or getattr(settings, 'AUDIOTRACKS_STATSD_HOST', 'localhost'),
+            port or getattr(settings, 'AUDIOTRACKS_STATSD_PORT', 8125))
+        if prefix is None:
+            prefix = getattr(settings, 'AUDIOTRACKS_STATSD_PREFIX',
+                             'audiotracks.')
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except (socket.error, socket.gaierror):
+            # Metrics are best effort
+            pass
+
+    def timing(self, name, ms):
+        self.send("%s%s:%d|ms" % (self.prefix, name, round(ms)))
+
+    def incr(self, name, count):
+        self.send("%s%s:%d|c" % (self.prefix, name, count))
+
+
+SINKS = {
+    'logging': LoggingSink,
+    'memory': MemorySink,
+    'statsd': StatsdSink,
+}
+
+_sinks = None
+
+
+def get_sinks():
+    global _sinks
+    if _sinks is None:
+        sinks = []
+        for path in getattr(settings, 'AUDIOTRACKS_METRICS_SINKS', ()):
+            if path in SINKS:
+                sink_class = SINKS[path]
+            else:
+                module_name, class_name = path.rsplit('.', 1)
+                try:
+                    sink_class = getattr(import_module(module_name),
+                                         class_name)
+                except (ImportError, AttributeError) as e:
+                    raise ImproperlyConfigured(
+                            'Error loading metrics sink %s: "%s"' % (path, e))
+            sinks.append(sink_class())
+        _sinks = sinks
+    return _sinks
+
+
+def get_sink(sink_class):
+    """
+    Return the enabled sink of class ``sink_class``, or None
+    """
+    for sink in get_sinks():
+        if isinstance(sink, sink_class):
+            return sink
+    return None
+
+
+def timing(name, ms):
+    for sink in get_sinks():
+        sink.timing(name, ms)
+
+
+def incr(name, count=1):
+    for sink in get_sinks():
+        sink.incr(name, count)
+
+
+class Timer(object):
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timing(self.name, (time.time() - self.started) * 1000)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(name):
+    """
+    Return a context manager measuring how long its block takes
+    """
+    if not get_sinks():
+        return NULL_TIMER
+    return Timer(name)
+
+
+def timed(name):
+    """
+    Decorator measuring how long calls to a function take
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,304 @@
+"""
+Background jobs.
+
+A job is a task name plus a key, usually the id of a track. Tasks are
+functions registered with the ``task`` decorator in ``audiotracks.tasks``; they
+receive the key and are run by the backend set in ``AUDIOTRACKS_JOB_BACKEND``:
+
+* ``audiotracks.jobs.ImmediateBackend`` runs jobs right away, within the
+  request. Delayed jobs are run once the response has been sent. This is the
+  default.
+* ``audiotracks.jobs.ThreadBackend`` runs jobs in a pool of threads of the web
+  server process, which is handy in development.
+* ``audiotracks.jobs.DatabaseBackend`` stores jobs in a table and relies on the
+  ``audiotracks_worker`` management command to run them.
+
+Tasks load the current state of whatever their key refers to, so enqueuing a
+job identical to one that is still pending doesn't add a job: it postpones the
+pending one by the new delay, so that a burst of changes is handled by a single
+run once it is over. A job isn't postponed more than
+``AUDIOTRACKS_JOB_MAX_DELAY`` seconds after it was first enqueued.
+
+Views enqueue jobs about the rows they change with ``enqueue_on_commit``, so
+that workers only look for them once the request is finished and its
+transaction committed.
+"""
+import datetime
+import logging
+import Queue
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started, request_finished
+from django.db import connection
+from django.db.models import F
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('audiotracks.jobs')
+
+MAX_DELAY = getattr(settings, 'AUDIOTRACKS_JOB_MAX_DELAY', 300)
+ATTEMPTS = getattr(settings, 'AUDIOTRACKS_JOB_ATTEMPTS', 3)
+RETRY_DELAY = getattr(settings, 'AUDIOTRACKS_JOB_RETRY_DELAY', 10)
+
+TASKS = {}
+
+
+def task(name):
+    """
+    Decorator registering a function as the task called ``name``
+    """
+    def decorator(func):
+        TASKS[name] = func
+        return func
+    return decorator
+
+
+def run_job(task_name, key):
+    import_module('audiotracks.tasks')  # Make sure tasks are registered
+    TASKS[task_name](key)
+
+
+class ImmediateBackend(object):
+    """
+    Run jobs right away. Jobs enqueued with a delay during a request are run
+    once, when the request is finished.
+    """
+    deferred = False
+
+    def enqueue(self, task_name, key, delay=0):
+        if delay and getattr(_request, 'jobs', None) is not None:
+            enqueue_on_commit(task_name, key)
+        else:
+            run_job(task_name, key)
+
+
+class Retry(Exception):
+    """
+    Raised by tasks which can't run yet. ``DatabaseBackend`` runs them again
+    after ``AUDIOTRACKS_JOB_RETRY_DELAY`` seconds, up to
+    ``AUDIOTRACKS_JOB_ATTEMPTS`` times, other backends report a failure.
+    """
+
+
+class ThreadBackend(object):
+    deferred = True
+
+    def __init__(self, workers=None):
+        self.workers = workers or getattr(settings, 'AUDIOTRACKS_JOB_WORKERS',
+                                          2)
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.pending = set()
+        # Timers of the delayed jobs, along with the time after which they
+        # can't be postponed anymore
+        self.timers = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, task_name, key, delay=0):
+        self.start()
+        job = (task_name, key)
+        self.lock.acquire()
+        try:
+            if job in self.pending:
+                if job in self.timers:
+                    timer, deadline = self.timers[job]
+                    timer.cancel()
+                    self.start_timer(job, min(delay, deadline - time.time()),
+                                     deadline)
+                return
+            self.pending.add(job)
+            if delay:
+                self.start_timer(job, delay, time.time() + MAX_DELAY)
+                return
+        finally:
+            self.lock.release()
+        self.queue.put(job)
+
+    def start_timer(self, job, delay, deadline):
+        timer = threading.Timer(max(delay, 0), self.release, [job])
+        timer.setDaemon(True)
+        self.timers[job] = (timer, deadline)
+        timer.start()
+
+    def release(self, job):
+        """
+        Queue a delayed job, unless it has been postponed
+        """
+        self.lock.acquire()
+        try:
+            if self.timers.get(job, (None,))[0] is not \
+                    threading.currentThread():
+                return
+            del self.timers[job]
+        finally:
+            self.lock.release()
+        self.queue.put(job)
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def work(self):
+        while True:
+            task_name, key = self.queue.get()
+            self.lock.acquire()
+            self.pending.discard((task_name, key))
+            self.lock.release()
+            try:
+                run_job(task_name, key)
+            except Exception:
+                logger.exception("Job %s(%s) failed", task_name, key)
+            finally:
+                # Each thread has its own database connection
+                connection.close()
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Block until all queued jobs have been run
+        """
+        self.queue.join()
+
+
+class DatabaseBackend(object):
+    deferred = True
+
+    def enqueue(self, task_name, key, delay=0):
+        from audiotracks.models import Job
+        run_after = datetime.datetime.now() + \
+                datetime.timedelta(seconds=delay)
+        pending = Job.objects.filter(task=task_name, key=key,
+                status=Job.PENDING).values_list('id', 'created_at')[:1]
+        if pending:
+            job_id, created_at = pending[0]
+            run_after = min(run_after,
+                    created_at + datetime.timedelta(seconds=MAX_DELAY))
+            # Unless a worker has claimed the job in the meantime
+            if Job.objects.filter(id=job_id, status=Job.PENDING).update(
+                    run_after=run_after):
+                return
+        Job.objects.create(task=task_name, key=key, run_after=run_after)
+
+    def claim(self):
+        """
+        Mark the oldest pending job which is due as running and return it, or
+        return None if there is no such job
+        """
+        from audiotracks.models import Job
+        while True:
+            try:
+                job = Job.objects.filter(status=Job.PENDING,
+                        run_after__lte=datetime.datetime.now()
+                        ).order_by('run_after', 'id')[0]
+            except IndexError:
+                return None
+            # Another worker may have claimed the job in the meantime
+            claimed = Job.objects.filter(id=job.id, status=Job.PENDING).update(
+                    status=Job.RUNNING, attempts=F('attempts') + 1)
+            if claimed:
+                return job
+
+    def run_pending(self):
+        """
+        Run pending jobs until there are none left and return how many jobs
+        have been run
+        """
+        from audiotracks.models import Job
+        count = 0
+        while True:
+            job = self.claim()
+            if job is None:
+                return count
+            try:
+                run_job(job.task, job.key)
+            except Exception as e:
+                # The job has been fetched before its attempt was counted
+                if isinstance(e, Retry) and job.attempts + 1 < ATTEMPTS:
+                    Job.objects.filter(id=job.id).update(status=Job.PENDING,
+                            run_after=datetime.datetime.now() +
+                            datetime.timedelta(seconds=RETRY_DELAY))
+                else:
+                    logger.exception("Job %s(%s) failed", job.task, job.key)
+                    Job.objects.filter(id=job.id).update(status=Job.FAILED,
+                            error=traceback.format_exc())
+            else:
+                job.delete()
+            count += 1
+
+    def work(self, interval=5):
+        while True:
+            if not self.run_pending():
+                time.sleep(interval)
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'AUDIOTRACKS_JOB_BACKEND',
+                       'audiotracks.jobs.ImmediateBackend')
+        module_name, class_name = path.rsplit('.', 1)
+        try:
+            backend_class = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured('Error loading job backend %s: "%s"' %
+                                       (path, e))
+        _backend = backend_class()
+    return _backend
+
+
+def enqueue(task_name, key, delay=0):
+    """
+    Run the task ``task_name`` for ``key``, waiting at least ``delay``
+    seconds if the backend defers jobs
+    """
+    get_backend().enqueue(task_name, unicode(key), delay)
+
+
+# Jobs held by enqueue_on_commit() until the end of the request handled by
+# the current thread
+_request = threading.local()
+
+
+def enqueue_on_commit(task_name, key, delay=0):
+    """
+    Enqueue a job once the current request is finished, after
+    TransactionMiddleware has committed its changes, so that workers don't
+    look for rows which don't exist yet. Outside of requests the job is
+    enqueued right away.
+    """
+    pending = getattr(_request, 'jobs', None)
+    if pending is None:
+        enqueue(task_name, key, delay)
+    elif (task_name, unicode(key), delay) not in pending:
+        pending.append((task_name, unicode(key), delay))
+
+
+def start_request(**kwargs):
+    _request.jobs = []
+
+
+def finish_request(**kwargs):
+    pending = getattr(_request, 'jobs', None) or []
+    _request.jobs = None
+    for task_name, key, delay in pending:
+        try:
+            enqueue(task_name, key, delay)
+        except Exception:
+            logger.exception("Job %s(%s) failed", task_name, key)
+
+
+request_started.connect(start_request)
+request_finished.connect(finish_request)
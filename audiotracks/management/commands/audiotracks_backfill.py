@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q
+
+from audiotracks.models import Track
+from audiotracks.stats import reconcile_all
+from audiotracks.tasks import AUDIO_INFO_FIELDS
+
+
+class Command(NoArgsCommand):
+    help = ("Store size, MIME type, duration, bitrate and sample rate of the "
+            "audio files of existing tracks.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all', action='store_true', dest='all', default=False,
+            help='Process all tracks, not only the ones missing information'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        tracks = Track.objects.order_by('id')
+        if not options['all']:
+            tracks = tracks.filter(Q(audio_size__isnull=True) |
+                                   Q(sample_rate__isnull=True))
+        count = 0
+        for track in tracks.iterator():
+            try:
+                track.update_audio_info()
+            except (IOError, OSError) as e:
+                self.stderr.write("Skipping track %s: %s\n" % (track.id, e))
+                continue
+            # Use update() so that updated_at isn't touched
+            Track.objects.filter(id=track.id).update(**dict(
+                (field, getattr(track, field)) for field in AUDIO_INFO_FIELDS))
+            count += 1
+            if verbosity > 1:
+                self.stdout.write("%s\n" % track.audio_file.name)
+        if count:
+            # Sizes and durations have been updated without saving tracks
+            reconcile_all()
+        if verbosity:
+            self.stdout.write("Updated %d track(s).\n" % count)
@@ -0,0 +1,30 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from audiotracks.indexes import create_indexes, sql_all_indexes
+from audiotracks.models import Track
+
+
+class Command(NoArgsCommand):
+    help = ("Create the indexes of the track table which are missing from a "
+            "database created by an older version of django-audiotracks.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the CREATE INDEX statements instead of running them'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        if options['sql']:
+            for statement in sql_all_indexes(Track, self.style):
+                self.stdout.write(statement + '\n')
+            return
+        with transaction.commit_on_success():
+            created = create_indexes(sql_all_indexes(Track))
+        if verbosity > 1:
+            for statement in created:
+                self.stdout.write(statement + '\n')
+        if verbosity:
+            self.stdout.write("Created %d index(es).\n" % len(created))
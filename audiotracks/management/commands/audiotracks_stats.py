@@ -0,0 +1,20 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from audiotracks.stats import reconcile_all
+
+
+class Command(NoArgsCommand):
+    help = ("Recompute the track statistics of all users, fixing those which "
+            "drifted from their tracks.")
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        with transaction.commit_on_success():
+            fixed = reconcile_all()
+        if verbosity > 1:
+            for user_id in fixed:
+                self.stdout.write("Fixed the statistics of user %s\n"
+                                  % user_id)
+        if verbosity:
+            self.stdout.write("Fixed %d user(s).\n" % len(fixed))
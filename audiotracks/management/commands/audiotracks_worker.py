@@ -0,0 +1,42 @@
+import threading
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from audiotracks.jobs import DatabaseBackend
+
+
+class Command(NoArgsCommand):
+    help = ("Run the background jobs stored in the database. Use it along "
+            "with AUDIOTRACKS_JOB_BACKEND = "
+            "'audiotracks.jobs.DatabaseBackend'.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--threads', type='int', dest='threads', default=1,
+            help='Number of jobs to run concurrently'),
+        make_option('--interval', type='float', dest='interval', default=5,
+            help='Seconds to wait before polling again when the queue is '
+                 'empty'),
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Exit when there are no pending jobs left'),
+    )
+
+    def handle_noargs(self, **options):
+        backend = DatabaseBackend()
+        if options['once']:
+            target = backend.run_pending
+            kwargs = {}
+        else:
+            target = backend.work
+            kwargs = {'interval': options['interval']}
+        if options['threads'] == 1:
+            target(**kwargs)
+            return
+        threads = [threading.Thread(target=target, kwargs=kwargs)
+                   for i in range(options['threads'])]
+        for thread in threads:
+            thread.setDaemon(True)
+            thread.start()
+        for thread in threads:
+            # join() with a timeout lets KeyboardInterrupt through
+            while thread.isAlive():
+                thread.join(1)
@@ -0,0 +1,248 @@
+import datetime
+import mimetypes
+import multiprocessing
+import os
+import time
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.template.defaultfilters import slugify
+from django.utils.hashcompat import sha_constructor
+
+from audiotracks import contentstore, jobs, staticfeeds, stats
+from audiotracks.caching import touch_scope
+from audiotracks.metadata import (read_metadata, get_audio_info,
+                                  get_cover_art, METADATA_FIELDS)
+from audiotracks.models import Track, get_audio_upload_path
+
+AUDIO_EXTENSIONS = ('.flac', '.m4a', '.mp3', '.mp4', '.oga', '.ogg', '.wav')
+
+# Name of the file recording which files have been imported, in the imported
+# directory unless the --state option is given
+STATE_FILENAME = '.audiotracks_import'
+
+
+def extract(path):
+    """
+    Read everything needed to create a track from the audio file located at
+    ``path``. Run in the worker processes, so it must not touch the database.
+    Return a ``(path, data, error)`` tuple.
+    """
+    try:
+        metadata = read_metadata(path)
+        info = get_audio_info(path, metadata)
+        if metadata is None and not info['duration']:
+            raise ValueError("not a supported audio file")
+        tags = {}
+        for field in METADATA_FIELDS:
+            if metadata and metadata.get(field):
+                tags[field] = metadata.get(field)[0]
+        content_hash = sha_constructor()
+        f = open(path, 'rb')
+        try:
+            for chunk in iter(lambda: f.read(64 * 2 ** 10), ''):
+                content_hash.update(chunk)
+        finally:
+            f.close()
+        mimetype = mimetypes.guess_type(path)[0]
+        if not mimetype and getattr(metadata, 'mime', None):
+            mimetype = metadata.mime[0]
+        data = {
+            'tags': tags,
+            'info': info,
+            'size': os.path.getsize(path),
+            'mimetype': mimetype,
+            'content_hash': content_hash.hexdigest(),
+            'cover_art': get_cover_art(path) is not None,
+        }
+    except Exception as e:
+        return path, None, str(e)
+    return path, data, None
+
+
+class SlugAllocator(object):
+    """
+    Allocate unique slugs the way ``slugify_uniquely`` does, but from an in
+    memory set of the slugs already taken
+    """
+
+    def __init__(self, taken):
+        self.taken = set(taken)
+        self.next_suffix = {}
+
+    def allocate(self, value):
+        base = slugify(value)
+        slug = base
+        if slug in self.taken:
+            suffix = self.next_suffix.get(base, 2)
+            while "%s-%d" % (base, suffix) in self.taken:
+                suffix += 1
+            self.next_suffix[base] = suffix + 1
+            slug = "%s-%d" % (base, suffix)
+        self.taken.add(slug)
+        return slug
+
+
+class Command(BaseCommand):
+    args = '<username> <directory>'
+    help = ("Import the audio files found in a directory tree as tracks of "
+            "the given user. Interrupted imports can be resumed by running "
+            "the command again.")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes',
+            default=None, help='Number of processes reading metadata '
+                               '(default: number of CPUs)'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=200, help='Number of tracks created per query'),
+        make_option('--state', dest='state', default=None,
+            help='File recording the imported files (default: %s in the '
+                 'directory)' % STATE_FILENAME),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Usage: import_tracks %s" % self.args)
+        username, directory = args
+        try:
+            self.user = User.objects.get(username=username)
+        except User.DoesNotExist:
+            raise CommandError("User %s doesn't exist" % username)
+        if not os.path.isdir(directory):
+            raise CommandError("%s isn't a directory" % directory)
+        self.verbosity = int(options.get('verbosity', 1))
+        batch_size = options['batch_size']
+
+        state_path = options['state'] or os.path.join(directory,
+                                                      STATE_FILENAME)
+        done = set()
+        if os.path.exists(state_path):
+            done = set(line.rstrip('\n') for line in open(state_path))
+        paths = [path for path in self.find_files(directory)
+                 if os.path.relpath(path, directory) not in done]
+        if self.verbosity:
+            self.stdout.write("%d file(s) to import, %d already imported.\n"
+                              % (len(paths), len(done)))
+        if not paths:
+            return
+
+        self.slugs = SlugAllocator(Track.objects.filter(user=self.user
+                ).values_list('slug', flat=True))
+        self.state = open(state_path, 'a')
+        self.imported = self.failed = self.bytes = 0
+        self.started = time.time()
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            batch = []
+            for path, data, error in pool.imap(extract, paths, 8):
+                if error is not None:
+                    self.failed += 1
+                    self.stderr.write("Skipping %s: %s\n" % (path, error))
+                    continue
+                batch.append((os.path.relpath(path, directory), path, data))
+                if len(batch) == batch_size:
+                    self.import_batch(batch)
+                    batch = []
+            if batch:
+                self.import_batch(batch)
+        finally:
+            pool.terminate()
+            self.state.close()
+        if self.verbosity:
+            self.report()
+            self.stdout.write("\n")
+
+    def find_files(self, directory):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in AUDIO_EXTENSIONS:
+                    yield os.path.join(dirpath, filename)
+
+    def import_batch(self, batch):
+        now = datetime.datetime.now()
+        tracks = []
+        cover_art = set()
+        # Audio files stored for the batch, deleted if it isn't committed
+        stored = []
+        bulk = hasattr(Track.objects, 'bulk_create')
+        try:
+            # Saving each track sends post_save, whose handlers would
+            # schedule the static feeds once per track
+            with staticfeeds.batched():
+                with transaction.commit_on_success():
+                    for relative_path, path, data in batch:
+                        track = self.build_track(path, data, now, stored)
+                        tracks.append(track)
+                        if data['cover_art']:
+                            cover_art.add(track.slug)
+                    if bulk:
+                        Track.objects.bulk_create(tracks)
+                        # bulk_create doesn't send signals
+                        stats.adjust(self.user.id, len(tracks),
+                                sum([track.audio_size for track in tracks]),
+                                sum([track.duration or 0 for track in tracks]),
+                                now)
+                        staticfeeds.schedule_feeds(Track, tracks[0])
+                    else:
+                        for track in tracks:
+                            track.save()
+        except:
+            storage = Track._meta.get_field('audio_file').storage
+            for name in stored:
+                storage.delete(name)
+            raise
+        if bulk:
+            touch_scope()
+            touch_scope(self.user.username)
+        # Only record the files once their tracks are committed
+        for relative_path, path, data in batch:
+            self.state.write(relative_path + '\n')
+            self.bytes += data['size']
+        self.state.flush()
+        self.imported += len(batch)
+
+        # bulk_create doesn't set primary keys on every database
+        ids = Track.objects.filter(user=self.user,
+                slug__in=[track.slug for track in tracks]
+                ).values_list('slug', 'id')
+        for slug, track_id in ids:
+            if slug in cover_art:
+                jobs.enqueue('extract_cover_art', track_id)
+            jobs.enqueue('compute_waveform', track_id)
+        if self.verbosity:
+            self.report()
+
+    def build_track(self, path, data, now, stored):
+        tags, info = data['tags'], data['info']
+        track = Track(user=self.user, created_at=now, updated_at=now,
+                      audio_size=data['size'], audio_mimetype=data['mimetype'],
+                      duration=info['duration'], bitrate=info['bitrate'],
+                      sample_rate=info['sample_rate'],
+                      content_hash=data['content_hash'], **tags)
+        basename = os.path.basename(path)
+        name = get_audio_upload_path(track, basename)
+        storage = Track._meta.get_field('audio_file').storage
+        if not (contentstore.is_blob(name) and contentstore.acquire(name)):
+            f = open(path, 'rb')
+            try:
+                name = storage.save(name, File(f))
+            finally:
+                f.close()
+            stored.append(name)
+            if contentstore.is_blob(name):
+                contentstore.add_reference(name)
+        track.audio_file = name
+        track.slug = self.slugs.allocate(track.title or
+                                         os.path.splitext(basename)[0])
+        return track
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 0.001)
+        self.stdout.write("\rImported %d file(s), %d failed, %.1f files/s, "
+                          "%.1f MB/s" % (self.imported, self.failed,
+                          self.imported / elapsed,
+                          self.bytes / elapsed / 2 ** 20))
+        self.stdout.flush()
@@ -0,0 +1,179 @@
+"""
+Helpers to read technical information from audio files.
+"""
+import base64
+import os
+import shutil
+import tempfile
+import wave
+from contextlib import contextmanager
+
+import mutagen
+from mutagen.easyid3 import EasyID3KeyError
+from mutagen.flac import Picture
+from mutagen.mp4 import MP4Cover
+
+from audiotracks.instrumentation import timed, timer
+
+METADATA_FIELDS = ('title', 'artist', 'genre', 'description', 'date')
+
+# File extensions of the cover art formats we accept
+IMAGE_EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/jpg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+}
+
+
+@contextmanager
+def local_copy(audio_file):
+    """
+    Yield the path of a local file holding the content of ``audio_file``,
+    which can be an uploaded file or a FieldFile. The file is only copied
+    when it isn't available on the local filesystem already.
+    """
+    uploaded_file = getattr(audio_file, 'file', audio_file)
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        yield uploaded_file.temporary_file_path()
+        return
+    if getattr(audio_file, '_committed', False):
+        try:
+            path = audio_file.path
+        except NotImplementedError:
+            # Remote storage
+            pass
+        else:
+            if os.path.exists(path):
+                yield path
+                return
+    ext = os.path.splitext(audio_file.name)[1]
+    tmp = tempfile.NamedTemporaryFile(suffix=ext)
+    try:
+        if hasattr(audio_file, 'chunks'):
+            audio_file.open('rb')
+            for chunk in audio_file.chunks():
+                tmp.write(chunk)
+        else:
+            audio_file.seek(0)
+            shutil.copyfileobj(audio_file, tmp)
+        tmp.flush()
+        yield tmp.name
+    finally:
+        tmp.close()
+
+
+@timed('metadata.read')
+def read_metadata(path):
+    try:
+        return mutagen.File(path, easy=True)
+    except Exception:
+        return None
+
+
+def update_audiofile_metadata(track, path=None):
+    """
+    Write the tags of ``track`` into its audio file, or into the file located
+    at ``path``. The file is only saved if at least one tag differs from what
+    it already contains. Return whether the file has been modified.
+    """
+    if path is None:
+        try:
+            path = track.audio_file.path
+        except NotImplementedError:
+            # Tags can't be written back to remote storages
+            return False
+    metadata = read_metadata(path)
+    changed = False
+    if metadata:
+        for field in METADATA_FIELDS:
+            value = getattr(track, field) or u''
+            if (metadata.get(field) or [u''])[0] == value:
+                continue
+            try:
+                metadata[field] = value
+            except EasyID3KeyError:
+                pass
+            else:
+                changed = True
+        if changed:
+            with timer('metadata.write'):
+                metadata.save()
+    return changed
+
+
+def get_audio_info(path, metadata=None):
+    """
+    Return a dictionary containing the duration (in seconds), the bitrate (in
+    bits per second) and the sample rate (in Hz) of the audio file located at
+    ``path``. Pass the mutagen object as ``metadata`` if the file has already
+    been parsed.
+    """
+    if metadata is None:
+        metadata = read_metadata(path)
+    info = {'duration': None, 'bitrate': None, 'sample_rate': None}
+    stream_info = getattr(metadata, 'info', None)
+    if stream_info is not None:
+        info['duration'] = getattr(stream_info, 'length', None)
+        info['bitrate'] = getattr(stream_info, 'bitrate', None)
+        info['sample_rate'] = getattr(stream_info, 'sample_rate', None)
+    else:
+        # mutagen doesn't handle WAV files
+        try:
+            wav = wave.open(path, 'rb')
+        except (wave.Error, EOFError, IOError):
+            pass
+        else:
+            rate = info['sample_rate'] = wav.getframerate()
+            if rate:
+                info['duration'] = wav.getnframes() / float(rate)
+            info['bitrate'] = rate * wav.getnchannels() * \
+                    wav.getsampwidth() * 8
+            wav.close()
+    if not info['bitrate'] and info['duration']:
+        info['bitrate'] = int(os.path.getsize(path) * 8 / info['duration'])
+    return info
+
+
+def get_cover_art(path):
+    """
+    Return a ``(data, extension)`` tuple containing the first picture embedded
+    in the audio file located at ``path``, or None if it doesn't contain any
+    picture in a supported format.
+    """
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return None
+    if audio is None:
+        return None
+    pictures = []  # list of (data, mimetype) tuples
+    # FLAC
+    for picture in getattr(audio, 'pictures', []):
+        pictures.append((picture.data, picture.mime))
+    tags = audio.tags
+    if hasattr(tags, 'getall'):
+        # ID3
+        for frame in tags.getall('APIC'):
+            pictures.append((frame.data, frame.mime))
+    elif tags is not None:
+        # Vorbis comments and MP4 atoms
+        for value in tags.get('metadata_block_picture', []):
+            try:
+                picture = Picture(base64.b64decode(value))
+            except Exception:
+                continue
+            pictures.append((picture.data, picture.mime))
+        for value, mimetype in zip(tags.get('coverart', []),
+                                   tags.get('coverartmime', [])):
+            pictures.append((base64.b64decode(value), mimetype))
+        for cover in tags.get('covr', []):
+            if getattr(cover, 'imageformat', None) == MP4Cover.FORMAT_PNG:
+                pictures.append((str(cover), 'image/png'))
+            else:
+                pictures.append((str(cover), 'image/jpeg'))
+    for data, mimetype in pictures:
+        extension = IMAGE_EXTENSIONS.get((mimetype or '').lower())
+        if data and extension:
+            return data, extension
+    return None
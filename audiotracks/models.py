@@ -1,28 +1,83 @@
+import datetime
 import os
 import mimetypes
+import shutil
+import tempfile
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import models
+from django.core import urlresolvers
+from django.core.files.base import ContentFile, File
+from django.db import models, transaction, IntegrityError
+from django.db.models.signals import post_save, post_delete, post_syncdb
 from django.template.defaultfilters import slugify
 from django.utils.translation  import ugettext_lazy as _
 
 from thumbs import ImageWithThumbsField
+from audiotracks import contentstore, stats
+from audiotracks.caching import track_changed
+from audiotracks.staticfeeds import schedule_feeds
+from audiotracks.indexes import create_composite_indexes
+from audiotracks.instrumentation import timed
+from audiotracks.metadata import (local_copy, read_metadata, get_audio_info,
+        get_cover_art, update_audiofile_metadata, METADATA_FIELDS)
 
-def slugify_uniquely(value, obj, slugfield="slug"): 
-    suffix = 1
-    potential = base = slugify(value)
+# How many times to try saving a new track when concurrent uploads pick the
+# same slug
+SLUG_ATTEMPTS = 5
+
+
+@timed('track.slugify')
+def slugify_uniquely(value, obj, slugfield="slug"):
+    """
+    Return a slug based on ``value`` that isn't used yet by another track of
+    the owner of ``obj``, adding a numeric suffix if needed. All the
+    conflicting slugs are fetched with a single query.
+    """
+    base = slugify(value)
     filter_params = {}
     filter_params['user'] = obj.user
-    while True:
-        if suffix > 1:
-            potential = "-".join([base, str(suffix)])
-        filter_params[slugfield] = potential
-        obj_count = obj.__class__.objects.filter(**filter_params).count()
-        if not obj_count:
-            return potential
+    filter_params['%s__startswith' % slugfield] = base
+    tracks = obj.__class__.objects.filter(**filter_params)
+    if obj.pk is not None:
+        tracks = tracks.exclude(pk=obj.pk)
+    taken = set(tracks.values_list(slugfield, flat=True))
+    if base not in taken:
+        return base
+    prefix = base + "-"
+    suffixes = set(int(slug[len(prefix):]) for slug in taken
+                   if slug.startswith(prefix) and slug[len(prefix):].isdigit())
+    suffix = 2
+    while suffix in suffixes:
         # we hit a conflicting slug, so bump the suffix & try again
         suffix += 1
+    return "-".join([base, str(suffix)])
+
+
+METADATA_PENDING = 'pending'
+METADATA_READY = 'ready'
+METADATA_FAILED = 'failed'
+METADATA_STATUS_CHOICES = (
+    (METADATA_PENDING, _("Pending")),
+    (METADATA_READY, _("Ready")),
+    (METADATA_FAILED, _("Failed")),
+)
+
+# Columns needed to render track listings
+LISTING_FIELDS = ('id', 'slug', 'title', 'created_at', 'updated_at', 'image',
+                  'user__username')
+
+
+class TrackManager(models.Manager):
+
+    def listing(self):
+        """
+        Return tracks along with their user, loading only the columns needed
+        to display them in a list
+        """
+        return self.get_query_set().select_related('user').only(
+                *LISTING_FIELDS)
 
 
 def get_upload_path(dirname, obj, filename):
@@ -31,21 +86,49 @@ def get_upload_path(dirname, obj, filename):
 def get_images_upload_path(obj, filename):
     return get_upload_path("images", obj, filename)
 
+def get_waveform_upload_path(obj, filename):
+    return get_upload_path("waveforms", obj, filename)
+
 def get_audio_upload_path(obj, filename):
+    if contentstore.ENABLED and obj.content_hash:
+        return contentstore.blob_name(obj.content_hash, filename)
     return get_upload_path("audio_files", obj, filename)
 
 
+@contextmanager
+def managed_transaction():
+    """
+    Run a block in a transaction committed at its end, unless it runs in a
+    transaction managed by the caller, the way Django deletes objects
+    """
+    if transaction.is_managed():
+        yield
+        return
+    transaction.enter_transaction_management()
+    transaction.managed(True)
+    try:
+        yield
+    except:
+        transaction.rollback()
+        raise
+    else:
+        transaction.commit()
+    finally:
+        transaction.leave_transaction_management()
+
+
 class AbstractTrack(models.Model):
 
     class Meta:
         abstract = True
+        unique_together = (('user', 'slug'),)
 
     user = models.ForeignKey(User,
         related_name = "tracks",
         blank = True,
         null = True
     )
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     updated_at = models.DateTimeField(auto_now=True)
     audio_file = models.FileField(_("Audio file"), upload_to=get_audio_upload_path)
     image = ImageWithThumbsField(_("Image"), upload_to=get_images_upload_path, null=True,
@@ -56,34 +139,347 @@ class AbstractTrack(models.Model):
     date = models.CharField(_("Date"), max_length="200", null=True, blank=True)
     description = models.TextField(_("Description"), null=True, blank=True)
     slug = models.SlugField(verbose_name=_("Slug (last part of the url)"))
+    # Technical information about the audio file, stored at upload time so
+    # that feeds and listings don't need to access the storage
+    audio_size = models.BigIntegerField(_("File size"), null=True,
+            editable=False)
+    audio_mimetype = models.CharField(_("MIME type"), max_length=100,
+            null=True, editable=False)
+    duration = models.FloatField(_("Duration"), null=True, editable=False)
+    bitrate = models.PositiveIntegerField(_("Bitrate"), null=True,
+            editable=False)
+    sample_rate = models.PositiveIntegerField(_("Sample rate"), null=True,
+            editable=False)
+    metadata_status = models.CharField(_("Metadata status"), max_length=10,
+            choices=METADATA_STATUS_CHOICES, default=METADATA_READY,
+            editable=False)
+    content_hash = models.CharField(_("SHA-1 hash"), max_length=40,
+            blank=True, db_index=True, editable=False)
+    waveform = models.FileField(_("Waveform"),
+            upload_to=get_waveform_upload_path, null=True, blank=True,
+            editable=False)
     _original_slug = None # Used to detect slug change
+    _original_stats = None # Used to update the statistics of the user
+
+    # Indexes for listings of a user's tracks, see audiotracks.indexes. The
+    # (user, slug) index comes with unique_together.
+    COMPOSITE_INDEXES = (('user', 'created_at'),)
+
+    objects = TrackManager()
 
     def __init__(self, *args, **kwargs):
         super(AbstractTrack, self).__init__(*args, **kwargs)
         self._original_slug = self.slug
+        self._original_stats = stats.get_snapshot(self)
 
     def __unicode__(self):
         return "Track '%s' uploaded by '%s'" % (self.title, self.user.username)
 
     def save(self, **kwargs):
-        if not self.slug:
-            # Automatically set initial slug
-            slug_source = getattr(self, 'title') or \
-                    os.path.splitext(os.path.basename(self.audio_file.name))[0]
+        previous_name = None
+        new_blob = released = False
+        # The statistics of the user, updated by a post_save handler, and the
+        # references to audio blobs change in the same transaction
+        with managed_transaction():
+            if contentstore.ENABLED and self.audio_file and \
+                    not self.audio_file._committed:
+                previous_name = self.store_audio_blob()
+                new_blob = not self.audio_file._committed
+            self.save_with_unique_slug(**kwargs)
+            if new_blob:
+                contentstore.add_reference(self.audio_file.name)
+            if previous_name and previous_name != self.audio_file.name and \
+                    contentstore.is_blob(previous_name):
+                released = contentstore.release(previous_name)
+        if released:
+            self.audio_file.storage.delete(previous_name)
+
+    def delete(self, *args, **kwargs):
+        super(AbstractTrack, self).delete(*args, **kwargs)
+        # Set by the post_delete handler releasing the audio blob
+        name = getattr(self, '_released_blob', None)
+        if name:
+            self.audio_file.storage.delete(name)
+
+    def save_with_unique_slug(self, **kwargs):
+        if self.slug:
+            return super(AbstractTrack, self).save(**kwargs)
+
+        # Automatically set initial slug
+        slug_source = getattr(self, 'title') or \
+                os.path.splitext(os.path.basename(self.audio_file.name))[0]
+        for attempt in range(SLUG_ATTEMPTS):
             self.slug = slugify_uniquely(slug_source, self)
-        super(AbstractTrack, self).save(**kwargs)
+            sid = transaction.savepoint()
+            try:
+                super(AbstractTrack, self).save(**kwargs)
+            except IntegrityError:
+                # Another track has taken the slug since we picked it
+                transaction.savepoint_rollback(sid)
+                if attempt == SLUG_ATTEMPTS - 1:
+                    raise
+            else:
+                transaction.savepoint_commit(sid)
+                return
+
+    def store_audio_blob(self):
+        """
+        Point the new audio file of the track to the blob of the same content,
+        if it is already stored, and add a reference to it. Otherwise the file
+        is stored as a new blob when the track is saved, and referenced once
+        saved. Return the name of the audio file the track referenced until
+        now, if any.
+        """
+        if not self.content_hash:
+            self.content_hash = contentstore.hash_file(self.audio_file)
+        previous_name = None
+        if self.pk:
+            names = type(self).objects.filter(pk=self.pk).values_list(
+                    'audio_file', flat=True)
+            if names:
+                previous_name = names[0]
+        name = contentstore.blob_name(self.content_hash, self.audio_file.name)
+        if contentstore.acquire(name):
+            self.audio_file.name = name
+            self.audio_file._committed = True
+        return previous_name
 
     @property
     def mimetype(self):
-        return mimetypes.guess_type(self.audio_file.path)[0]
+        if self.audio_mimetype:
+            return self.audio_mimetype
+        return mimetypes.guess_type(self.audio_file.name)[0]
+
+    def update_audio_info(self, path=None, metadata=None):
+        """
+        Store size, MIME type, duration and bitrate of the audio file. Call
+        this whenever the audio file is set or replaced, passing the path of a
+        local copy and the mutagen object if they are already available.
+        """
+        if path is None:
+            with local_copy(self.audio_file) as path:
+                return self.update_audio_info(path, metadata)
+        info = get_audio_info(path, metadata)
+        self.audio_size = self.audio_file.size
+        self.audio_mimetype = mimetypes.guess_type(self.audio_file.name)[0]
+        if not self.audio_mimetype and getattr(metadata, 'mime', None):
+            self.audio_mimetype = metadata.mime[0]
+        self.duration = info['duration']
+        self.bitrate = info['bitrate']
+        self.sample_rate = info['sample_rate']
+
+    def fill_from_audio_file(self, path, metadata=None, overwrite=True):
+        """
+        Copy tags, technical information and embedded cover art from the audio
+        file located at ``path``. Fields which already have a value are left
+        alone unless ``overwrite`` is True. The track isn't saved.
+        """
+        if metadata is None:
+            metadata = read_metadata(path)
+        for field in METADATA_FIELDS:
+            if metadata and metadata.get(field) and \
+                    (overwrite or not getattr(self, field)):
+                setattr(self, field, metadata.get(field)[0])
+        self.update_audio_info(path, metadata)
+        if not self.image:
+            self.extract_cover_art(path)
+
+    def extract_cover_art(self, path):
+        """
+        Use the picture embedded in the audio file located at ``path``, if
+        any, as the image of the track. The track isn't saved.
+        """
+        cover_art = get_cover_art(path)
+        if cover_art is not None:
+            data, extension = cover_art
+            basename = os.path.splitext(
+                    os.path.basename(self.audio_file.name))[0]
+            self.image.save("%s.%s" % (basename, extension),
+                    ContentFile(data), save=False)
+
+    def write_tags(self):
+        """
+        Write the tags of the track into its audio file, if they changed.
+        Blobs may be shared with other tracks, so instead of being modified
+        they are copied and the copy is stored as a new blob. Return whether
+        the audio file changed.
+        """
+        previous_name, previous_size = self.audio_file.name, self.audio_size
+        if not contentstore.is_blob(previous_name):
+            if not update_audiofile_metadata(self):
+                return False
+            self.audio_size = self.audio_file.size
+            self.content_hash = contentstore.hash_file(self.audio_file)
+            with managed_transaction():
+                return self.save_audio_file(previous_name, previous_size)
+        storage = self.audio_file.storage
+        tmp = tempfile.NamedTemporaryFile(
+                suffix=os.path.splitext(previous_name)[1])
+        try:
+            self.audio_file.open('rb')
+            try:
+                shutil.copyfileobj(self.audio_file, tmp)
+            finally:
+                self.audio_file.close()
+            tmp.flush()
+            if not update_audiofile_metadata(self, tmp.name):
+                return False
+            tmp.seek(0)
+            self.content_hash = contentstore.hash_file(File(tmp))
+            self.audio_size = os.path.getsize(tmp.name)
+            name = contentstore.blob_name(self.content_hash, previous_name)
+            with managed_transaction():
+                if not contentstore.acquire(name):
+                    name = storage.save(name, File(tmp))
+                    contentstore.add_reference(name)
+                self.audio_file.name = name
+                saved = self.save_audio_file(previous_name, previous_size)
+                # The blob the track doesn't reference is released
+                unused = saved and previous_name or name
+                released = contentstore.release(unused)
+        finally:
+            tmp.close()
+        if released:
+            storage.delete(unused)
+        return saved
+
+    def save_audio_file(self, previous_name, previous_size):
+        """
+        Store the audio file of the track and its size and hash, leaving the
+        other columns, which may have been edited since the track was loaded,
+        alone. Return False if the audio file of the track isn't
+        ``previous_name`` anymore, in which case nothing is stored.
+        """
+        self.updated_at = datetime.datetime.now()
+        if not type(self).objects.filter(id=self.id,
+                audio_file=previous_name).update(
+                audio_file=self.audio_file.name, audio_size=self.audio_size,
+                content_hash=self.content_hash, updated_at=self.updated_at):
+            return False
+        if self.user_id:
+            stats.adjust(self.user_id, 0,
+                         (self.audio_size or 0) - (previous_size or 0))
+        return True
 
     @models.permalink
     def get_absolute_url(self):
         return ('audiotracks.views.track_detail', [self.user.username, self.slug])
 
+    def get_audio_url(self):
+        """
+        URL to play the audio file, served by the track_audio view if the
+        AUDIOTRACKS_SERVE_AUDIO setting is True
+        """
+        if getattr(settings, 'AUDIOTRACKS_SERVE_AUDIO', False):
+            return urlresolvers.reverse('track_audio',
+                                        args=[self.user.username, self.slug])
+        return self.audio_file.url
+
+    def get_waveform_url(self):
+        return urlresolvers.reverse('track_waveform',
+                                    args=[self.user.username, self.slug])
+
+    def get_download_url(self):
+        if getattr(settings, 'AUDIOTRACKS_SERVE_AUDIO', False):
+            return self.get_audio_url() + '?download'
+        return self.audio_file.url
+
 if hasattr(settings, 'AUDIOTRACKS_MODEL'):
     app_name, model_name = settings.AUDIOTRACKS_MODEL.split('.')
     Track = models.get_model(app_name, model_name)
 else:
     class Track(AbstractTrack):
         pass
+
+
+class TrackStats(models.Model):
+    """
+    Statistics of the tracks of a user, maintained by ``audiotracks.stats``
+    """
+    user = models.OneToOneField(User, primary_key=True,
+            related_name="track_stats")
+    track_count = models.PositiveIntegerField(_("Tracks"), default=0)
+    total_size = models.BigIntegerField(_("Total size"), default=0)
+    total_duration = models.FloatField(_("Total duration"), default=0)
+    latest_created_at = models.DateTimeField(_("Latest track"), null=True)
+    # Time of the last change to the tracks of the user
+    updated_at = models.DateTimeField(default=datetime.datetime.now)
+
+    def __unicode__(self):
+        return "Statistics of the tracks of '%s'" % self.user
+
+
+class TrackCounters(models.Model):
+    """
+    Play and download counts of a track, updated in batches by
+    ``audiotracks.counters``. They are kept out of the track table so that
+    saving a track never writes back counts loaded before a flush.
+    """
+    track = models.OneToOneField(Track, primary_key=True,
+            related_name="counters")
+    play_count = models.PositiveIntegerField(_("Plays"), default=0)
+    download_count = models.PositiveIntegerField(_("Downloads"), default=0)
+
+    def __unicode__(self):
+        return "Counters of track %s" % self.track_id
+
+
+class AudioBlob(models.Model):
+    """
+    Number of tracks referencing an audio blob, see
+    ``audiotracks.contentstore``
+    """
+    name = models.CharField(max_length=255, primary_key=True)
+    reference_count = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return self.name
+
+
+class Job(models.Model):
+    """
+    Background job stored by ``audiotracks.jobs.DatabaseBackend``
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (RUNNING, _("Running")),
+        (FAILED, _("Failed")),
+    )
+
+    task = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+            default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    run_after = models.DateTimeField(default=datetime.datetime.now)
+    error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return "Job %s(%s)" % (self.task, self.key)
+
+
+def release_audio_blob(sender, instance, **kwargs):
+    name = instance.audio_file.name
+    if contentstore.is_blob(name) and contentstore.release(name):
+        # Deleted by AbstractTrack.delete once the transaction is committed
+        instance._released_blob = name
+
+
+def delete_waveform(sender, instance, **kwargs):
+    if instance.waveform:
+        instance.waveform.delete(save=False)
+
+
+post_save.connect(track_changed, sender=Track)
+post_delete.connect(track_changed, sender=Track)
+post_save.connect(schedule_feeds, sender=Track)
+post_save.connect(stats.track_saved, sender=Track)
+post_delete.connect(stats.track_deleted, sender=Track)
+post_delete.connect(schedule_feeds, sender=Track)
+post_delete.connect(release_audio_blob, sender=Track)
+post_delete.connect(delete_waveform, sender=Track)
+post_syncdb.connect(create_composite_indexes)
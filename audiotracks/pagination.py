@@ -0,0 +1,131 @@
+"""
+Keyset pagination for track listings.
+
+Instead of counting rows and using an offset, pages are delimited by the
+``(created_at, id)`` pair of their first and last tracks, encoded in opaque
+cursor tokens. The cost of fetching a page doesn't depend on how deep it is.
+"""
+import base64
+import datetime
+
+from django.core.paginator import Paginator
+from django.db.models import Q
+
+NEXT = 'n'
+PREVIOUS = 'p'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def encode_cursor(track, direction):
+    value = '%s|%s|%s' % (direction,
+                          track.created_at.strftime(DATETIME_FORMAT),
+                          track.pk)
+    return base64.urlsafe_b64encode(value.encode('ascii')).decode(
+            'ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """
+    Return a ``(direction, created_at, pk)`` tuple from a cursor token
+    """
+    try:
+        token = str(token)
+        value = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        direction, created_at, pk = value.decode('ascii').split('|')
+        if direction not in (NEXT, PREVIOUS):
+            raise ValueError(direction)
+        return (direction,
+                datetime.datetime.strptime(created_at, DATETIME_FORMAT),
+                int(pk))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(token)
+
+
+class CursorPage(object):
+    is_cursor = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator(object):
+    """
+    Paginate a track queryset from the newest to the oldest track. Unlike
+    Django's Paginator, it never counts the tracks.
+    """
+
+    def __init__(self, object_list, per_page):
+        self.object_list = object_list
+        self.per_page = int(per_page)
+
+    def page(self, cursor=None):
+        """
+        Return the page following (or preceding, depending on how the cursor
+        has been built) the cursor, or the first page if ``cursor`` is None.
+        Raise InvalidCursor if the token can't be decoded.
+        """
+        tracks = self.object_list
+        if cursor is None:
+            direction = NEXT
+        else:
+            direction, created_at, pk = decode_cursor(cursor)
+            if direction == NEXT:
+                tracks = tracks.filter(Q(created_at__lt=created_at) |
+                                       Q(created_at=created_at, pk__lt=pk))
+            else:
+                tracks = tracks.filter(Q(created_at__gt=created_at) |
+                                       Q(created_at=created_at, pk__gt=pk))
+        if direction == NEXT:
+            tracks = tracks.order_by('-created_at', '-pk')
+        else:
+            tracks = tracks.order_by('created_at', 'pk')
+
+        # Fetch one more track to find out if there is another page
+        object_list = list(tracks[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if direction == NEXT:
+            has_next, has_previous = has_more, cursor is not None
+        else:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+
+        next_cursor = previous_cursor = None
+        if object_list:
+            if has_next:
+                next_cursor = encode_cursor(object_list[-1], NEXT)
+            if has_previous:
+                previous_cursor = encode_cursor(object_list[0], PREVIOUS)
+        return CursorPage(object_list, next_cursor, previous_cursor)
+
+
+class CountedPaginator(Paginator):
+    """
+    Django Paginator given the number of objects instead of counting them,
+    for instance from the statistics of a user
+    """
+
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._count = count
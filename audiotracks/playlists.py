@@ -0,0 +1,141 @@
+"""
+M3U and XSPF playlists of track listings.
+
+Playlists are streamed: tracks are fetched a chunk at a time with keyset
+pagination and written out as they come, so that the playlist of a whole
+catalogue is never held in memory. Titles and durations come from the track
+table, audio files aren't read.
+
+Middleware accessing ``response.content`` (such as GZipMiddleware or
+CommonMiddleware with USE_ETAGS) defeats streaming.
+"""
+from xml.sax.saxutils import escape
+
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+
+from audiotracks.feeds import ITEMS_PER_FEED
+from audiotracks.models import Track
+from audiotracks.pagination import CursorPaginator, InvalidCursor
+
+CHUNK_SIZE = 500
+
+PLAYLIST_FIELDS = ('id', 'slug', 'title', 'artist', 'duration', 'audio_file',
+                   'created_at', 'user__username')
+
+CONTENT_TYPES = {
+    'm3u': 'audio/x-mpegurl',
+    'm3u8': 'audio/x-mpegurl; charset=utf-8',
+    'xspf': 'application/xspf+xml; charset=utf-8',
+}
+
+
+def iterate_tracks(tracks, chunk_size=None):
+    """
+    Iterate over the tracks of a queryset from the newest to the oldest,
+    fetching them ``chunk_size`` (default: CHUNK_SIZE) at a time
+    """
+    paginator = CursorPaginator(tracks, chunk_size or CHUNK_SIZE)
+    page = paginator.page()
+    while True:
+        for track in page.object_list:
+            yield track
+        if not page.has_next():
+            break
+        page = paginator.page(page.next_cursor)
+
+
+def get_title(track):
+    title = track.title or track.slug
+    if track.artist:
+        title = u"%s - %s" % (track.artist, title)
+    return title
+
+
+def m3u(request, tracks, encoding):
+    yield "#EXTM3U\n"
+    for track in tracks:
+        if track.duration is None:
+            duration = -1
+        else:
+            duration = int(round(track.duration))
+        # Line breaks in titles would end the directive
+        title = u" ".join(get_title(track).splitlines())
+        lines = u"#EXTINF:%d,%s\n%s\n" % (duration, title,
+                request.build_absolute_uri(track.get_audio_url()))
+        yield lines.encode(encoding, 'replace')
+
+
+def xspf(request, tracks, encoding='utf-8'):
+    yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<playlist version="1" xmlns="http://xspf.org/ns/0/">\n'
+           '<trackList>\n')
+    for track in tracks:
+        element = [u"<track>",
+                   u"<location>%s</location>" % escape(
+                       request.build_absolute_uri(track.get_audio_url())),
+                   u"<title>%s</title>" % escape(track.title or track.slug)]
+        if track.artist:
+            element.append(u"<creator>%s</creator>" % escape(track.artist))
+        if track.duration is not None:
+            element.append(u"<duration>%d</duration>" %
+                           round(track.duration * 1000))
+        element.append(u"<info>%s</info>" % escape(
+                request.build_absolute_uri(track.get_absolute_url())))
+        element.append(u"</track>\n")
+        yield u"".join(element).encode(encoding)
+    yield "</trackList>\n</playlist>\n"
+
+
+WRITERS = {
+    'm3u': (m3u, 'latin-1'),
+    'm3u8': (m3u, 'utf-8'),
+    'xspf': (xspf, 'utf-8'),
+}
+
+
+def playlist_response(request, tracks, format):
+    writer, encoding = WRITERS[format]
+    return HttpResponse(writer(request, tracks, encoding),
+                        content_type=CONTENT_TYPES[format])
+
+
+def get_tracks():
+    return Track.objects.select_related('user').only(*PLAYLIST_FIELDS)
+
+
+def index_playlist(request, format, username=None):
+    """
+    Playlist of all the tracks, or of all the tracks of ``username``
+    """
+    tracks = get_tracks()
+    if username:
+        tracks = tracks.filter(user__username=username)
+    return playlist_response(request, iterate_tracks(tracks), format)
+
+
+@login_required
+def user_index_playlist(request, format, username=None):
+    """
+    Playlist of the tracks of the current user
+    """
+    tracks = get_tracks().filter(user=request.user)
+    return playlist_response(request, iterate_tracks(tracks), format)
+
+
+def feed_playlist(request, format, username=None):
+    """
+    Playlist of the tracks of the podcast feed, paginated the same way
+    """
+    tracks = get_tracks()
+    if username:
+        tracks = tracks.filter(user=get_object_or_404(User,
+                                                      username=username))
+    paginator = CursorPaginator(tracks, ITEMS_PER_FEED)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        page = paginator.page()
+    return playlist_response(request, page.object_list, format)
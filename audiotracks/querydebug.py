@@ -0,0 +1,222 @@
+"""
+Detection of repeated queries, the signature of N+1 query problems.
+
+Add ``audiotracks.querydebug.DuplicateQueryMiddleware`` to
+``MIDDLEWARE_CLASSES`` to record the queries of each request along with the
+template and code issuing them. Queries are grouped by shape, their SQL with
+literals and lists of parameters collapsed, and shapes run at least
+``AUDIOTRACKS_DUPLICATE_QUERY_THRESHOLD`` times in a request are reported to
+the ``audiotracks.queries`` logger, or raised as DuplicateQueries if
+``AUDIOTRACKS_DUPLICATE_QUERY_ERRORS`` is True.
+
+The middleware is only active when ``AUDIOTRACKS_DETECT_DUPLICATE_QUERIES``
+is True, which defaults to the value of ``DEBUG``.
+"""
+import logging
+import os
+import re
+import sys
+
+import django
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Node, Template
+
+logger = logging.getLogger('audiotracks.queries')
+
+DJANGO_DIR = os.path.dirname(os.path.abspath(django.__file__))
+THIS_FILE = os.path.splitext(os.path.abspath(__file__))[0]
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+LIST_RE = re.compile(r'\((?:\s*(?:%s|\?)\s*,)+\s*(?:%s|\?)\s*\)')
+
+
+class DuplicateQueries(Exception):
+    pass
+
+
+def get_shape(sql):
+    """
+    Return ``sql`` with its literals replaced by placeholders and its lists of
+    placeholders collapsed, so that queries differing only by their
+    parameters have the same shape
+    """
+    sql = STRING_RE.sub('%s', sql)
+    sql = NUMBER_RE.sub('%s', sql)
+    return LIST_RE.sub('(...)', sql)
+
+
+def is_own_frame(filename):
+    filename = os.path.abspath(filename)
+    return (filename.startswith(DJANGO_DIR) or
+            os.path.splitext(filename)[0] == THIS_FILE)
+
+
+def get_location(frame):
+    """
+    Return the ``(code, template)`` locations of the stack starting at
+    ``frame``: the innermost line of code outside of Django, and the innermost
+    template tag being rendered, as ``name:line`` strings or None
+    """
+    code = template = None
+    while frame is not None and (code is None or template is None):
+        if code is None and not is_own_frame(frame.f_code.co_filename):
+            code = '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno,
+                                    frame.f_code.co_name)
+        if template is None:
+            template = get_template_location(frame.f_locals.get('self'))
+        frame = frame.f_back
+    return code, template
+
+
+def get_template_location(obj):
+    # isinstance() would evaluate lazy objects such as request.user
+    obj_type = type(obj)
+    # Nodes only know their position in the template with TEMPLATE_DEBUG
+    if issubclass(obj_type, Node) and hasattr(obj, 'source'):
+        origin, (start, end) = obj.source
+        try:
+            line = origin.reload()[:start].count('\n') + 1
+        except Exception:
+            return origin.name
+        return '%s:%d' % (origin.name, line)
+    if issubclass(obj_type, Template):
+        return obj.name
+    return None
+
+
+class RecordingCursor(object):
+
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, sql, params=()):
+        self.recorder.record(sql)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.recorder.record(sql)
+        return self.cursor.executemany(sql, param_list)
+
+
+class QueryRecorder(object):
+    """
+    Record the shape and location of the queries of all the database
+    connections of the current thread while installed
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.installed = []
+
+    def record(self, sql):
+        code, template = get_location(sys._getframe(2))
+        self.queries.append((get_shape(sql), code, template))
+
+    def install(self):
+        for connection in connections.all():
+            self.wrap(connection)
+
+    def wrap(self, connection):
+        # Connections are thread local, so only the current thread is
+        # affected. A recorder left installed by a streamed response which
+        # wasn't consumed is replaced.
+        connection.__dict__.pop('cursor', None)
+        cursor = connection.cursor
+        recording_cursor = lambda: RecordingCursor(cursor(), self)
+        recording_cursor.recorder = self
+        connection.cursor = recording_cursor
+        self.installed.append(connection)
+
+    def uninstall(self):
+        for connection in self.installed:
+            if getattr(connection.cursor, 'recorder', None) is self:
+                del connection.cursor
+        self.installed = []
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.uninstall()
+
+    def get_duplicates(self, threshold=None):
+        """
+        Return ``(shape, count, locations)`` tuples of the shapes of queries
+        run at least ``threshold`` times, locations being the set of the
+        ``(code, template)`` locations issuing them
+        """
+        if threshold is None:
+            threshold = getattr(settings,
+                                'AUDIOTRACKS_DUPLICATE_QUERY_THRESHOLD', 3)
+        shapes = {}
+        for shape, code, template in self.queries:
+            shapes.setdefault(shape, []).append((code, template))
+        return [(shape, len(locations), set(locations))
+                for shape, locations in sorted(shapes.items())
+                if len(locations) >= threshold]
+
+
+def format_duplicates(duplicates, path):
+    lines = ['Repeated queries in %s:' % path]
+    for shape, count, locations in duplicates:
+        lines.append('%d times: %s' % (count, shape))
+        for code, template in sorted(locations):
+            if template:
+                lines.append('    from template %s' % template)
+            lines.append('    from %s' % code)
+    return '\n'.join(lines)
+
+
+class DuplicateQueryMiddleware(object):
+
+    def __init__(self):
+        if not getattr(settings, 'AUDIOTRACKS_DETECT_DUPLICATE_QUERIES',
+                       settings.DEBUG):
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        request._query_recorder = QueryRecorder()
+        request._query_recorder.install()
+
+    def process_response(self, request, response):
+        recorder = getattr(request, '_query_recorder', None)
+        if recorder is None:
+            return response
+        del request._query_recorder
+        if getattr(response, '_is_string', True):
+            self.report(request, recorder)
+        else:
+            # Queries of streamed responses run while they are consumed
+            response._container = self.stream(request, response._container,
+                                              recorder)
+        return response
+
+    def stream(self, request, content, recorder):
+        try:
+            for chunk in content:
+                yield chunk
+        finally:
+            if hasattr(content, 'close'):
+                content.close()
+        self.report(request, recorder)
+
+    def report(self, request, recorder):
+        recorder.uninstall()
+        duplicates = recorder.get_duplicates()
+        if not duplicates:
+            return
+        message = format_duplicates(duplicates, request.path)
+        if getattr(settings, 'AUDIOTRACKS_DUPLICATE_QUERY_ERRORS', False):
+            raise DuplicateQueries(message)
+        logger.warning(message)
@@ -0,0 +1,195 @@
+"""
+Pre-rendered podcast feeds.
+
+When ``AUDIOTRACKS_STATIC_FEEDS`` is True, saving or deleting a track
+schedules a ``publish_feed`` job rendering the global feed and the feed of the
+owner of the track to static files of the default storage, so that the web
+server or a CDN can serve them directly. Jobs are delayed by
+``AUDIOTRACKS_STATIC_FEED_DELAY`` seconds, which collapses bursts of changes
+into a single rendering.
+
+This needs a job backend deferring jobs. With ``ImmediateBackend``, feeds
+would be rendered in the request and the transaction saving the track, so
+their files are deleted instead, and published again by the next request for
+the feed.
+
+``feeds.choose_feed`` redirects to the static files once they exist, or
+serves their content if ``AUDIOTRACKS_STATIC_FEED_REDIRECT`` is False. Only
+the first page of feeds is pre-rendered.
+
+Changes made in bulk, like imports, run in a ``batched()`` block so that each
+feed is scheduled once for the whole block rather than once per track.
+"""
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core import urlresolvers
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.http import HttpRequest, HttpResponse, HttpResponseRedirect
+
+from audiotracks import jobs
+from audiotracks.instrumentation import timer
+
+ENABLED = getattr(settings, 'AUDIOTRACKS_STATIC_FEEDS', False)
+REDIRECT = getattr(settings, 'AUDIOTRACKS_STATIC_FEED_REDIRECT', True)
+DELAY = getattr(settings, 'AUDIOTRACKS_STATIC_FEED_DELAY', 30)
+HTTPS = getattr(settings, 'AUDIOTRACKS_STATIC_FEED_HTTPS', False)
+FEED_DIR = 'audiotracks/feeds/'
+CONTENT_TYPE = 'application/rss+xml; charset=utf-8'
+
+# Feeds scheduled within the batched() block running in the current thread
+_batch = threading.local()
+
+
+def get_feed_name(username=None):
+    if username:
+        return '%susers/%s.rss' % (FEED_DIR, username)
+    return '%sall.rss' % FEED_DIR
+
+
+def schedule(username=None, delay=None):
+    """
+    Schedule the publication of the feed of ``username``, or of the global
+    feed if ``username`` is None
+    """
+    pending = getattr(_batch, 'usernames', None)
+    if pending is not None:
+        pending.add(username or '')
+        return
+    if not jobs.get_backend().deferred:
+        unpublish_feed(username)
+        return
+    if delay is None:
+        delay = DELAY
+    jobs.enqueue('publish_feed', username or '', delay)
+
+
+@contextmanager
+def batched():
+    """
+    Collect the feeds scheduled within the block and schedule each of them
+    once at its end. Nothing is scheduled if the block raises an exception.
+    """
+    if getattr(_batch, 'usernames', None) is not None:
+        yield
+        return
+    _batch.usernames = set()
+    try:
+        yield
+        usernames = _batch.usernames
+    finally:
+        _batch.usernames = None
+    for username in sorted(usernames):
+        schedule(username)
+
+
+def schedule_feeds(sender, instance, **kwargs):
+    """
+    Signal handler connected to post_save and post_delete of the Track model
+    """
+    if not ENABLED:
+        return
+    schedule()
+    if instance.user_id:
+        schedule(instance.user.username)
+
+
+class FeedRequest(HttpRequest):
+    """
+    Request for the current site, over HTTPS if
+    ``AUDIOTRACKS_STATIC_FEED_HTTPS`` is True
+    """
+
+    def __init__(self):
+        super(FeedRequest, self).__init__()
+        self.META = {'HTTP_HOST': Site.objects.get_current().domain,
+                     'SERVER_PORT': HTTPS and '443' or '80'}
+
+    def is_secure(self):
+        return HTTPS
+
+
+def render_feed(username=None):
+    """
+    Return the content of the first page of the feed of ``username``, or of
+    the global feed, as served to a request for the current site
+    """
+    from audiotracks import feeds
+    request = FeedRequest()
+    if username:
+        request.path = urlresolvers.reverse('tracks_feed', args=[username])
+        response = feeds.UserTracks()(request, username=username)
+    else:
+        request.path = urlresolvers.reverse('tracks_feed')
+        response = feeds.AllTracks()(request)
+    return response.content
+
+
+def save_file(name, content):
+    """
+    Save ``content`` under ``name`` in the default storage, replacing the
+    file atomically when the storage is on the local filesystem
+    """
+    try:
+        path = default_storage.path(name)
+    except NotImplementedError:
+        if default_storage.exists(name):
+            default_storage.delete(name)
+        default_storage.save(name, ContentFile(content))
+        return
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+    os.chmod(tmp_path, getattr(settings, 'FILE_UPLOAD_PERMISSIONS', None) or
+                       0o644)
+    os.rename(tmp_path, path)
+
+
+def unpublish_feed(username=None):
+    name = get_feed_name(username)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+
+
+def publish_feed(username=None):
+    name = get_feed_name(username)
+    if username and not User.objects.filter(username=username).exists():
+        unpublish_feed(username)
+        return
+    with timer('feeds.publish'):
+        save_file(name, render_feed(username))
+
+
+def serve_feed(username=None):
+    """
+    Return a response redirecting to or serving the static feed of
+    ``username``, or None if it hasn't been published yet, in which case its
+    publication is scheduled. Without a deferred job backend, it is
+    published by the request instead.
+    """
+    name = get_feed_name(username)
+    if not default_storage.exists(name):
+        if jobs.get_backend().deferred:
+            schedule(username, 0)
+            return None
+        publish_feed(username)
+        if not default_storage.exists(name):
+            return None
+    if REDIRECT:
+        return HttpResponseRedirect(default_storage.url(name))
+    f = default_storage.open(name)
+    try:
+        return HttpResponse(f.read(), content_type=CONTENT_TYPE)
+    finally:
+        f.close()
@@ -0,0 +1,196 @@
+"""
+Per-user track statistics.
+
+Each user with tracks has a ``TrackStats`` row holding their number of tracks,
+the total size and duration of their audio files, the creation time of their
+latest track and the time of the last change to their tracks, which every
+save or delete of one of their tracks updates. Pages don't need to aggregate
+tracks to display them, and ``user_index`` doesn't need to count tracks to
+paginate them.
+
+Rows are adjusted by the difference each save or delete of a track makes, in
+the same transaction. Missing rows are computed from the tracks when first
+needed, and the ``audiotracks_stats`` management command recomputes all of
+them, fixing the drift left by updates bypassing ``Track.save``.
+"""
+import datetime
+
+from django.db import transaction, IntegrityError
+from django.db.models import Count, F, Max, Sum
+
+# Fields of a track the statistics of its user depend on
+STATS_FIELDS = ('user_id', 'audio_size', 'duration', 'created_at')
+
+
+def get_snapshot(track):
+    """
+    Return the values of the fields of ``track`` the statistics depend on,
+    or None if some are deferred and haven't been loaded
+    """
+    try:
+        return tuple([track.__dict__[name] for name in STATS_FIELDS])
+    except KeyError:
+        return None
+
+
+def compute(user_id):
+    """
+    Return the statistics of a user computed from their tracks
+    """
+    from audiotracks.models import Track
+    return Track.objects.filter(user=user_id).aggregate(
+            track_count=Count('id'), total_size=Sum('audio_size'),
+            total_duration=Sum('duration'),
+            latest_created_at=Max('created_at'))
+
+
+def reconcile(user_id):
+    """
+    Recompute the statistics of a user from their tracks. Return True if
+    they differed from the stored ones.
+    """
+    from audiotracks.models import TrackStats
+    values = compute(user_id)
+    values['total_size'] = values['total_size'] or 0
+    values['total_duration'] = values['total_duration'] or 0
+    stored = TrackStats.objects.filter(user=user_id).values(*values.keys())
+    if stored and stored[0] == values:
+        return False
+    if not stored and not values['track_count']:
+        # Users without tracks don't need a row, and may have been deleted
+        return False
+    values['updated_at'] = datetime.datetime.now()
+    if not TrackStats.objects.filter(user=user_id).update(**values):
+        sid = transaction.savepoint()
+        try:
+            TrackStats.objects.create(user_id=user_id, **values)
+        except IntegrityError:
+            # Created by a concurrent save, which included this one
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+    return True
+
+
+def reconcile_all():
+    """
+    Recompute the statistics of all the users with tracks or statistics.
+    Return the ids of the users whose statistics were wrong.
+    """
+    from audiotracks.models import Track, TrackStats
+    user_ids = set(Track.objects.filter(user__isnull=False).values_list(
+            'user', flat=True).distinct())
+    user_ids.update(TrackStats.objects.values_list('user', flat=True))
+    return [user_id for user_id in sorted(user_ids) if reconcile(user_id)]
+
+
+def adjust(user_id, count=0, size=0, duration=0, created_at=None):
+    """
+    Add to the statistics of a user. ``created_at`` is the creation time of
+    an added track, which may be the latest one.
+    """
+    from audiotracks.models import TrackStats
+    updated = TrackStats.objects.filter(user=user_id).update(
+            track_count=F('track_count') + count,
+            total_size=F('total_size') + size,
+            total_duration=F('total_duration') + duration,
+            updated_at=datetime.datetime.now())
+    if not updated:
+        # The tracks already include the change
+        reconcile(user_id)
+    elif created_at is not None:
+        TrackStats.objects.filter(user=user_id).exclude(
+                latest_created_at__gte=created_at).update(
+                latest_created_at=created_at)
+
+
+def track_saved(sender, instance, created, **kwargs):
+    """
+    Handler of the post_save signal of the Track model
+    """
+    previous = instance._original_stats
+    current = get_snapshot(instance)
+    instance._original_stats = current
+    if current is None or (previous is None and not created):
+        # Some fields weren't loaded, the difference isn't known
+        for user_id in set([instance.user_id, previous and previous[0]]):
+            if user_id:
+                reconcile(user_id)
+                touch(user_id)
+        return
+    user_id, size, duration, created_at = current
+    if created:
+        if user_id:
+            adjust(user_id, 1, size or 0, duration or 0, created_at)
+        return
+    if previous == current:
+        # Other fields changed, the time of the last change is still needed
+        if user_id:
+            touch(user_id)
+        return
+    previous_user_id, previous_size, previous_duration = previous[:3]
+    if previous_user_id != user_id:
+        if previous_user_id:
+            track_removed(previous_user_id, previous_size or 0,
+                          previous_duration or 0)
+        if user_id:
+            adjust(user_id, 1, size or 0, duration or 0, created_at)
+    elif user_id:
+        adjust(user_id, 0, (size or 0) - (previous_size or 0),
+               (duration or 0) - (previous_duration or 0))
+
+
+def touch(user_id):
+    """
+    Record a change to the tracks of a user which leaves their statistics
+    alone
+    """
+    from audiotracks.models import TrackStats
+    TrackStats.objects.filter(user=user_id).update(
+            updated_at=datetime.datetime.now())
+
+
+def track_removed(user_id, size, duration):
+    from audiotracks.models import TrackStats
+    if not TrackStats.objects.filter(user=user_id).update(
+            track_count=F('track_count') - 1,
+            total_size=F('total_size') - size,
+            total_duration=F('total_duration') - duration,
+            latest_created_at=compute_latest(user_id),
+            updated_at=datetime.datetime.now()):
+        reconcile(user_id)
+
+
+def compute_latest(user_id):
+    from audiotracks.models import Track
+    return Track.objects.filter(user=user_id).aggregate(
+            latest=Max('created_at'))['latest']
+
+
+def track_deleted(sender, instance, **kwargs):
+    """
+    Handler of the post_delete signal of the Track model
+    """
+    snapshot = instance._original_stats
+    if snapshot is None or not snapshot[0]:
+        if instance.user_id:
+            reconcile(instance.user_id)
+        return
+    user_id, size, duration = snapshot[:3]
+    track_removed(user_id, size or 0, duration or 0)
+
+
+def get_stats(user):
+    """
+    Return the statistics of ``user``, a User or a user id, computing them
+    if they haven't been stored yet. The statistics of users without tracks
+    aren't stored.
+    """
+    from audiotracks.models import TrackStats
+    user_id = getattr(user, 'pk', user)
+    try:
+        return TrackStats.objects.get(user=user_id)
+    except TrackStats.DoesNotExist:
+        if reconcile(user_id):
+            return TrackStats.objects.get(user=user_id)
+        return TrackStats(user_id=user_id, updated_at=None)
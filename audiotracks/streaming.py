@@ -0,0 +1,164 @@
+"""
+Serve audio files from a view, with support for range requests so that
+players can seek, and optional offloading to the front web server.
+"""
+import os
+import re
+from calendar import timegm
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date, parse_etags, quote_etag
+
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# None, 'xsendfile' (Apache mod_xsendfile, lighttpd) or 'xaccel' (nginx)
+SENDFILE = getattr(settings, 'AUDIOTRACKS_SENDFILE', None)
+# Location of MEDIA_ROOT in the nginx configuration when using X-Accel-Redirect
+ACCEL_REDIRECT_PREFIX = getattr(settings,
+        'AUDIOTRACKS_ACCEL_REDIRECT_PREFIX', '/protected/')
+
+
+class UnsatisfiableRange(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Return the ``(start, end)`` byte positions (inclusive) requested by a
+    Range header, or None if the whole file should be served. Only single
+    byte ranges are supported, other requests get the whole file. Raise
+    UnsatisfiableRange if the range is outside of the file.
+    """
+    match = RANGE_RE.match(header.replace(' ', ''))
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if not length:
+            raise UnsatisfiableRange()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise UnsatisfiableRange()
+    return start, min(end, size - 1)
+
+
+def file_iterator(fieldfile, start, length, chunk_size=CHUNK_SIZE):
+    """
+    Read ``length`` bytes of a stored file from ``start``, chunk by chunk
+    """
+    fieldfile.open('rb')
+    try:
+        try:
+            fieldfile.seek(start)
+        except (AttributeError, IOError):
+            # Not seekable, skip the first bytes
+            remaining = start
+            while remaining:
+                remaining -= len(fieldfile.read(min(chunk_size, remaining)))
+        while length > 0:
+            data = fieldfile.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fieldfile.close()
+
+
+def get_etag(fieldfile, size, version=None, last_modified=None):
+    """
+    Return the ETag of the stored file ``fieldfile``. Files may be rewritten
+    in place with the same name and size, so the ETag also depends on
+    ``version``, such as a hash of the content, or else on ``last_modified``.
+    The storage isn't accessed, as players send many range requests.
+    """
+    parts = [fieldfile.name, unicode(size)]
+    if version:
+        parts.append(unicode(version))
+    elif last_modified is not None:
+        parts.append(last_modified.isoformat())
+    return md5_constructor(u':'.join(parts).encode('utf-8')).hexdigest()
+
+
+def serve_file(request, fieldfile, size, content_type, last_modified=None,
+               attachment=False, version=None):
+    """
+    Return a response serving the stored file ``fieldfile`` of ``size``
+    bytes, honouring Range, If-Range and If-None-Match request headers.
+    ``version`` identifies the content of the file, if known.
+    """
+    etag = get_etag(fieldfile, size, version, last_modified)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        return HttpResponseNotModified()
+
+    path = None
+    if SENDFILE == 'xsendfile':
+        try:
+            path = fieldfile.path
+        except NotImplementedError:
+            # The file isn't on the local filesystem, stream it instead
+            pass
+    if SENDFILE == 'xaccel' or path is not None:
+        # The front server reads the file and handles range requests
+        response = HttpResponse('', content_type=content_type)
+        if path is None:
+            response['X-Accel-Redirect'] = ACCEL_REDIRECT_PREFIX + \
+                    fieldfile.name.encode('utf-8')
+        else:
+            response['X-Sendfile'] = path.encode('utf-8')
+    else:
+        byte_range = None
+        range_header = request.META.get('HTTP_RANGE')
+        if range_header and range_valid(request, etag, last_modified):
+            try:
+                byte_range = parse_range(range_header, size)
+            except UnsatisfiableRange:
+                response = HttpResponse('', status=416)
+                response['Content-Range'] = 'bytes */%s' % size
+                return response
+        if byte_range is None:
+            start, length, status = 0, size, 200
+        else:
+            start, end = byte_range
+            length, status = end - start + 1, 206
+        if request.method == 'HEAD':
+            content = ''
+        else:
+            content = file_iterator(fieldfile, start, length)
+        response = HttpResponse(content, content_type=content_type,
+                                status=status)
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response['Content-Range'] = 'bytes %s-%s/%s' % (start, end, size)
+
+    response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(
+                timegm(last_modified.utctimetuple()))
+    if attachment:
+        response['Content-Disposition'] = 'attachment; filename="%s"' % \
+                os.path.basename(fieldfile.name).encode('utf-8')
+    return response
+
+
+def range_valid(request, etag, last_modified):
+    """
+    Whether the Range header should be honoured given the If-Range header
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return quote_etag(etag) == if_range
+    return last_modified is not None and \
+            http_date(timegm(last_modified.utctimetuple())) == if_range
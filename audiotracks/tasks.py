@@ -0,0 +1,165 @@
+"""
+Tasks run in the background by the job backend, see ``audiotracks.jobs``
+"""
+import datetime
+
+from django.core.files.base import ContentFile
+from django.db import transaction, IntegrityError
+from django.db.models import Q
+
+from audiotracks import staticfeeds, stats, waveform
+from audiotracks.caching import forget_track, track_changed
+from audiotracks.jobs import task, Retry
+from audiotracks.metadata import local_copy, METADATA_FIELDS
+from audiotracks.models import (Track, managed_transaction, slugify_uniquely,
+        METADATA_READY, METADATA_FAILED)
+
+
+# Fields filled in from the audio file itself, which users can't edit
+AUDIO_INFO_FIELDS = ('audio_size', 'audio_mimetype', 'duration', 'bitrate',
+                     'sample_rate')
+
+
+def track_updated(track, previous_slug=None):
+    """
+    Invalidate what depends on a track changed with ``update()``, which
+    doesn't send the post_save signal
+    """
+    track._original_slug = previous_slug or track.slug
+    if track.user_id:
+        stats.touch(track.user_id)
+    track_changed(Track, track)
+    staticfeeds.schedule_feeds(Track, track)
+
+
+def save_extracted_image(track, had_image):
+    """
+    Attach the cover art extracted into ``track.image`` unless the user has
+    set an image in the meantime. Return whether it was attached.
+    """
+    if had_image or not track.image:
+        return False
+    if Track.objects.filter(Q(image='') | Q(image__isnull=True),
+                            id=track.id).update(image=track.image.name,
+                            updated_at=datetime.datetime.now()):
+        return True
+    track.image.delete(save=False)
+    return False
+
+
+@task('extract_metadata')
+def extract_metadata(track_id):
+    """
+    Fill in the tags, audio information and cover art of a track uploaded
+    with a pending metadata status. Only fields which are still empty are
+    written, as the user may have edited the track while the file was read.
+    """
+    try:
+        track = Track.objects.select_related('user').get(id=track_id)
+    except Track.DoesNotExist:
+        # The upload may not have been committed yet
+        raise Retry("Track %s doesn't exist" % track_id)
+    original = dict((field, getattr(track, field))
+                    for field in METADATA_FIELDS + AUDIO_INFO_FIELDS)
+    had_image = bool(track.image)
+    tracks = Track.objects.filter(id=track.id)
+    try:
+        with local_copy(track.audio_file) as path:
+            track.fill_from_audio_file(path, overwrite=False)
+    except Exception:
+        tracks.update(metadata_status=METADATA_FAILED)
+        raise
+    now = datetime.datetime.now()
+    values = dict((field, getattr(track, field))
+                  for field in AUDIO_INFO_FIELDS)
+    # The audio file may have been replaced in the meantime, along with its
+    # information
+    if tracks.filter(audio_file=track.audio_file.name).update(
+            metadata_status=METADATA_READY, updated_at=now, **values):
+        if track.user_id:
+            stats.adjust(track.user_id, 0,
+                    (track.audio_size or 0) - (original['audio_size'] or 0),
+                    (track.duration or 0) - (original['duration'] or 0))
+    else:
+        tracks.update(metadata_status=METADATA_READY)
+    filled = []
+    for field in METADATA_FIELDS:
+        value = getattr(track, field)
+        if value and not original[field] and tracks.filter(
+                Q(**{field: ''}) | Q(**{'%s__isnull' % field: True})
+                ).update(updated_at=now, **{field: value}):
+            filled.append(field)
+    save_extracted_image(track, had_image)
+
+    # The slug was made from the file name, make it from the title unless
+    # the user has changed it
+    previous_slug = track.slug
+    if 'title' in filled:
+        slug = slugify_uniquely(track.title, track)
+        with managed_transaction():
+            sid = transaction.savepoint()
+            try:
+                tracks.filter(slug=previous_slug).update(slug=slug)
+            except IntegrityError:
+                # Another upload took the slug since it was picked
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.savepoint_commit(sid)
+    try:
+        track = Track.objects.select_related('user').get(id=track.id)
+    except Track.DoesNotExist:
+        return
+    track_updated(track, previous_slug)
+
+
+@task('extract_cover_art')
+def extract_cover_art(track_id):
+    try:
+        track = Track.objects.select_related('user').get(id=track_id)
+    except Track.DoesNotExist:
+        return
+    if track.image:
+        return
+    with local_copy(track.audio_file) as path:
+        track.extract_cover_art(path)
+    if save_extracted_image(track, False):
+        track_updated(track)
+
+
+@task('write_tags')
+def write_tags(track_id):
+    try:
+        track = Track.objects.get(id=track_id)
+    except Track.DoesNotExist:
+        return
+    if not track.write_tags():
+        return
+    try:
+        track = Track.objects.select_related('user').get(id=track.id)
+    except Track.DoesNotExist:
+        return
+    track_updated(track)
+
+
+@task('compute_waveform')
+def compute_waveform(track_id):
+    try:
+        track = Track.objects.get(id=track_id)
+    except Track.DoesNotExist:
+        return
+    with local_copy(track.audio_file) as path:
+        data = waveform.compute_waveform(path)
+    if data is None:
+        return
+    if track.waveform:
+        track.waveform.delete(save=False)
+    track.waveform.save('%s.peaks' % track.id, ContentFile(data), save=False)
+    # Leave the other fields, which may have been edited in the meantime, and
+    # the modification time alone
+    Track.objects.filter(id=track.id).update(waveform=track.waveform.name)
+    forget_track(track.user.username, track.slug)
+
+
+@task('publish_feed')
+def publish_feed(username):
+    staticfeeds.publish_feed(username or None)
@@ -1,14 +1,40 @@
+import datetime
 import os
+import hashlib
+import re
 from os.path import dirname, abspath
 import shutil
+import socket
+import StringIO
+import struct
+import tempfile
+import threading
+import time
 
 from django.conf import settings
-from django.contrib.auth.models import User
+from django.contrib import messages
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import StopUpload
+from django.core.management import call_command
+from django.db import connection, IntegrityError
+from django.db.models.fields.files import FieldFile
+from django.template import Context, Template
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
+from django.utils import simplejson, unittest
 import mutagen
+from mutagen.id3 import ID3, APIC
+from PIL import Image
 
-from audiotracks.models import Track
+from audiotracks import (caching, contentstore, counters, feeds, indexes,
+        instrumentation, jobs, models, playlists, querydebug, staticfeeds,
+        stats, streaming, thumbs, uploadhandler, views, waveform)
+from audiotracks.metadata import METADATA_FIELDS
+from audiotracks.models import AudioBlob, Track, slugify_uniquely
 
 TEST_DATA_DIR = os.path.join(dirname(dirname(abspath(__file__))),
                              'tests', 'data')
@@ -19,12 +45,17 @@ class TestViews(TestCase):
     urls = 'urls'
 
     def setUp(self):
+        cache.clear()
         User.objects.create_user("bob", "bob@example.com", "secret")
         User.objects.create_user("alice", "alice@example.com", "secret")
         self.client = Client()
         response = self.client.login(username='bob', password='secret')
 
     def tearDown(self):
+        jobs._backend = None
+        if counters._timer is not None:
+            counters._timer.cancel()
+            counters._timer = None
         if os.path.exists(settings.MEDIA_ROOT):
             shutil.rmtree(settings.MEDIA_ROOT)
 
@@ -55,6 +86,15 @@ class TestViews(TestCase):
         self.assertEquals(track.slug, "django-audiotracks-test-file")
         return track
 
+    def count_queries(self, url):
+        # connection.queries is reset when the request starts
+        connection.use_debug_cursor = True
+        try:
+            self.client.get(url)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+
     def do_edit(self, track, **params):
         default_params = {
             'title': 'New Title',
@@ -144,6 +184,10 @@ class TestViews(TestCase):
         # Check that the file has been replaced
         track = Track.objects.get(id=track_id)
         self.assert_(track.audio_file.path.endswith('.ogg'))
+        self.assertEquals(track.audio_mimetype, "audio/ogg")
+        # Tags have been written into the new file
+        self.assertEquals(track.audio_size,
+                os.path.getsize(track.audio_file.path))
 
     def test_delete_image(self):
         "Attach and remove track image"
@@ -251,3 +295,1164 @@ class TestViews(TestCase):
         _, existing_alice_track, new_alice_track = Track.objects.all()
         self.assertEquals(new_alice_track.slug,
                           'django-audiotracks-test-file-2')
+
+    def test_feed_conditional_get(self):
+        "Feed answers with 304 Not Modified when nothing changed"
+        self.do_upload('ogg')
+        resp = self.client.get('/music/feed')
+        self.assertEquals(resp.status_code, 200)
+        assert 'django-audiotracks test file' in resp.content
+        assert resp.has_header('Last-Modified')
+        etag = resp['ETag']
+        resp = self.client.get('/music/feed', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 304)
+        resp = self.client.get('/bob/music/feed', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 200)
+        # Feeds contain absolute URLs, so they are cached for each host
+        resp = self.client.get('/music/feed', HTTP_HOST='example.org')
+        assert 'http://example.org/' in resp.content
+        assert 'http://testserver/' not in resp.content
+
+    def test_feed_cache_invalidation(self):
+        "Cached feeds are dropped when a track is saved or deleted"
+        self.do_upload('ogg')
+        resp = self.client.get('/bob/music/feed')
+        etag = resp['ETag']
+        track = Track.objects.get(genre="Test Data")
+        track.title = "Changed Title"
+        track.save()
+        resp = self.client.get('/bob/music/feed', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 200)
+        assert 'Changed Title' in resp.content
+        etag = resp['ETag']
+        track.delete()
+        resp = self.client.get('/bob/music/feed', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 200)
+        assert 'Changed Title' not in resp.content
+
+    def test_audio_info(self):
+        "Size, MIME type, duration and bitrate are stored at upload time"
+        for ext, mimetype in (('ogg', 'audio/ogg'), ('wav', 'audio/x-wav')):
+            self.do_upload(ext)
+            track = Track.objects.latest('id')
+            self.assertEquals(track.audio_mimetype, mimetype)
+            self.assertEquals(track.audio_size, os.path.getsize(
+                os.path.join(TEST_DATA_DIR, 'audio_file.' + ext)))
+            self.assert_(track.duration > 0)
+            self.assert_(track.bitrate > 0)
+
+    def test_backfill_audio_info(self):
+        "The backfill command fills in missing audio information"
+        self.do_upload('mp3')
+        track = Track.objects.get(genre="Test Data")
+        Track.objects.update(audio_size=None, audio_mimetype=None,
+                duration=None, bitrate=None, sample_rate=None)
+        call_command('audiotracks_backfill', verbosity=0)
+        backfilled = Track.objects.get(id=track.id)
+        self.assertEquals(backfilled.audio_size, track.audio_size)
+        self.assertEquals(backfilled.sample_rate, track.sample_rate)
+        self.assert_(backfilled.sample_rate)
+        self.assertEquals(backfilled.audio_mimetype, "audio/mpeg")
+        self.assertEquals(backfilled.duration, track.duration)
+        self.assertEquals(backfilled.updated_at, track.updated_at)
+
+    def test_listing_queries(self):
+        "Listings and feeds don't issue one query per track"
+        users = User.objects.order_by('username')
+        Track.objects.create(user=users[1], title="Track 0",
+                audio_file="audio_file.ogg", audio_size=1000)
+        urls = ('/music', '/bob/music/tracks', '/music/feed',
+                '/bob/music/feed')
+        for url in urls:
+            # Warm up module level caches such as the one of the Site model
+            self.client.get(url)
+        cache.clear()
+        counts = [self.count_queries(url) for url in urls]
+        for n in range(1, 5):
+            Track.objects.create(user=users[n % 2], title="Track %s" % n,
+                    audio_file="audio_file.ogg", audio_size=1000)
+        cache.clear()
+        self.assertEquals([self.count_queries(url) for url in urls], counts)
+
+    # Maximum number of queries issued by views and feeds with cold caches,
+    # whatever the number of tracks they list. Requests of logged in users
+    # include the session and user lookups.
+    QUERY_BUDGETS = (
+        ('/music', 5),
+        ('/bob/music/tracks', 5),
+        ('/bob/music/track/track-1', 5),
+        ('/music/edit/1', 4),
+        ('/music/confirm_delete/1', 4),
+        ('/music/upload', 3),
+        ('/music/feed', 3),
+        ('/bob/music/feed', 4),
+        ('/music/feed/archive/0', 2),
+        ('/bob/music/feed/archive/0', 3),
+        ('/music.m3u', 1),
+        ('/bob/music/tracks.xspf', 3),
+        ('/bob/music/feed.m3u8', 2),
+    )
+
+    def count_request_queries(self, url):
+        "Number of queries of a request with cold caches, content included"
+        cache.clear()
+        connection.use_debug_cursor = True
+        try:
+            resp = self.client.get(url)
+            self.assertEquals(resp.status_code, 200, url)
+            # Streamed responses run queries while they are consumed
+            resp.content
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+
+    def test_query_budgets(self):
+        "Views and feeds stay within a query budget independent of page size"
+        for username in ('bob', 'alice'):
+            self.create_tracks(12, username)
+        Track.objects.filter(id=1).update(slug='track-1')
+        for url, budget in self.QUERY_BUDGETS:
+            # Warm up module level caches such as the one of the Site model
+            self.client.get(url).content
+        counts = {}
+        items_per_feed = feeds.ITEMS_PER_FEED
+        try:
+            for page_size in (1, 10):
+                settings.AUDIOTRACKS_PER_PAGE = page_size
+                feeds.ITEMS_PER_FEED = playlists.ITEMS_PER_FEED = page_size
+                for url, budget in self.QUERY_BUDGETS:
+                    counts.setdefault(url, []).append(
+                            self.count_request_queries(url))
+        finally:
+            settings.AUDIOTRACKS_PER_PAGE = 3
+            feeds.ITEMS_PER_FEED = playlists.ITEMS_PER_FEED = items_per_feed
+        for url, budget in self.QUERY_BUDGETS:
+            small, large = counts[url]
+            self.assertEquals(small, large, "%s issues %d queries with one "
+                    "track per page and %d with ten" % (url, small, large))
+            self.assert_(large <= budget, "%s issues %d queries, its budget "
+                         "is %d" % (url, large, budget))
+
+        # Looking up the user of each track is reported with the template
+        template = Template('{% for track in tracks %}{{ track.user }}'
+                            '{% endfor %}', name='listing.html')
+        with querydebug.QueryRecorder() as recorder:
+            template.render(Context({'tracks': Track.objects.all()}))
+        [(shape, count, locations)] = recorder.get_duplicates()
+        self.assertEquals(count, 24)
+        assert shape.startswith('SELECT "auth_user"."id"')
+        [(code, template_name)] = locations
+        assert code.startswith(__file__.rstrip('c'))
+        self.assertEquals(template_name, 'listing.html')
+        assert 'from template listing.html' in querydebug.format_duplicates(
+                recorder.get_duplicates(), '/music')
+
+    def create_tracks(self, count, username='bob'):
+        user = User.objects.get(username=username)
+        for n in range(1, count + 1):
+            Track.objects.create(user=user, title="Track %s" % n,
+                    audio_file="audio_file.ogg", audio_size=1000)
+
+    def test_cursor_pagination(self):
+        "Cursor pagination of listings"
+        self.create_tracks(7)
+        settings.AUDIOTRACKS_PAGINATION = 'cursor'
+        try:
+            resp = self.client.get('/music')
+            self.assertEquals([t.title for t in resp.context['tracks']],
+                    ['Track 7', 'Track 6', 'Track 5'])
+            page = resp.context['page']
+            self.assertFalse(page.has_previous())
+            assert '?cursor=%s' % page.next_cursor in resp.content
+
+            resp = self.client.get('/music', {'cursor': page.next_cursor})
+            resp = self.client.get('/music',
+                    {'cursor': resp.context['page'].next_cursor})
+            self.assertEquals([t.title for t in resp.context['tracks']],
+                    ['Track 1'])
+            page = resp.context['page']
+            self.assertFalse(page.has_next())
+
+            resp = self.client.get('/bob/music/tracks',
+                    {'cursor': page.previous_cursor})
+            self.assertEquals([t.title for t in resp.context['tracks']],
+                    ['Track 4', 'Track 3', 'Track 2'])
+            self.assert_(resp.context['page'].has_previous())
+
+            resp = self.client.get('/music', {'cursor': 'garbage'})
+            self.assertEquals(resp.context['tracks'][0].title, 'Track 7')
+        finally:
+            del settings.AUDIOTRACKS_PAGINATION
+
+    def test_feed_next_page(self):
+        "Feeds link to a page of older items"
+        self.create_tracks(12)
+        resp = self.client.get('/bob/music/feed')
+        assert 'Track 12' in resp.content
+        assert '"Track 2"' not in resp.content
+        next_url = re.search(r'href="http://testserver([^"]+)" rel="next"',
+                resp.content).group(1)
+        resp = self.client.get(next_url)
+        assert '"Track 2"' in resp.content
+        assert '"Track 3"' not in resp.content
+        assert 'rel="next"' not in resp.content
+
+    def test_feed_archive(self):
+        "Full pages of older items are served as RFC 5005 archives"
+        self.create_tracks(25)
+        resp = self.client.get('/bob/music/feed')
+        archive_url = re.search(
+                r'href="http://testserver([^"]+)" rel="prev-archive"',
+                resp.content).group(1)
+        self.assertEquals(archive_url, '/bob/music/feed/archive/1')
+        resp = self.client.get(archive_url)
+        content = resp.content
+        assert '<fh:archive' in content
+        assert '"Track 20"' in content and '"Track 11"' in content
+        assert '"Track 21"' not in content and '"Track 10"' not in content
+        assert 'rel="current"' in content
+        assert '/bob/music/feed/archive/0" rel="prev-archive"' in content
+        assert 'rel="next-archive"' not in content
+        self.assertEquals(self.client.get('/bob/music/feed/archive/2'
+                                          ).status_code, 404)
+        etag = self.client.get('/music/feed/archive/0')['ETag']
+        self.assertEquals(self.client.get('/music/feed/archive/0',
+                HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # The global number of tracks is counted once per change
+        self.assertNumQueries(0, caching.get_track_count)
+        self.assertEquals(caching.get_track_count(), 25)
+
+        # New tracks don't change full pages, edits do
+        self.create_tracks(1)
+        self.assertEquals(caching.get_track_count(), 26)
+        self.assertEquals(self.count_queries(archive_url), 0)
+        Track.objects.filter(title="Track 15").update(title="Edited")
+        Track.objects.get(title="Edited").save()
+        resp = self.client.get(archive_url)
+        assert '"Edited"' in resp.content
+
+    def test_static_feeds(self):
+        "Feeds are published to static files when tracks change"
+        staticfeeds.ENABLED = True
+        try:
+            # Without a deferred job backend, feeds are published by the
+            # next request rather than when tracks are saved
+            self.create_tracks(2)
+            name = staticfeeds.get_feed_name('bob')
+            self.assertFalse(default_storage.exists(name))
+            resp = self.client.get('/bob/music/feed')
+            self.assertEquals(resp.status_code, 302)
+            assert resp['Location'].endswith(name)
+            assert '"Track 2"' in default_storage.open(name).read()
+            assert 'http://example.com/' in default_storage.open(name).read()
+            global_name = staticfeeds.get_feed_name()
+            self.assertFalse(default_storage.exists(global_name))
+            self.client.get('/music/feed')
+            self.create_tracks(1, username='alice')
+            self.assertFalse(default_storage.exists(global_name))
+            self.assert_(default_storage.exists(name))
+            staticfeeds.HTTPS = True
+            staticfeeds.publish_feed()
+            content = default_storage.open(global_name).read()
+            assert 'https://example.com/' in content
+            assert 'http://example.com' not in content
+            staticfeeds.REDIRECT = False
+            resp = self.client.get('/bob/music/feed')
+            self.assertEquals(resp.content, default_storage.open(name).read())
+            self.assertEquals(self.client.get('/bob/music/feed',
+                    {'cursor': 'garbage'}).status_code, 200)
+
+            # Bursts of changes are published once
+            jobs._backend = jobs.DatabaseBackend()
+            self.create_tracks(3)
+            self.assertEquals(models.Job.objects.filter(task='publish_feed'
+                                                        ).count(), 2)
+            assert '"Track 3"' not in default_storage.open(name).read()
+            models.Job.objects.update(run_after=datetime.datetime.now())
+            call_command('audiotracks_worker', once=True)
+            assert '"Track 3"' in default_storage.open(name).read()
+        finally:
+            staticfeeds.ENABLED = False
+            staticfeeds.REDIRECT = True
+            staticfeeds.HTTPS = False
+
+    def test_track_stats(self):
+        "Track statistics of users are updated along with their tracks"
+        self.create_tracks(3)
+        bob = User.objects.get(username='bob')
+        bob_stats = stats.get_stats(bob)
+        self.assertEquals((bob_stats.track_count, bob_stats.total_size),
+                          (3, 3000))
+        track = Track.objects.get(title="Track 3")
+        self.assertEquals(bob_stats.latest_created_at, track.created_at)
+        track.duration = 10.5
+        track.audio_size = 500
+        track.save()
+        track.save()
+        bob_stats = stats.get_stats(bob)
+        self.assertEquals((bob_stats.total_size, bob_stats.total_duration),
+                          (2500, 10.5))
+        track.delete()
+        bob_stats = stats.get_stats(bob)
+        self.assertEquals((bob_stats.track_count, bob_stats.total_size,
+                           bob_stats.total_duration), (2, 2000, 0))
+        self.assertEquals(bob_stats.latest_created_at,
+                          Track.objects.get(title="Track 2").created_at)
+        self.assertEquals(stats.get_stats(
+                User.objects.get(username='alice')).track_count, 0)
+        self.assertEquals(models.TrackStats.objects.count(), 1)
+
+        # Edits which leave the statistics alone still change the time of
+        # the last change, from which scope stamps are recovered
+        stamp = caching.get_scope_stamp('bob')
+        track = Track.objects.get(title="Track 2")
+        track.title = "Renamed"
+        track.save()
+        cache.clear()
+        self.assert_(caching.get_scope_stamp('bob') > stamp)
+
+        # The listing of the user is paginated without counting tracks
+        connection.use_debug_cursor = True
+        try:
+            resp = self.client.get('/bob/music/tracks')
+            assert not [query for query in connection.queries
+                        if 'COUNT(' in query['sql']]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertContains(resp, '2 tracks')
+
+        # Updates bypassing save() are fixed by the reconcile command
+        Track.objects.update(audio_size=5)
+        self.assertEquals(stats.get_stats(bob).total_size, 2000)
+        call_command('audiotracks_stats', verbosity=0)
+        self.assertEquals(stats.get_stats(bob).total_size, 10)
+        self.assertEquals(stats.reconcile_all(), [])
+
+    def test_counters(self):
+        "Plays and downloads are counted in a buffer flushed in batches"
+        self.create_tracks(2)
+        track, other_track = Track.objects.order_by('id')
+        url = '/bob/music/audio/%s' % track.slug
+        counters._buffer = counters.MemoryBuffer()
+        try:
+            self.client.get(url)
+            self.client.get(url, HTTP_RANGE='bytes=0-')
+            self.client.get(url, HTTP_RANGE='bytes=100-')
+            self.client.get(url + '?download')
+            self.client.get('/bob/music/audio/%s' % other_track.slug)
+            # The first hit started the timer flushing the buffer
+            timer = counters._timer
+            self.assert_(timer.isAlive())
+            self.client.get(url)
+            self.assert_(counters._timer is timer)
+            timer.cancel()
+            counters._timer = None
+            # Buffered increments are added to the stored counts, which are
+            # cached until the next flush
+            self.assertEquals(counters.get_counts(track),
+                              {'play_count': 3, 'download_count': 1})
+            self.assertNumQueries(0, counters.get_counts, track)
+            resp = self.client.get('/bob/music/track/%s' % track.slug)
+            assert '3 plays, 1 downloads' in resp.content
+            # Counters are created by the first flush, then updated
+            self.assertEquals(counters.flush(), 2)
+            self.assertEquals(counters.get_counts(track),
+                              {'play_count': 3, 'download_count': 1})
+            self.assertNumQueries(0, counters.flush)
+            self.client.get(url)
+            self.client.get('/bob/music/audio/%s' % other_track.slug)
+            self.assertNumQueries(2, counters.flush)
+
+            # Saving a track loaded before a flush doesn't lose counts
+            track = Track.objects.get(id=track.id)
+            self.client.get(url)
+            counters.flush()
+            track.save()
+            self.assertEquals(counters.get_counts(track)['play_count'], 5)
+
+            # Increments may be buffered in the cache
+            counters._buffer = counters.CacheBuffer()
+            self.client.get(url)
+            self.client.get(url)
+            self.assertEquals(counters.get_counts(track)['play_count'], 7)
+            self.assertEquals(counters.flush(), 1)
+            self.assertEquals(counters.get_counts(track)['play_count'], 7)
+            self.assertEquals(counters.flush(), 0)
+        finally:
+            counters._buffer = None
+
+    def test_instrumentation(self):
+        "Stages of uploads are timed and sent to the metrics sinks"
+        self.assertEquals(instrumentation.get_sinks(), [])
+        self.assert_(instrumentation.timer('upload.save') is
+                     instrumentation.NULL_TIMER)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.settimeout(5)
+        memory = instrumentation.MemorySink()
+        instrumentation._sinks = [memory, instrumentation.StatsdSink(
+                '127.0.0.1', listener.getsockname()[1], 'test.')]
+        try:
+            self.do_upload('ogg')
+            metrics = memory.snapshot()
+            for name in ('upload.receive', 'metadata.read', 'track.slugify',
+                         'upload.save'):
+                self.assert_(metrics['timings'][name]['count'] >= 1, name)
+            self.assertEquals(metrics['counters'], {'upload.accepted': 1})
+            self.assertEquals(sum(metrics['timings']['upload.save'
+                                                     ]['buckets']), 1)
+            packets = set()
+            while len(packets) < 5:
+                packets.add(listener.recv(1024).split(':')[0])
+            assert 'test.upload.receive' in packets
+
+            # Only staff members can read the metrics
+            self.assertEquals(self.client.get('/music/metrics').status_code,
+                              302)
+            User.objects.filter(username='bob').update(is_staff=True)
+            resp = self.client.get('/music/metrics')
+            self.assertEquals(simplejson.loads(resp.content)['counters'],
+                              {'upload.accepted': 1})
+        finally:
+            instrumentation._sinks = None
+            listener.close()
+
+    def test_benchmarks(self):
+        "Synthetic catalogues grow incrementally and regressions are reported"
+        from benchmarks import catalogue, run
+        samples = catalogue.store_samples()
+        catalogue.generate(3, 10, samples)
+        catalogue.generate(3, 25, samples)
+        self.assertEquals(Track.objects.filter(
+                user__username__startswith='user').count(), 25)
+        track = Track.objects.get(slug='track-24')
+        self.assertEquals(track.user.username, 'user0')
+        assert default_storage.exists(track.audio_file.name)
+        assert Track.objects.get(slug='track-0').image
+
+        stats = run.measure(run.Scenarios().track_detail, 2)
+        self.assertEquals(stats['iterations'], 2)
+        assert stats['min_ms'] <= stats['median_ms'] <= stats['max_ms']
+        baseline = {'results': {'10': {'index': dict(stats, mean_ms=10.0)}}}
+        results = {'results': {'10': {'index': dict(stats, mean_ms=11.0)}}}
+        self.assertEquals(run.compare(results, baseline, 1.2), [])
+        results['results']['10']['index'].update(mean_ms=13.0,
+                                                 queries=stats['queries'] + 1)
+        self.assertEquals([name for size, name, message in
+                           run.compare(results, baseline, 1.2)],
+                          ['index', 'index'])
+
+    def test_slugify_uniquely(self):
+        "Unique slugs are allocated with a single query"
+        user = User.objects.get(username='bob')
+        for slug in ('untitled', 'untitled-2', 'untitled-4', 'untitled-foo'):
+            Track.objects.create(user=user, slug=slug,
+                    audio_file="audio_file.ogg")
+        track = Track(user=user)
+        self.assertNumQueries(1, slugify_uniquely, "Untitled", track)
+        self.assertEquals(slugify_uniquely("Untitled", track), 'untitled-3')
+        self.assertEquals(slugify_uniquely("Untitled foo", track),
+                'untitled-foo-2')
+        self.assertEquals(slugify_uniquely("Something", track), 'something')
+        alice = User.objects.get(username='alice')
+        self.assertEquals(slugify_uniquely("Untitled", Track(user=alice)),
+                'untitled')
+
+    def test_slug_race(self):
+        "A new track gets another slug if its slug is taken concurrently"
+        user = User.objects.get(username='bob')
+        Track.objects.create(user=user, slug='untitled',
+                audio_file="audio_file.ogg")
+        self.assertRaises(IntegrityError, Track.objects.create, user=user,
+                slug='untitled', audio_file="audio_file.ogg")
+        original_slugify_uniquely = models.slugify_uniquely
+        calls = []
+        def racy_slugify_uniquely(value, obj):
+            # The first call returns the slug another upload just took
+            calls.append(value)
+            if len(calls) == 1:
+                return 'untitled'
+            return original_slugify_uniquely(value, obj)
+        models.slugify_uniquely = racy_slugify_uniquely
+        try:
+            track = Track.objects.create(user=user, title="Untitled",
+                    audio_file="audio_file.ogg")
+        finally:
+            models.slugify_uniquely = original_slugify_uniquely
+        self.assertEquals(len(calls), 2)
+        self.assertEquals(track.slug, 'untitled-2')
+
+    def test_deferred_metadata_extraction(self):
+        "Uploads are accepted right away when metadata extraction is deferred"
+        jobs._backend = jobs.DatabaseBackend()
+        self.do_upload('ogg')
+        track = Track.objects.get()
+        self.assertEquals(track.metadata_status, 'pending')
+        self.assertEquals(track.genre, None)
+        self.assertEquals(track.slug, 'audio_file')
+        resp = self.client.get('/music/status/%s' % track.id)
+        self.assertEquals(simplejson.loads(resp.content)['status'], 'pending')
+
+        # Edits made while the file is read are kept
+        def fill_and_edit(track, *args, **kwargs):
+            Track.objects.filter(id=track.id).update(genre='Edited')
+            return models.AbstractTrack.fill_from_audio_file(track, *args,
+                                                             **kwargs)
+        Track.fill_from_audio_file = fill_and_edit
+        try:
+            call_command('audiotracks_worker', once=True)
+        finally:
+            del Track.fill_from_audio_file
+        self.assertEquals(models.Job.objects.count(), 0)
+        resp = self.client.get('/music/status/%s' % track.id)
+        data = simplejson.loads(resp.content)
+        self.assertEquals(data['status'], 'ready')
+        self.assertEquals(data['genre'], 'Edited')
+        self.assert_(data['duration'] > 0)
+        self.assert_(data['sample_rate'] > 0)
+        track = Track.objects.get()
+        self.assertEquals(track.title, "django-audiotracks test file")
+        # The slug made from the file name is replaced by one made from the
+        # title
+        self.assertEquals(track.slug, 'django-audiotracks-test-file')
+        self.assertEquals(stats.get_stats(track.user).total_size,
+                          track.audio_size)
+
+        # Other users can't see the status of the track
+        self.client.login(username='alice', password='secret')
+        resp = self.client.get('/music/status/%s' % track.id)
+        self.assertEquals(resp.status_code, 404)
+
+    def test_failed_job(self):
+        "Failed jobs are kept along with their traceback"
+        jobs._backend = jobs.DatabaseBackend()
+        jobs.enqueue('extract_metadata', 'not a number')
+        call_command('audiotracks_worker', once=True)
+        job = models.Job.objects.get()
+        self.assertEquals(job.status, models.Job.FAILED)
+        self.assertEquals(job.attempts, 1)
+        assert 'ValueError' in job.error
+
+        # Jobs of uploads which haven't been committed are retried
+        job.delete()
+        jobs.enqueue('extract_metadata', 999)
+        for attempt in range(jobs.ATTEMPTS):
+            models.Job.objects.update(run_after=datetime.datetime.now())
+            call_command('audiotracks_worker', once=True)
+            job = models.Job.objects.get()
+            self.assertEquals(job.attempts, attempt + 1)
+        self.assertEquals(job.status, models.Job.FAILED)
+        assert 'Retry' in job.error
+
+    def test_enqueue_on_commit(self):
+        "Jobs enqueued on commit wait for the end of the request"
+        jobs._backend = jobs.DatabaseBackend()
+        jobs.start_request()
+        jobs.enqueue_on_commit('compute_waveform', 1)
+        jobs.enqueue_on_commit('compute_waveform', 1)
+        self.assertEquals(models.Job.objects.count(), 0)
+        jobs.finish_request()
+        self.assertEquals(models.Job.objects.count(), 1)
+        jobs.enqueue_on_commit('compute_waveform', 2)
+        self.assertEquals(models.Job.objects.count(), 2)
+
+    def test_thread_backend(self):
+        "Jobs run in a pool of threads"
+        done = []
+        jobs.task('test_thread_backend')(
+                lambda key: done.append((key, threading.currentThread())))
+        backend = jobs.ThreadBackend(workers=2)
+        for n in range(5):
+            backend.enqueue('test_thread_backend', n)
+        backend.join()
+        self.assertEquals(sorted(key for key, thread in done), range(5))
+        assert threading.currentThread() not in [t for k, t in done]
+
+        # Delayed jobs are postponed by identical jobs, and run once
+        del done[:]
+        backend.enqueue('test_thread_backend', 'delayed', 60)
+        timer = backend.timers[('test_thread_backend', 'delayed')][0]
+        backend.enqueue('test_thread_backend', 'delayed', 60)
+        # The first timer has been cancelled
+        self.assert_(timer.finished.isSet())
+        backend.enqueue('test_thread_backend', 'delayed', 0)
+        for attempt in range(100):
+            if done:
+                break
+            time.sleep(0.01)
+        backend.join()
+        self.assertEquals([key for key, thread in done], ['delayed'])
+        self.assertEquals(backend.timers, {})
+        del jobs.TASKS['test_thread_backend']
+
+    def test_immediate_backend(self):
+        "Delayed jobs enqueued during a request run once it is finished"
+        done = []
+        jobs.task('test_immediate_backend')(done.append)
+        backend = jobs.ImmediateBackend()
+        backend.enqueue('test_immediate_backend', 'now', 10)
+        self.assertEquals(done, ['now'])
+        del done[:]
+        jobs.start_request()
+        backend.enqueue('test_immediate_backend', 'later', 10)
+        backend.enqueue('test_immediate_backend', 'later', 10)
+        backend.enqueue('test_immediate_backend', 'now', 0)
+        self.assertEquals(done, ['now'])
+        jobs._backend = backend
+        jobs.finish_request()
+        self.assertEquals(done, ['now', 'later'])
+        del jobs.TASKS['test_immediate_backend']
+
+    def test_embedded_cover_art(self):
+        "Cover art embedded in the audio file is attached to the track"
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filepath = os.path.join(tmpdir, 'cover.mp3')
+            shutil.copy(os.path.join(TEST_DATA_DIR, 'audio_file.mp3'),
+                    filepath)
+            tags = ID3(filepath)
+            tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc=u'Cover',
+                data=open(os.path.join(TEST_DATA_DIR, 'image.jpg'),
+                          'rb').read()))
+            tags.save()
+            self.client.post('/music/upload', {'audio_file': open(filepath)})
+        finally:
+            shutil.rmtree(tmpdir)
+        track = Track.objects.get()
+        self.assert_(track.image.name.endswith('cover.jpg'))
+        assert os.path.exists(os.path.join(settings.MEDIA_ROOT,
+            track.image.name.replace('.jpg', '.48x48.jpg')))
+
+    def test_edit_without_tag_change(self):
+        "The audio file isn't rewritten when no tag has changed"
+        self.do_upload('ogg')
+        track = Track.objects.get(genre="Test Data")
+        audio_file_path = track.audio_file.path
+        os.utime(audio_file_path, (0, 0))
+        self.do_edit(track, slug='new-slug', **dict((field,
+            getattr(track, field) or '') for field in METADATA_FIELDS))
+        self.assertEquals(Track.objects.get(id=track.id).slug, 'new-slug')
+        self.assertEquals(os.path.getmtime(audio_file_path), 0)
+        self.do_edit(track, slug='new-slug')
+        self.assertNotEquals(os.path.getmtime(audio_file_path), 0)
+
+    def test_deferred_tag_write(self):
+        "Tags of rapidly edited tracks are written once, after a delay"
+        self.do_upload('flac')
+        jobs._backend = jobs.DatabaseBackend()
+        track = Track.objects.get(genre="Test Data")
+        self.do_edit(track, slug='new-slug', title='First Title')
+        run_after = models.Job.objects.get().run_after
+        self.do_edit(track, slug='new-slug', title='Second Title')
+        job = models.Job.objects.get()
+        self.assertEquals((job.task, job.key), ('write_tags', str(track.id)))
+        # Each edit postpones the write
+        self.assert_(job.run_after > run_after)
+        self.assertEquals(jobs.get_backend().run_pending(), 0)
+        metadata = mutagen.File(track.audio_file.path, easy=True)
+        self.assertEquals(metadata['title'], ['django-audiotracks test file'])
+
+        models.Job.objects.update(run_after=job.created_at)
+        self.assertEquals(jobs.get_backend().run_pending(), 1)
+        metadata = mutagen.File(track.audio_file.path, easy=True)
+        self.assertEquals(metadata['title'], ['Second Title'])
+        self.assertEquals(metadata['genre'], ['New Genre'])
+        track = Track.objects.get(id=track.id)
+        self.assertEquals(track.audio_size,
+                          os.path.getsize(track.audio_file.path))
+
+        # Only the columns describing the file are written, keeping edits
+        # made since the track was loaded
+        track.title = 'Third Title'
+        Track.objects.filter(id=track.id).update(description='Edited')
+        self.assert_(track.write_tags())
+        track = Track.objects.get(id=track.id)
+        self.assertEquals((track.title, track.description),
+                          ('Second Title', 'Edited'))
+        self.assertEquals(mutagen.File(track.audio_file.path,
+                                       easy=True)['title'], ['Third Title'])
+        self.assertEquals(track.audio_size,
+                          os.path.getsize(track.audio_file.path))
+        self.assertEquals(stats.get_stats(track.user).total_size,
+                          track.audio_size)
+
+        # Jobs aren't postponed indefinitely
+        jobs.enqueue('write_tags', track.id, 60)
+        created_at = datetime.datetime.now() - datetime.timedelta(
+                seconds=jobs.MAX_DELAY)
+        models.Job.objects.update(created_at=created_at)
+        jobs.enqueue('write_tags', track.id, 60)
+        self.assertEquals(models.Job.objects.get().run_after, created_at +
+                          datetime.timedelta(seconds=jobs.MAX_DELAY))
+
+    def test_resize_thumbs(self):
+        "All thumbnail sizes are generated from a single decode"
+        original = StringIO.StringIO()
+        Image.new('RGB', (1600, 1200), (255, 0, 0)).save(original, 'JPEG')
+        opened = []
+        original_open = thumbs.Image.open
+        def counting_open(*args):
+            opened.append(args)
+            return original_open(*args)
+        thumbs.Image.open = counting_open
+        try:
+            images = thumbs.resize_thumbs(original,
+                    ((48, 48), (200, 200), (300, 100)))
+        finally:
+            thumbs.Image.open = original_open
+        self.assertEquals(len(opened), 1)
+        self.assertEquals(images[(48, 48)].size, (48, 48))
+        self.assertEquals(images[(200, 200)].size, (200, 200))
+        self.assertEquals(images[(300, 100)].size, (133, 100))
+        content = thumbs.generate_thumb(original, (48, 48), 'jpg')
+        self.assertEquals(Image.open(content).size, (48, 48))
+
+    def test_lazy_thumbnail_urls(self):
+        "Thumbnail URLs are only computed when needed"
+        user = User.objects.get(username='bob')
+        Track.objects.create(user=user, title="Track",
+                audio_file="audio_file.ogg", image="images/cover.jpg")
+        track = Track.objects.get()
+        calls = []
+        storage_url = track.image.storage.url
+        track.image.storage.url = lambda name: calls.append(name) or \
+                storage_url(name)
+        try:
+            self.assertEquals(calls, [])
+            self.assertEquals(track.image.url_48x48,
+                    settings.MEDIA_URL + 'images/cover.48x48.jpg')
+            self.assertEquals(track.image.url_48x48,
+                    settings.MEDIA_URL + 'images/cover.48x48.jpg')
+            self.assertEquals(track.image.srcset(),
+                    '%(url)s.48x48.jpg 48w, %(url)s.200x200.jpg 200w' % {
+                        'url': settings.MEDIA_URL + 'images/cover'})
+            self.assertEquals(len(calls), 1)
+            self.assertRaises(AttributeError, getattr, track.image,
+                    'url_10x10')
+        finally:
+            del track.image.storage.url
+
+    def test_audio_range_requests(self):
+        "Serve audio files with byte range support"
+        self.do_upload('ogg')
+        track = Track.objects.get()
+        data = open(os.path.join(TEST_DATA_DIR, 'audio_file.ogg'),
+                    'rb').read()
+        url = '/bob/music/audio/' + track.slug
+
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Accept-Ranges'], 'bytes')
+        self.assertEquals(response['Content-Type'], 'audio/ogg')
+        self.assertEquals(response.content, data)
+        etag = response['ETag']
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response['Content-Range'],
+                          'bytes 10-19/%s' % len(data))
+        self.assertEquals(response.content, data[10:20])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-5')
+        self.assertEquals(response.status_code, 206)
+        self.assertEquals(response.content, data[-5:])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=%s-' % len(data))
+        self.assertEquals(response.status_code, 416)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19',
+                                   HTTP_IF_RANGE='"stale"')
+        self.assertEquals(response.status_code, 200)
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEquals(response.status_code, 206)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+
+        # Range requests don't query the database or the storage
+        self.client.logout()
+        self.assertNumQueries(0, self.client.get, url,
+                              HTTP_RANGE='bytes=10-19')
+
+        # Files rewritten in place with the same size get a new ETag
+        Track.objects.filter(id=track.id).update(content_hash='0' * 40)
+        caching.forget_track('bob', track.slug)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19',
+                                   HTTP_IF_RANGE=etag)
+        self.assertEquals(response.status_code, 200)
+
+        response = self.client.get(url + '?download')
+        self.assert_(response['Content-Disposition'].startswith('attachment'))
+        self.assertEquals(self.client.get(url + 'x').status_code, 404)
+
+    def test_audio_sendfile(self):
+        "Offload audio files to the front web server"
+        self.do_upload('ogg')
+        track = Track.objects.get()
+        streaming.SENDFILE = 'xaccel'
+        try:
+            response = self.client.get('/bob/music/audio/' + track.slug)
+        finally:
+            streaming.SENDFILE = None
+        self.assertEquals(response['X-Accel-Redirect'],
+                          '/protected/' + track.audio_file.name)
+        self.assertEquals(response.content, '')
+
+        # Files which aren't on the local filesystem are streamed
+        def no_path(fieldfile):
+            raise NotImplementedError
+        path = FieldFile.path
+        streaming.SENDFILE = 'xsendfile'
+        FieldFile.path = property(no_path)
+        try:
+            response = self.client.get('/bob/music/audio/' + track.slug)
+        finally:
+            FieldFile.path = path
+            streaming.SENDFILE = None
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Sendfile'))
+        self.assertEquals(response.content, open(os.path.join(TEST_DATA_DIR,
+                'audio_file.ogg'), 'rb').read())
+
+    def test_upload_handler(self):
+        "Uploads are hashed and checked while they are received"
+        self.do_upload('mp3')
+        track = Track.objects.get()
+        data = open(os.path.join(TEST_DATA_DIR, 'audio_file.mp3'),
+                    'rb').read()
+        self.assertEquals(track.content_hash, hashlib.sha1(data).hexdigest())
+
+        upload = StringIO.StringIO('This is not an audio file')
+        upload.name = 'audio_file.ogg'
+        response = self.client.post('/music/upload', {'audio_file': upload})
+        self.assertEquals(Track.objects.count(), 1)
+        self.assertEquals(response.context['form'].errors['audio_file'],
+                          ['Unsupported audio format.'])
+
+        uploadhandler.MAX_UPLOAD_SIZE = 1000
+        try:
+            filename, filehandle = self.get_upload_file('ogg')
+            response = self.client.post('/music/upload',
+                                        {'audio_file': filehandle})
+        finally:
+            uploadhandler.MAX_UPLOAD_SIZE = None
+        self.assertEquals(Track.objects.count(), 1)
+        self.assertEquals(response.context['form'].errors['audio_file'],
+                          ['The file is too large, the maximum size is '
+                           '1000 bytes.'])
+
+        # Rejected files are discarded without resetting the connection
+        handler = uploadhandler.AudioUploadHandler(max_size=10)
+        handler.new_file('audio_file', 'audio_file.ogg', 'audio/ogg', None)
+        try:
+            handler.receive_data_chunk('OggS' * 10, 0)
+        except StopUpload as e:
+            self.assertFalse(e.connection_reset)
+        else:
+            self.fail("The upload wasn't stopped")
+        self.assert_('too large' in handler.error)
+        self.assertEquals(uploadhandler.sniff_format('RIFF\0\0\0\0WAVEfmt '),
+                          'wav')
+
+    def test_content_addressed_storage(self):
+        "Identical uploads share a blob, deleted with its last track"
+        contentstore.ENABLED = True
+        try:
+            self.do_upload('ogg')
+            self.client.login(username='alice', password='secret')
+            self.do_upload('ogg')
+            bob_track, alice_track = Track.objects.order_by('id')
+            self.assertEquals(bob_track.audio_file.name,
+                              alice_track.audio_file.name)
+            blob = bob_track.audio_file.path
+            self.assert_(contentstore.is_blob(bob_track.audio_file.name))
+            self.assert_(bob_track.content_hash in blob)
+            self.assert_(os.path.exists(blob))
+            self.assertEquals(AudioBlob.objects.get(
+                    name=bob_track.audio_file.name).reference_count, 2)
+
+            # Writing tags stores a new blob
+            self.do_edit(alice_track, slug=alice_track.slug)
+            alice_track = Track.objects.get(id=alice_track.id)
+            self.assertNotEquals(alice_track.audio_file.name,
+                                 bob_track.audio_file.name)
+            self.assertEquals(dict(AudioBlob.objects.values_list(
+                    'name', 'reference_count')),
+                    {bob_track.audio_file.name: 1,
+                     alice_track.audio_file.name: 1})
+            self.assertEquals(mutagen.File(alice_track.audio_file.path,
+                                           easy=True)['title'], ['New Title'])
+            self.assertEquals(mutagen.File(blob, easy=True)['title'],
+                              [bob_track.title])
+
+            bob_track.delete()
+            self.assertFalse(os.path.exists(blob))
+            alice_blob = alice_track.audio_file.path
+            alice_track.delete()
+            self.assertFalse(os.path.exists(alice_blob))
+            self.assertEquals(AudioBlob.objects.count(), 0)
+
+            # A blob whose last reference is released isn't reused, as its
+            # file is being deleted
+            self.do_upload('ogg')
+            track = Track.objects.get()
+            AudioBlob.objects.all().delete()
+            self.client.login(username='bob', password='secret')
+            self.do_upload('ogg')
+            self.assertEquals(Track.objects.filter(
+                    audio_file=track.audio_file.name).count(), 1)
+        finally:
+            contentstore.ENABLED = False
+
+    def test_waveform_endpoint(self):
+        "Serve precomputed waveforms as binary data or JSON"
+        self.do_upload('ogg')
+        track = Track.objects.get()
+        url = '/bob/music/waveform/' + track.slug
+        self.assertEquals(self.client.get(url).status_code, 404)
+
+        data = waveform.MAGIC + struct.pack('<IIIIII', 44100, 2, 10, 2, 20, 1
+                ) + struct.pack('<6b', -10, 12, -100, 127, -100, 127)
+        track.waveform.save('1.peaks', ContentFile(data))
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, data)
+        response = self.client.get(url + '?format=json')
+        self.assertEquals(simplejson.loads(response.content), {
+            'sample_rate': 44100,
+            'levels': [
+                {'samples_per_peak': 10, 'length': 2,
+                 'peaks': [-10, 12, -100, 127]},
+                {'samples_per_peak': 20, 'length': 1, 'peaks': [-100, 127]},
+                ]})
+        self.assertContains(self.client.get('/bob/music/track/' + track.slug),
+                            'audiotracks-waveform')
+
+    @unittest.skipIf(waveform.numpy is None, "NumPy isn't installed")
+    def test_compute_waveform(self):
+        "Compute the waveform of WAV files"
+        self.do_upload('wav')
+        track = Track.objects.get()
+        data = waveform.parse_waveform(track.waveform.read())
+        levels = data['levels']
+        # 43976 frames at 11 samples per peak
+        self.assertEquals([level['length'] for level in levels],
+                          [3998, 1000, 250])
+        self.assertEquals(levels[1]['samples_per_peak'],
+                          levels[0]['samples_per_peak'] * 4)
+        peaks = levels[0]['peaks']
+        self.assert_(max(peaks) > 0 > min(peaks))
+        self.assertEquals(max(levels[2]['peaks']), max(peaks))
+
+    def test_import_tracks(self):
+        "Import a directory of audio files, resuming interrupted imports"
+        directory = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(directory, 'sub'))
+            for ext in ('ogg', 'mp3'):
+                shutil.copy(os.path.join(TEST_DATA_DIR, 'audio_file.' + ext),
+                            directory)
+            shutil.copy(os.path.join(TEST_DATA_DIR, 'audio_file.wav'),
+                        os.path.join(directory, 'sub'))
+            open(os.path.join(directory, 'broken.flac'), 'w').write('xxx')
+            open(os.path.join(directory, 'notes.txt'), 'w').write('xxx')
+            # Pretend a previous import has been interrupted
+            open(os.path.join(directory, '.audiotracks_import'), 'w').write(
+                    'audio_file.mp3\n')
+            stdout, stderr = StringIO.StringIO(), StringIO.StringIO()
+            # Static feeds are scheduled once per batch
+            scheduled = []
+            enqueue = jobs.enqueue
+            def record(task, *args):
+                scheduled.append(task)
+                return enqueue(task, *args)
+            staticfeeds.ENABLED = True
+            jobs._backend = jobs.DatabaseBackend()
+            jobs.enqueue = record
+            try:
+                call_command('import_tracks', 'bob', directory, processes=1,
+                             batch_size=2, stdout=stdout, stderr=stderr)
+            finally:
+                staticfeeds.ENABLED = False
+                jobs.enqueue = enqueue
+            self.assertEquals(scheduled.count('publish_feed'), 2)
+            self.assert_('broken.flac' in stderr.getvalue())
+            self.assert_('Imported 2 file(s), 1 failed' in stdout.getvalue())
+            ogg_track, wav_track = Track.objects.order_by('id')
+            self.assertEquals(ogg_track.slug, 'django-audiotracks-test-file')
+            self.assertEquals(ogg_track.genre, 'Test Data')
+            self.assertEquals(ogg_track.audio_mimetype, 'audio/ogg')
+            self.assert_(ogg_track.duration > 0)
+            self.assert_(os.path.exists(ogg_track.audio_file.path))
+            self.assertEquals(wav_track.slug, 'audio_file')
+
+            call_command('import_tracks', 'bob', directory, processes=1,
+                         stdout=stdout, stderr=stderr)
+            self.assertEquals(Track.objects.count(), 2)
+
+            # Files stored for a batch which fails are deleted
+            shutil.copy(os.path.join(TEST_DATA_DIR, 'audio_file.flac'),
+                        os.path.join(directory, 'new.flac'))
+            def fail(track, **kwargs):
+                raise RuntimeError
+            Track.save = fail
+            try:
+                self.assertRaises(RuntimeError, call_command, 'import_tracks',
+                        'bob', directory, processes=1, stdout=stdout,
+                        stderr=stderr)
+            finally:
+                del Track.save
+            self.assertEquals(Track.objects.count(), 2)
+            self.assertFalse(default_storage.exists(
+                    'audiotracks/audio_files/bob/new.flac'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_import_slug_allocation(self):
+        "Allocate slugs like slugify_uniquely does"
+        from audiotracks.management.commands.import_tracks import \
+                SlugAllocator
+        slugs = SlugAllocator(['track', 'track-2', 'track-4'])
+        self.assertEquals([slugs.allocate('Track') for i in range(3)],
+                          ['track-3', 'track-5', 'track-6'])
+        self.assertEquals(slugs.allocate('Other'), 'other')
+
+    def test_track_list_fragment_cache(self):
+        "Rendered list items are cached until their track changes"
+        self.create_tracks(2)
+        track = Track.objects.get(title="Track 1")
+        for url in ('/music', '/bob/music/tracks'):
+            self.assertContains(self.client.get(url), 'Track 1')
+        # update() doesn't change updated_at
+        Track.objects.filter(id=track.id).update(title="Renamed")
+        self.assertContains(self.client.get('/music'), 'Track 1')
+        response = self.client.get('/bob/music/tracks')
+        self.assertContains(response, 'Track 1')
+        # Owner actions aren't part of the cached fragment
+        self.assertContains(response, '/music/edit/%s' % track.id)
+        track = Track.objects.get(id=track.id)
+        track.save()
+        for url in ('/music', '/bob/music/tracks'):
+            self.assertContains(self.client.get(url), 'Renamed')
+
+    def test_anonymous_page_cache(self):
+        "Pages are served from the cache to anonymous users"
+        self.create_tracks(2)
+        self.client.logout()
+        self.client.get('/music')
+        self.assertEquals(self.count_queries('/music'), 0)
+        self.assert_(self.count_queries('/alice/music'))
+        self.assertEquals(self.count_queries('/alice/music'), 0)
+        self.create_tracks(1, username='alice')
+        response = self.client.get('/alice/music')
+        self.assertContains(response, 'Track 1')
+        self.assertContains(self.client.get('/music'), 'uploaded by alice')
+
+        # Pages showing messages to a visitor aren't shared
+        for attempt in range(2):
+            request = RequestFactory().get('/music')
+            request.user = AnonymousUser()
+            request._messages = CookieStorage(request)
+            messages.info(request, 'Only for you')
+            self.assertContains(views.index(request), 'Only for you')
+            self.assertNotContains(self.client.get('/music'), 'Only for you')
+            cache.clear()
+
+    def test_indexes(self):
+        "Composite indexes are created along with the track table"
+        statements = indexes.sql_composite_indexes(Track)
+        self.assertEquals(len(statements), 1)
+        self.assert_('"user_id", "created_at"' in statements[0])
+        cursor = connection.cursor()
+        cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = %s", [Track._meta.db_table])
+        created = [row[0] for row in cursor.fetchall()]
+        self.assert_(statements[0].rstrip(';') in created)
+        # Existing indexes are skipped. Running DDL statements would commit
+        # the test transaction.
+        self.assertEquals(indexes.create_indexes(
+                indexes.sql_all_indexes(Track)), [])
+        stdout = StringIO.StringIO()
+        call_command('audiotracks_indexes', sql=True, stdout=stdout)
+        self.assert_('("created_at");' in stdout.getvalue())
+
+    def test_track_detail_cache(self):
+        "Track lookups are cached, including misses"
+        self.create_tracks(1)
+        self.assertNumQueries(1, caching.get_track, 'bob', 'track-1')
+        self.assertNumQueries(0, caching.get_track, 'bob', 'track-1')
+        track = caching.get_track('bob', 'track-1')
+        self.assertEquals(track.title, "Track 1")
+        self.assertNumQueries(0, lambda: track.user.username)
+        self.assertEquals(caching.get_track('bob', 'renamed'), None)
+        self.assertNumQueries(0, caching.get_track, 'bob', 'renamed')
+        self.assertEquals(self.client.get('/bob/music/track/renamed'
+                                          ).status_code, 404)
+
+        # Changing the slug forgets both the old and the new one
+        track = Track.objects.get(slug='track-1')
+        track.slug = 'renamed'
+        track.save()
+        self.assertEquals(caching.get_track('bob', 'track-1'), None)
+        self.assertEquals(caching.get_track('bob', 'renamed').id, track.id)
+        self.assertContains(self.client.get('/bob/music/track/renamed'),
+                            'Track 1')
+
+        # While a process reloads a stale entry, others serve it
+        key = caching.get_track_key('bob', 'renamed')
+        cache.set(key, (0, track))
+        cache.add(key + ':lock', 1)
+        self.assertNumQueries(0, caching.get_track, 'bob', 'renamed')
+        cache.delete(key + ':lock')
+        self.assertNumQueries(1, caching.get_track, 'bob', 'renamed')
+        self.assertNumQueries(0, caching.get_track, 'bob', 'renamed')
+
+        track.delete()
+        self.assertEquals(caching.get_track('bob', 'renamed'), None)
+
+    def test_playlists(self):
+        "M3U and XSPF playlists are streamed a chunk of tracks at a time"
+        self.create_tracks(5)
+        Track.objects.filter(title="Track 5").update(artist=u"Bj\xf6rk",
+                                                     duration=61.6)
+        old_chunk_size = playlists.CHUNK_SIZE
+        playlists.CHUNK_SIZE = 2
+        try:
+            resp = self.client.get('/bob/music.m3u')
+            self.assertEquals(resp['Content-Type'], 'audio/x-mpegurl')
+            lines = resp.content.splitlines()
+            self.assertEquals(lines[0], '#EXTM3U')
+            self.assertEquals(lines[1], '#EXTINF:62,Bj\xf6rk - Track 5')
+            assert lines[2].startswith('http://testserver/')
+            assert lines[2].endswith('audio_file.ogg')
+            self.assertEquals(lines[3], '#EXTINF:-1,Track 4')
+            self.assertEquals(len(lines), 11)
+            # Tracks are fetched while the response is iterated, one query
+            # per chunk of two tracks
+            resp = self.client.get('/music.m3u')
+            self.assertNumQueries(3, lambda: resp.content)
+        finally:
+            playlists.CHUNK_SIZE = old_chunk_size
+
+        resp = self.client.get('/music.m3u8')
+        assert '#EXTINF:62,Bj\xc3\xb6rk - Track 5' in resp.content
+
+        resp = self.client.get('/music.xspf')
+        self.assertEquals(resp['Content-Type'],
+                          'application/xspf+xml; charset=utf-8')
+        content = resp.content
+        assert ('<title>Track 5</title><creator>Bj\xc3\xb6rk</creator>'
+                '<duration>61600</duration>') in content
+        self.assertEquals(content.count('<track>'), 5)
+
+        self.assertEquals(self.client.get('/alice/music.m3u').content,
+                          '#EXTM3U\n')
+        self.assertEquals(len(self.client.get('/bob/music/feed.m3u'
+                                              ).content.splitlines()), 11)
+        self.assertEquals(len(self.client.get('/music/tracks.m3u'
+                                              ).content.splitlines()), 11)
+        self.client.logout()
+        self.assertEquals(self.client.get('/music/tracks.m3u').status_code,
+                          302)
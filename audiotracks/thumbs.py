@@ -11,6 +11,12 @@ except ImportError:
     import Image
 from django.core.files.base import ContentFile
 import cStringIO
+import re
+import threading
+
+from audiotracks.instrumentation import timer
+
+THUMB_URL_RE = re.compile(r'^url_(\d+)x(\d+)$')
 
 def generate_thumb(img, thumb_size, format):
     """
@@ -25,82 +31,171 @@ def generate_thumb(img, thumb_size, format):
     format      format of the original image ('jpeg','gif','png',...)
                 (this format will be used for the generated thumbnail, too)
     """
+    return generate_thumbs(img, [thumb_size], format)[thumb_size]
+
+def generate_thumbs(img, sizes, format):
+    """
+    Generates thumbnails for several sizes at once and returns a dictionary
+    mapping each size to a ContentFile object. See resize_thumbs.
+    """
+    images = resize_thumbs(img, sizes)
+    return dict((size, encode_thumb(images[size], format)) for size in sizes)
+
+def resize_thumbs(img, sizes):
+    """
+    Returns a dictionary mapping each size to a resized PIL image
     
+    The original image is decoded only once. Large JPEG images are shrunk by
+    the decoder itself (see Image.draft) to the smallest scale that is still
+    bigger than the largest thumbnail, and each thumbnail is resized from the
+    smallest already generated thumbnail that is big enough, rather than from
+    the original image.
+    
+    Square sizes produce a thumbnail of the largest square of the image,
+    other sizes a thumbnail of the whole image that fits in the given size.
+    """
     img.seek(0) # see http://code.djangoproject.com/ticket/8222 for details
     image = Image.open(img)
     
+    max_w = max([w for w, h in sizes])
+    max_h = max([h for w, h in sizes])
+    # Only has an effect on JPEG images
+    image.draft(image.mode, (max_w, max_h))
+    
     # Convert to RGB if necessary
     if image.mode not in ('L', 'RGB', 'RGBA'):
         image = image.convert('RGB')
-        
-    # get size
-    thumb_w, thumb_h = thumb_size
-    # If you want to generate a square thumbnail
-    if thumb_w == thumb_h:
-        # quad
-        xsize, ysize = image.size
-        # get minimum size
-        minsize = min(xsize,ysize)
-        # largest square possible in the image
-        xnewsize = (xsize-minsize)/2
-        ynewsize = (ysize-minsize)/2
-        # crop it
-        image2 = image.crop((xnewsize, ynewsize, xsize-xnewsize, ysize-ynewsize))
-        # load is necessary after crop                
-        image2.load()
-        # thumbnail of the cropped image (with ANTIALIAS to make it look better)
-        image2.thumbnail(thumb_size, Image.ANTIALIAS)
     else:
-        # not quad
-        image2 = image
-        image2.thumbnail(thumb_size, Image.ANTIALIAS)
+        image.load()
     
+    square = None
+    # (box, image) pairs of the thumbnails generated so far, for each shape
+    generated = {True: [], False: []}
+    thumbs = {}
+    # Biggest sizes first, so that smaller ones can be resized from them
+    for size in sorted(set(sizes), key=lambda size: size[0] * size[1],
+                       reverse=True):
+        thumb_w, thumb_h = size
+        quad = thumb_w == thumb_h
+        if quad:
+            if square is None:
+                # largest square possible in the image
+                xsize, ysize = image.size
+                minsize = min(xsize, ysize)
+                xnewsize = (xsize - minsize) / 2
+                ynewsize = (ysize - minsize) / 2
+                square = image.crop((xnewsize, ynewsize, xsize - xnewsize,
+                                     ysize - ynewsize))
+                # load is necessary after crop
+                square.load()
+            source = square
+        else:
+            source = image
+        for (box_w, box_h), candidate in generated[quad]:
+            if box_w >= thumb_w and box_h >= thumb_h:
+                # generated is sorted from the biggest to the smallest
+                source = candidate
+        thumb = source.copy()
+        thumb.thumbnail(size, Image.ANTIALIAS)
+        generated[quad].append((size, thumb))
+        thumbs[size] = thumb
+    return thumbs
+
+def encode_thumb(image, format):
+    """
+    Encodes a PIL image and returns a ContentFile object
+    """
     io = cStringIO.StringIO()
     # PNG and GIF are the same, JPG is JPEG
     if format.upper()=='JPG':
         format = 'JPEG'
     
-    image2.save(io, format)
-    return ContentFile(io.getvalue())    
+    image.save(io, format)
+    return ContentFile(io.getvalue())
 
 class ImageWithThumbsFieldFile(ImageFieldFile):
     """
     See ImageWithThumbsField for usage example
     """
-    def __init__(self, *args, **kwargs):
-        super(ImageWithThumbsFieldFile, self).__init__(*args, **kwargs)
-        
-        if self.field.sizes:
-            def get_size(self, size):
-                if not self:
-                    return ''
-                else:
-                    split = self.url.rsplit('.',1)
-                    thumb_url = '%s.%sx%s.%s' % (split[0],w,h,split[1])
-                    return thumb_url
-                    
-            for size in self.field.sizes:
-                (w,h) = size
-                setattr(self, 'url_%sx%s' % (w,h), get_size(self, size))
+    def __getattr__(self, name):
+        # url_[width]x[height] attributes are resolved on first access, then
+        # memoized. Use __dict__ since this may be called before __init__ or
+        # during unpickling.
+        match = THUMB_URL_RE.match(name)
+        field = self.__dict__.get('field')
+        if match and field is not None and field.sizes:
+            size = (int(match.group(1)), int(match.group(2)))
+            if size in [tuple(s) for s in field.sizes]:
+                thumb_url = self.thumb_url(size)
+                self.__dict__[name] = thumb_url
+                return thumb_url
+        raise AttributeError(name)
+    
+    def _get_base_url(self):
+        if '_base_url' not in self.__dict__:
+            self._base_url = self.url
+        return self._base_url
+    
+    def _reset_urls(self):
+        for name in list(self.__dict__):
+            if name == '_base_url' or THUMB_URL_RE.match(name):
+                del self.__dict__[name]
+    
+    def thumb_url(self, size):
+        """
+        Returns the URL of the thumbnail of the given size
+        """
+        if not self:
+            return ''
+        (w,h) = size
+        split = self._get_base_url().rsplit('.',1)
+        return '%s.%sx%s.%s' % (split[0],w,h,split[1])
+    
+    def srcset(self):
+        """
+        Returns the value of a srcset attribute listing all the thumbnails,
+        for use in an img element
+        """
+        if not self or not self.field.sizes:
+            return ''
+        return ', '.join(['%s %sw' % (self.thumb_url(size), size[0])
+                          for size in self.field.sizes])
                 
     def save(self, name, content, save=True):
-        super(ImageWithThumbsFieldFile, self).save(name, content, save)
+        self._reset_urls()
+        with timer('storage.save'):
+            super(ImageWithThumbsFieldFile, self).save(name, content, save)
         
         if self.field.sizes:
-            for size in self.field.sizes:
+            split = self.name.rsplit('.',1)
+            # you can use another thumbnailing function if you like
+            with timer('thumbs.resize'):
+                thumbs = resize_thumbs(content, self.field.sizes)
+            
+            # Encode and store thumbnails in parallel
+            errors = []
+            def save_thumb(size):
                 (w,h) = size
-                split = self.name.rsplit('.',1)
                 thumb_name = '%s.%sx%s.%s' % (split[0],w,h,split[1])
-                
-                # you can use another thumbnailing function if you like
-                thumb_content = generate_thumb(content, size, split[1])
-                
-                thumb_name_ = self.storage.save(thumb_name, thumb_content)        
-                
-                if not thumb_name == thumb_name_:
-                    raise ValueError('There is already a file named %s' % thumb_name)
+                try:
+                    thumb_content = encode_thumb(thumbs[size], split[1])
+                    thumb_name_ = self.storage.save(thumb_name, thumb_content)
+                    if not thumb_name == thumb_name_:
+                        raise ValueError('There is already a file named %s' % thumb_name)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=save_thumb, args=(size,))
+                       for size in self.field.sizes]
+            with timer('thumbs.save'):
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            if errors:
+                raise errors[0]
         
     def delete(self, save=True):
+        self._reset_urls()
         name=self.name
         super(ImageWithThumbsFieldFile, self).delete(save)
         if self.field.sizes:
@@ -126,6 +221,10 @@ class ImageWithThumbsField(ImageField):
         my_object.photo.url_125x125
         my_object.photo.url_300x200
     
+    These URLs are only computed when they are accessed. To get a value for
+    the srcset attribute of an img element listing all thumbnails:
+        my_object.photo.srcset()
+    
     Note: The 'sizes' attribute is not required. If you don't provide it, 
     ImageWithThumbsField will act as a normal ImageField
         
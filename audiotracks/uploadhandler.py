@@ -0,0 +1,144 @@
+"""
+Upload handler for audio files.
+
+Audio files are written to a temporary file, like with Django's
+TemporaryFileUploadHandler, but the handler also computes their SHA-1 hash and
+sniffs their format as chunks arrive. Files in an unsupported format are
+dropped as soon as their first chunk has been received, and requests larger
+than ``AUDIOTRACKS_MAX_UPLOAD_SIZE`` aren't parsed at all.
+"""
+import time
+
+from django.conf import settings
+from django.core.files.uploadhandler import (TemporaryFileUploadHandler,
+                                             StopUpload)
+from django.http import QueryDict
+from django.template.defaultfilters import filesizeformat
+from django.utils.datastructures import MultiValueDict
+from django.utils.hashcompat import sha_constructor
+from django.utils.translation import ugettext as _, ugettext_lazy
+
+from audiotracks import instrumentation
+
+# Maximum size of an upload in bytes, None for no limit
+MAX_UPLOAD_SIZE = getattr(settings, 'AUDIOTRACKS_MAX_UPLOAD_SIZE', None)
+
+# Number of bytes needed to recognize a format
+HEADER_SIZE = 12
+
+UNSUPPORTED_FORMAT_ERROR = ugettext_lazy("Unsupported audio format.")
+
+FORMAT_MIMETYPES = {
+    'ogg': 'audio/ogg',
+    'flac': 'audio/flac',
+    'mp3': 'audio/mpeg',
+    'mp4': 'audio/mp4',
+    'wav': 'audio/x-wav',
+}
+
+
+def sniff_format(header):
+    """
+    Return the name of the audio format of a file starting with ``header``, or
+    None if it isn't recognized
+    """
+    if header.startswith('OggS'):
+        return 'ogg'
+    if header.startswith('fLaC'):
+        return 'flac'
+    if header.startswith('ID3'):
+        return 'mp3'
+    if len(header) >= 2 and header[0] == '\xff' and \
+            ord(header[1]) & 0xe0 == 0xe0:
+        # MPEG audio frame sync
+        return 'mp3'
+    if header.startswith('RIFF') and header[8:12] == 'WAVE':
+        return 'wav'
+    if header[4:8] == 'ftyp':
+        return 'mp4'
+    return None
+
+
+class AudioUploadHandler(TemporaryFileUploadHandler):
+    """
+    Check the audio file uploaded in the ``field_name`` field while it is
+    received. The uploaded file gets ``content_hash`` and ``audio_format``
+    attributes. When the upload is rejected, the rest of the request is
+    discarded and ``error`` holds the reason, which the upload form reports.
+    The connection is kept so that the form can be sent back.
+    """
+
+    def __init__(self, request=None, field_name='audio_file',
+                 max_size=None):
+        super(AudioUploadHandler, self).__init__(request)
+        self.field_name = field_name
+        self.max_size = max_size or MAX_UPLOAD_SIZE
+        self.error = None
+        self.checking = False
+        self.started = time.time()
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        if self.max_size and content_length > self.max_size:
+            self.reject_too_large()
+            instrumentation.incr('upload.rejected')
+            # Don't read the request body at all
+            return QueryDict('', encoding=encoding), MultiValueDict()
+        return None
+
+    def new_file(self, field_name, *args, **kwargs):
+        super(AudioUploadHandler, self).new_file(field_name, *args, **kwargs)
+        self.checking = field_name == self.field_name
+        self.hash = sha_constructor()
+        self.header = ''
+        self.audio_format = None
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.checking:
+            if self.max_size and start + len(raw_data) > self.max_size:
+                self.reject_too_large()
+                self.stop()
+            if self.audio_format is None:
+                self.header += raw_data[:HEADER_SIZE - len(self.header)]
+                if len(self.header) >= HEADER_SIZE:
+                    self.check_format()
+            self.hash.update(raw_data)
+        return super(AudioUploadHandler, self).receive_data_chunk(raw_data,
+                                                                  start)
+
+    def file_complete(self, file_size):
+        checked, self.checking = self.checking, False
+        if checked and self.audio_format is None:
+            # File shorter than HEADER_SIZE
+            self.audio_format = sniff_format(self.header)
+            if self.audio_format is None:
+                self.error = UNSUPPORTED_FORMAT_ERROR
+                self.file.close()
+                return None
+        uploaded_file = super(AudioUploadHandler, self).file_complete(
+                file_size)
+        if checked:
+            uploaded_file.content_hash = self.hash.hexdigest()
+            uploaded_file.audio_format = self.audio_format
+        return uploaded_file
+
+    def upload_complete(self):
+        # The whole request body has been read
+        instrumentation.timing('upload.receive',
+                               (time.time() - self.started) * 1000)
+        if self.error:
+            instrumentation.incr('upload.rejected')
+
+    def check_format(self):
+        self.audio_format = sniff_format(self.header)
+        if self.audio_format is None:
+            self.error = UNSUPPORTED_FORMAT_ERROR
+            self.stop()
+
+    def stop(self):
+        self.file.close()
+        raise StopUpload()
+
+    def reject_too_large(self):
+        self.error = _("The file is too large, the maximum size is "
+                       "%(size)s.") % {'size': filesizeformat(self.max_size)}
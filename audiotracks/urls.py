@@ -5,12 +5,28 @@ urlpatterns = patterns("audiotracks.views",
     url("^/?$", "index", name="audiotracks"),
     url("^/(?P<page_number>\d+)/?$", "index", name="audiotracks"),
     url("^/track/(?P<track_slug>.*)$", "track_detail", name="track_detail"),
+    url("^/audio/(?P<track_slug>.+)$", "track_audio", name="track_audio"),
+    url("^/waveform/(?P<track_slug>.+)$", "track_waveform",
+        name="track_waveform"),
     url("^/upload", "upload_track", name="upload_track"),
     url("^/edit/(?P<track_id>.+)", "edit_track", name="edit_track"),
+    url("^/status/(?P<track_id>\d+)$", "track_status", name="track_status"),
+    url("^/metrics$", "metrics", name="audiotracks_metrics"),
     url("^/confirm_delete/(?P<track_id>\d+)$", "confirm_delete_track", 
         name="confirm_delete_track"),
     url("^/delete$", "delete_track", name="delete_track"),
     url("^/tracks$", "user_index", name="user_index"),
     url("^/tracks/(?P<page_number>\d)/?$", "user_index", name="user_index"),
     url("^/feed/?$", feeds.choose_feed, name="tracks_feed"),
+    url("^/feed/archive/(?P<number>\d+)$", feeds.archive_feed,
+        name="tracks_feed_archive"),
+)
+
+urlpatterns += patterns("audiotracks.playlists",
+    url("^\.(?P<format>m3u8?|xspf)$", "index_playlist",
+        name="audiotracks_playlist"),
+    url("^/tracks\.(?P<format>m3u8?|xspf)$", "user_index_playlist",
+        name="user_index_playlist"),
+    url("^/feed\.(?P<format>m3u8?|xspf)$", "feed_playlist",
+        name="tracks_feed_playlist"),
 )
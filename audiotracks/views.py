@@ -1,29 +1,53 @@
 import os
 
 from django.utils.translation  import ugettext
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.conf import settings
-from django.core.files.uploadhandler import TemporaryFileUploadHandler
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core import urlresolvers
-from django.http import HttpResponseRedirect
+from django.http import Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render_to_response
 from django.template import RequestContext
+from django.utils import simplejson
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib import messages
 
-import mutagen
-from mutagen.easyid3 import EasyID3KeyError
-
-from audiotracks.models import Track
+from audiotracks import counters, instrumentation, jobs, waveform
+from audiotracks.caching import cache_anonymous_page, get_track
+from audiotracks.models import Track, METADATA_PENDING
 from audiotracks.forms import TrackUploadForm, TrackEditForm
+from audiotracks.instrumentation import MemorySink, timer
+from audiotracks.metadata import METADATA_FIELDS
+from audiotracks.pagination import (CountedPaginator, CursorPaginator,
+                                    InvalidCursor)
+from audiotracks.stats import get_stats
+from audiotracks.streaming import serve_file
+from audiotracks.uploadhandler import AudioUploadHandler, FORMAT_MIMETYPES
 
-METADATA_FIELDS = ('title', 'artist', 'genre', 'description', 'date')
+# Seconds to wait before writing tags back into an edited audio file, so that
+# several edits in a row result in a single write
+TAG_WRITE_DELAY = getattr(settings, 'AUDIOTRACKS_TAG_WRITE_DELAY', 10)
 
 
-def paginate(tracks, page_number):
+def paginate(tracks, page_number, cursor=None, count=None):
+    """
+    Return the page of ``tracks`` to display and its tracks. ``count`` is the
+    number of tracks, if known, so that numbered pagination doesn't need to
+    count them.
+    """
     per_page = getattr(settings, 'AUDIOTRACKS_PER_PAGE', 10)
-    paginator = Paginator(tracks, per_page)
+    if getattr(settings, 'AUDIOTRACKS_PAGINATION', 'numbered') == 'cursor':
+        paginator = CursorPaginator(tracks, per_page)
+        try:
+            page = paginator.page(cursor)
+        except InvalidCursor:
+            page = paginator.page()
+        return page, page.object_list
+
+    if count is None:
+        paginator = Paginator(tracks, per_page)
+    else:
+        paginator = CountedPaginator(tracks, per_page, count)
 
     if page_number is None:
         page = paginator.page(1)
@@ -40,12 +64,13 @@ def paginate(tracks, page_number):
     return page, page.object_list
 
 
+@cache_anonymous_page
 def index(request, username=None, page_number=None):
-    tracks = Track.objects
+    tracks = Track.objects.listing()
     if username:
         tracks = tracks.filter(user__username=username)
-    tracks = tracks.order_by('-created_at').all()
-    page, tracks = paginate(tracks, page_number)
+    tracks = tracks.order_by('-created_at')
+    page, tracks = paginate(tracks, page_number, request.GET.get('cursor'))
     base_path = urlresolvers.reverse('audiotracks',
                     args=[username] if username is not None else [])
     return render_to_response("audiotracks/latest.html", {
@@ -55,46 +80,122 @@ def index(request, username=None, page_number=None):
 
 
 def user_index(request, username, page_number=None):
-    tracks = request.user.tracks.order_by('-created_at').all()
-    page, tracks = paginate(tracks, page_number)
+    tracks = request.user.tracks.listing().order_by('-created_at')
+    stats = get_stats(request.user)
+    page, tracks = paginate(tracks, page_number, request.GET.get('cursor'),
+                            stats.track_count)
     base_path = urlresolvers.reverse('user_index', args=[username])
     return render_to_response("audiotracks/user_index.html", {
         'username': username, 'tracks': tracks, 'page': page,
-        'base_path': base_path,
+        'base_path': base_path, 'stats': stats,
         }, context_instance=RequestContext(request))
 
 
 def track_detail(request, track_slug, username=None):
-    params = {'slug': track_slug}
-    params['user__username'] = username
-    track = Track.objects.get(**params)
+    track = get_track(username, track_slug)
+    if track is None:
+        raise Http404
     return render_to_response("audiotracks/detail.html",
-            {'username': username, 'track': track},
+            {'username': username, 'track': track,
+             'counts': counters.get_counts(track)},
             context_instance=RequestContext(request))
 
 
-def set_temporary_file_upload_handler(request):
+def is_first_request(request):
+    """
+    Return whether a request for an audio file isn't a request for the rest
+    of it
+    """
+    range_header = request.META.get('HTTP_RANGE', '')
+    return not range_header or \
+            range_header.replace(' ', '').startswith('bytes=0-')
+
+
+def track_audio(request, track_slug, username=None):
+    """
+    Serve the audio file of a track. Add a ``download`` query string parameter
+    to have browsers save the file rather than play it. Plays and downloads
+    are counted by ``audiotracks.counters``.
+    """
+    track = get_track(username, track_slug)
+    if track is None:
+        raise Http404
+    size = track.audio_size
+    if size is None:
+        size = track.audio_file.size
+    attachment = 'download' in request.GET
+    response = serve_file(request, track.audio_file, size,
+                          track.mimetype or 'application/octet-stream',
+                          last_modified=track.updated_at,
+                          attachment=attachment, version=track.content_hash)
+    # Players request ranges as they go, only count the start of the file
+    if request.method == 'GET' and response.status_code in (200, 206) and \
+            is_first_request(request):
+        counters.increment(track, attachment and 'download_count' or
+                           'play_count')
+    return response
+
+
+def track_waveform(request, track_slug, username=None):
+    """
+    Serve the waveform of a track in the binary format described in
+    ``audiotracks.waveform``, or as JSON with ``?format=json``
+    """
+    track = get_object_or_404(Track, user__username=username,
+                              slug=track_slug)
+    if not track.waveform:
+        raise Http404
+    if request.GET.get('format') == 'json':
+        track.waveform.open('rb')
+        try:
+            data = waveform.parse_waveform(track.waveform.read())
+        finally:
+            track.waveform.close()
+        return HttpResponse(simplejson.dumps(data),
+                            content_type='application/json')
+    return serve_file(request, track.waveform, track.waveform.size,
+                      'application/octet-stream',
+                      last_modified=track.updated_at)
+
+
+def set_audio_upload_handler(request):
     # Disable in memory upload before accessing POST
     # because we need a file from which to read metadata
-    request.upload_handlers = [TemporaryFileUploadHandler()]
+    handler = AudioUploadHandler(request)
+    request.upload_handlers = [handler]
+    return handler
 
 
 @login_required
 @csrf_exempt  # request.POST is accessed by CsrfViewMiddleware
 def upload_track(request):
-    set_temporary_file_upload_handler(request)
+    handler = set_audio_upload_handler(request)
     if request.method == "POST":
-        form = TrackUploadForm(request.POST, request.FILES)
+        form = TrackUploadForm(request.POST, request.FILES,
+                               upload_error=handler.error)
         if form.is_valid():
             audio_file = request.FILES['audio_file']
-            audio_file_path = audio_file.temporary_file_path()
-            metadata = mutagen.File(audio_file_path, easy=True)
             track = form.save(commit=False)
             track.user = request.user
-            for field in METADATA_FIELDS:
-                if metadata and metadata.get(field):
-                    setattr(track, field, metadata.get(field)[0])
-            track.save()
+            track.content_hash = audio_file.content_hash
+            if jobs.get_backend().deferred:
+                # Accept the upload right away, metadata will be extracted
+                # by a worker
+                track.metadata_status = METADATA_PENDING
+                with timer('upload.save'):
+                    track.save()
+                jobs.enqueue_on_commit('extract_metadata', track.id)
+            else:
+                with timer('upload.metadata'):
+                    track.fill_from_audio_file(
+                            audio_file.temporary_file_path())
+                if not track.audio_mimetype:
+                    track.audio_mimetype = FORMAT_MIMETYPES[
+                            audio_file.audio_format]
+                with timer('upload.save'):
+                    track.save()
+            jobs.enqueue_on_commit('compute_waveform', track.id)
+            instrumentation.incr('upload.accepted')
 
             return HttpResponseRedirect(urlresolvers.reverse('edit_track',
                 args=[track.id]))
@@ -104,27 +205,50 @@ def upload_track(request):
             context_instance=RequestContext(request))
 
 
-def update_audiofile_metadata(track):
-    filepath = track.audio_file.path
-    metadata = mutagen.File(filepath, easy=True)
-    if metadata:
-        for field in METADATA_FIELDS:
-            try:
-                metadata[field] = getattr(track, field)
-            except EasyID3KeyError:
-                pass
-        metadata.save()
+@login_required
+def track_status(request, track_id):
+    """
+    Return the metadata extraction status and the metadata of a track as JSON
+    """
+    track = get_object_or_404(request.user.tracks, id=track_id)
+    data = {
+        'status': track.metadata_status,
+        'duration': track.duration,
+        'bitrate': track.bitrate,
+        'sample_rate': track.sample_rate,
+        'image': track.image.url_48x48 if track.image else None,
+    }
+    for field in METADATA_FIELDS:
+        data[field] = getattr(track, field)
+    return HttpResponse(simplejson.dumps(data),
+                        content_type='application/json')
 
 
 @login_required
 def edit_track(request, track_id):
     username = request.user.username
     track = request.user.tracks.get(id=track_id)
+    # Share the user already loaded instead of fetching it again for the
+    # slug check and the cache invalidation
+    track.user = request.user
     if request.method == "POST":
+        original_tags = [getattr(track, field) or u''
+                         for field in METADATA_FIELDS]
         form = TrackEditForm(request.POST, request.FILES, instance=track)
         if form.is_valid():
-            track = form.save()
-            update_audiofile_metadata(track)
+            track = form.save(commit=False)
+            if 'audio_file' in request.FILES:
+                track.content_hash = ''
+                track.update_audio_info()
+            with timer('edit.save'):
+                track.save()
+            form.save_m2m()
+            tags = [getattr(track, field) or u'' for field in METADATA_FIELDS]
+            if 'audio_file' in request.FILES or tags != original_tags:
+                jobs.enqueue_on_commit('write_tags', track.id,
+                                       delay=TAG_WRITE_DELAY)
+            if 'audio_file' in request.FILES:
+                jobs.enqueue_on_commit('compute_waveform', track.id)
             if 'delete_image' in request.POST:
                 track.image = None
                 track.save()
@@ -167,3 +291,15 @@ def delete_track(request):
     messages.add_message(request, messages.INFO,
             ugettext('"%s" has been deleted.') % track.title)
     return HttpResponseRedirect(request.POST.get('came_from', '/'))
+
+
+@user_passes_test(lambda user: user.is_staff)
+def metrics(request):
+    """
+    Return the timings and counters kept by the memory metrics sink as JSON
+    """
+    sink = instrumentation.get_sink(MemorySink)
+    if sink is None:
+        raise Http404
+    return HttpResponse(simplejson.dumps(sink.snapshot()),
+                        content_type='application/json')
@@ -0,0 +1,217 @@
+"""
+Waveform overviews.
+
+Audio files are decoded once, after upload, into min/max peak pairs at a few
+zoom levels. Peaks are stored as signed bytes in a small binary file, so that
+players can draw an overview of a track without downloading the audio.
+
+Decoders are functions taking the path of an audio file and returning a
+``(sample_rate, frame_count, blocks)`` tuple, where ``blocks`` iterates over
+NumPy arrays of mono samples between -1 and 1 and ``frame_count`` is the
+(possibly estimated) number of samples. They return None when they can't
+decode the file. The ``AUDIOTRACKS_WAVEFORM_DECODERS`` setting lists the
+decoders to try, in order. WAV files are decoded natively, other formats need
+``audiotracks.waveform.decode_ffmpeg`` or a decoder of your own.
+
+Computing waveforms requires NumPy. Without it, tracks simply don't get one.
+
+Binary format, little-endian::
+
+    "AWF1"
+    uint32 sample rate
+    uint32 number of levels
+    for each level: uint32 samples per peak, uint32 number of peaks
+    for each level: int8 min, int8 max for each peak
+"""
+import struct
+import subprocess
+import wave
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = 'AWF1'
+
+# Number of peaks of each zoom level, from the finest to the coarsest
+LEVELS = getattr(settings, 'AUDIOTRACKS_WAVEFORM_LEVELS', (4096, 1024, 256))
+
+DECODERS = getattr(settings, 'AUDIOTRACKS_WAVEFORM_DECODERS',
+                   ('audiotracks.waveform.decode_wav',))
+
+# Number of frames decoded at once
+BLOCK_SIZE = 2 ** 16
+
+
+def decode_wav(path):
+    try:
+        wav = wave.open(path, 'rb')
+    except (wave.Error, EOFError, IOError):
+        return None
+    width, channels = wav.getsampwidth(), wav.getnchannels()
+    if width not in (1, 2, 4):
+        wav.close()
+        return None
+
+    def blocks():
+        dtype = {1: numpy.uint8, 2: '<i2', 4: '<i4'}[width]
+        scale = float(2 ** (8 * width - 1))
+        try:
+            while True:
+                data = wav.readframes(BLOCK_SIZE)
+                if not data:
+                    break
+                samples = numpy.frombuffer(data, dtype=dtype).astype(
+                        numpy.float32)
+                if width == 1:
+                    # 8 bit samples are unsigned
+                    samples -= 128
+                samples = samples.reshape(-1, channels).mean(axis=1)
+                yield samples / scale
+        finally:
+            wav.close()
+
+    return wav.getframerate(), wav.getnframes(), blocks()
+
+
+def decode_ffmpeg(path):
+    """
+    Decode any format supported by the ffmpeg command, which must be installed
+    """
+    from audiotracks.metadata import get_audio_info
+    info = get_audio_info(path)
+    if not info['duration']:
+        return None
+    sample_rate = info['sample_rate'] or 44100
+    try:
+        process = subprocess.Popen(['ffmpeg', '-v', 'quiet', '-i', path,
+                                    '-f', 's16le', '-ac', '1', '-ar',
+                                    str(sample_rate), '-'],
+                                   stdout=subprocess.PIPE)
+    except OSError:
+        return None
+
+    def blocks():
+        try:
+            while True:
+                data = process.stdout.read(BLOCK_SIZE * 2)
+                if not data:
+                    break
+                if len(data) % 2:
+                    data = data[:-1]
+                yield numpy.frombuffer(data, dtype='<i2').astype(
+                        numpy.float32) / 32768
+        finally:
+            process.stdout.close()
+            process.wait()
+
+    return sample_rate, int(info['duration'] * sample_rate), blocks()
+
+
+def get_decoders():
+    decoders = []
+    for path in DECODERS:
+        module_name, func_name = path.rsplit('.', 1)
+        try:
+            decoders.append(getattr(import_module(module_name), func_name))
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured(
+                    'Error loading waveform decoder %s: "%s"' % (path, e))
+    return decoders
+
+
+def compute_peaks(blocks, samples_per_peak):
+    """
+    Return the ``(minima, maxima)`` arrays of each group of
+    ``samples_per_peak`` samples
+    """
+    minima, maxima = [], []
+    carry = numpy.zeros(0, dtype=numpy.float32)
+    for block in blocks:
+        samples = numpy.concatenate((carry, block))
+        usable = len(samples) - len(samples) % samples_per_peak
+        if usable:
+            groups = samples[:usable].reshape(-1, samples_per_peak)
+            minima.append(groups.min(axis=1))
+            maxima.append(groups.max(axis=1))
+        carry = samples[usable:]
+    if len(carry):
+        minima.append(numpy.array([carry.min()]))
+        maxima.append(numpy.array([carry.max()]))
+    if not minima:
+        return numpy.zeros(0), numpy.zeros(0)
+    return numpy.concatenate(minima), numpy.concatenate(maxima)
+
+
+def downsample(minima, maxima, factor):
+    """
+    Merge peaks ``factor`` by ``factor``
+    """
+    padding = -len(minima) % factor
+    if padding:
+        minima = numpy.concatenate((minima, [minima[-1]] * padding))
+        maxima = numpy.concatenate((maxima, [maxima[-1]] * padding))
+    return (minima.reshape(-1, factor).min(axis=1),
+            maxima.reshape(-1, factor).max(axis=1))
+
+
+def compute_waveform(path):
+    """
+    Return the waveform of the audio file located at ``path`` in the binary
+    format described above, or None if NumPy isn't available or no decoder
+    supports the file
+    """
+    if numpy is None:
+        return None
+    for decoder in get_decoders():
+        decoded = decoder(path)
+        if decoded is not None:
+            break
+    else:
+        return None
+    sample_rate, frame_count, blocks = decoded
+
+    finest = max(LEVELS)
+    samples_per_peak = max(1, -(-frame_count // finest))
+    minima, maxima = compute_peaks(blocks, samples_per_peak)
+    levels = []
+    for level in sorted(LEVELS, reverse=True):
+        factor = max(1, finest // level)
+        level_minima, level_maxima = downsample(minima, maxima, factor)
+        pairs = numpy.empty(len(level_minima) * 2, dtype=numpy.int8)
+        pairs[0::2] = numpy.clip(level_minima * 127, -127, 127)
+        pairs[1::2] = numpy.clip(level_maxima * 127, -127, 127)
+        levels.append((samples_per_peak * factor, pairs))
+
+    header = [MAGIC, struct.pack('<II', sample_rate, len(levels))]
+    for level_samples_per_peak, pairs in levels:
+        header.append(struct.pack('<II', level_samples_per_peak,
+                                  len(pairs) // 2))
+    return ''.join(header + [pairs.tostring() for _, pairs in levels])
+
+
+def parse_waveform(data):
+    """
+    Return a dictionary describing a waveform in the binary format. Doesn't
+    require NumPy.
+    """
+    if data[:4] != MAGIC:
+        raise ValueError("Not a waveform")
+    sample_rate, level_count = struct.unpack_from('<II', data, 4)
+    offset = 12
+    levels = []
+    for i in range(level_count):
+        samples_per_peak, length = struct.unpack_from('<II', data, offset)
+        levels.append({'samples_per_peak': samples_per_peak,
+                       'length': length})
+        offset += 8
+    for level in levels:
+        size = level['length'] * 2
+        level['peaks'] = list(struct.unpack_from('<%db' % size, data, offset))
+        offset += size
+    return {'sample_rate': sample_rate, 'levels': levels}
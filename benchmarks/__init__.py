@@ -0,0 +1,8 @@
+"""
+Benchmarks of django-audiotracks.
+
+``benchmarks/run.py`` measures the latency, throughput and number of queries
+of the main views, feeds and thumbnail generation on synthetic catalogues
+built by ``benchmarks.catalogue``, and compares the results with a baseline.
+``benchmarks/query_plans.py`` shows the query plans of track listings.
+"""
@@ -0,0 +1,103 @@
+"""
+Synthetic catalogue generator.
+
+Tracks point to real audio files and cover images, the samples of
+``tests/data``, which are stored once and shared by all the tracks using them
+so that large catalogues can be generated quickly. Needs configured Django
+settings.
+"""
+import os
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from audiotracks.metadata import get_audio_info, read_metadata
+from audiotracks.models import Track
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))), 'tests', 'data')
+AUDIO_SAMPLES = ('audio_file.ogg', 'audio_file.flac', 'audio_file.mp3',
+                 'audio_file.wav')
+IMAGE_SAMPLE = 'image.jpg'
+PASSWORD = 'secret'
+BATCH_SIZE = 500
+
+
+def get_sample_path(filename):
+    return os.path.join(DATA_DIR, filename)
+
+
+def store_samples():
+    """
+    Store the sample audio files and cover image, and return a list of the
+    field values of the tracks using each audio file
+    """
+    image_name = None
+    samples = []
+    for index, filename in enumerate(AUDIO_SAMPLES):
+        path = get_sample_path(filename)
+        f = open(path, 'rb')
+        try:
+            name = default_storage.save('benchmarks/%s' % filename, File(f))
+        finally:
+            f.close()
+        info = get_audio_info(path, read_metadata(path))
+        values = {'audio_file': name, 'audio_size': os.path.getsize(path),
+                  'duration': info['duration'], 'bitrate': info['bitrate'],
+                  'sample_rate': info['sample_rate']}
+        # Every other sample has a cover image
+        if index % 2 == 0:
+            if image_name is None:
+                image_name = store_image()
+            values['image'] = image_name
+        samples.append(values)
+    return samples
+
+
+def store_image():
+    """
+    Store the sample cover image along with its thumbnails, and return its
+    name
+    """
+    track = Track(user=User(username='benchmarks'))
+    f = open(get_sample_path(IMAGE_SAMPLE), 'rb')
+    try:
+        track.image.save(IMAGE_SAMPLE, File(f), save=False)
+    finally:
+        f.close()
+    return track.image.name
+
+
+def get_username(number):
+    return 'user%d' % number
+
+
+def generate(user_count, track_count, samples=None):
+    """
+    Grow the catalogue to ``user_count`` users and ``track_count`` tracks,
+    spread evenly between users. Users have the password PASSWORD and the
+    slugs of tracks are ``track-<number>``.
+    """
+    if samples is None:
+        samples = store_samples()
+    users = []
+    for number in range(user_count):
+        username = get_username(number)
+        try:
+            users.append(User.objects.get(username=username))
+        except User.DoesNotExist:
+            users.append(User.objects.create_user(
+                    username, '%s@example.com' % username, PASSWORD))
+    for start in range(Track.objects.count(), track_count, BATCH_SIZE):
+        with transaction.commit_on_success():
+            for number in range(start, min(start + BATCH_SIZE, track_count)):
+                values = samples[number % len(samples)]
+                Track.objects.create(user=users[number % user_count],
+                        slug='track-%d' % number, title='Track %d' % number,
+                        artist='Artist %d' % (number % 50),
+                        genre='Genre %d' % (number % 10),
+                        description='Description of track %d' % number,
+                        **values)
+    return users
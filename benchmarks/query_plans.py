@@ -0,0 +1,140 @@
+"""
+Show the query plans and timings of the main track queries without and with
+the indexes of the track table.
+
+Usage, from the root of the repository::
+
+    python benchmarks/query_plans.py [--tracks 20000] [--users 50]
+
+Runs against an in-memory SQLite database unless DJANGO_SETTINGS_MODULE is
+set, in which case the tables must not exist yet in the configured database.
+"""
+from __future__ import print_function
+
+import datetime
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from django.conf import settings
+
+if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes',
+                        'audiotracks'),
+    )
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from audiotracks.indexes import (create_indexes, sql_all_indexes,
+                                 sql_composite_indexes)
+from audiotracks.models import Track
+
+REPEAT = 200
+
+
+def get_queries():
+    user = User.objects.get(username='user1')
+    return [
+        ("index", Track.objects.listing().order_by('-created_at')[:10]),
+        ("user_index", Track.objects.listing().filter(user=user).order_by(
+                '-created_at')[:10]),
+        ("track_detail", Track.objects.select_related('user').filter(
+                user__username='user1', slug='track-%d' % 42)),
+    ]
+
+
+def populate(track_count, user_count):
+    users = [User.objects.create(username='user%d' % n)
+             for n in range(user_count)]
+    start = datetime.datetime(2012, 1, 1)
+    ids = []
+    with transaction.commit_on_success():
+        for n in range(track_count):
+            track = Track(user=users[n % user_count], slug='track-%d' % n,
+                          title='Track %d' % n,
+                          audio_file='track-%d.ogg' % n)
+            track.save()
+            ids.append(track.id)
+    # Spread creation times, auto_now_add set them all to now
+    cursor = connection.cursor()
+    cursor.executemany('UPDATE %s SET created_at = %%s WHERE id = %%s'
+                       % connection.ops.quote_name(Track._meta.db_table),
+                       [(start + datetime.timedelta(minutes=n), track_id)
+                        for n, track_id in enumerate(ids)])
+    transaction.commit_unless_managed()
+
+
+def drop_indexes():
+    """
+    Drop the indexes added for track listings, keeping the ones on foreign
+    keys and unique constraints
+    """
+    created_at_index = [statement for statement in
+                        connection.creation.sql_indexes_for_field(Track,
+                                Track._meta.get_field('created_at'),
+                                no_style())]
+    cursor = connection.cursor()
+    for statement in created_at_index + sql_composite_indexes(Track):
+        name = re.match(r'CREATE INDEX (\S+)', statement).group(1)
+        cursor.execute('DROP INDEX %s' % name)
+    transaction.commit_unless_managed()
+
+
+def explain(queryset):
+    sql, params = queryset.query.get_compiler('default').as_sql()
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join([unicode(column) for column in row])
+            for row in cursor.fetchall()]
+
+
+def report(title):
+    print()
+    print("== %s ==" % title)
+    for name, queryset in get_queries():
+        started = time.time()
+        for i in range(REPEAT):
+            list(queryset.all())
+        elapsed = (time.time() - started) / REPEAT * 1000
+        print()
+        print("%s: %.3f ms" % (name, elapsed))
+        for line in explain(queryset):
+            print("    " + line)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--tracks', type='int', default=20000)
+    parser.add_option('--users', type='int', default=50)
+    options, args = parser.parse_args()
+
+    call_command('syncdb', interactive=False, verbosity=0)
+    print("Creating %d tracks..." % options.tracks)
+    populate(options.tracks, options.users)
+
+    drop_indexes()
+    report("Without listing indexes")
+    created = create_indexes(sql_all_indexes(Track))
+    transaction.commit_unless_managed()
+    print()
+    print("Created %d index(es)" % len(created))
+    report("With listing indexes")
+
+
+if __name__ == '__main__':
+    main()
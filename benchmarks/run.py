@@ -0,0 +1,273 @@
+"""
+Measure the latency, throughput and number of queries of the views, feeds
+and thumbnail generation on synthetic catalogues of growing sizes.
+
+Usage, from the root of the repository::
+
+    python benchmarks/run.py [--sizes 100,1000,10000] [--users 20]
+                             [--iterations 20] [--warm]
+                             [--output results.json]
+                             [--baseline baseline.json] [--threshold 1.2]
+
+Runs against an in-memory SQLite database unless DJANGO_SETTINGS_MODULE is
+set, in which case the tables must not exist yet in the configured database.
+Caches are cleared before each request unless ``--warm`` is given.
+
+With ``--baseline``, results are compared with those of an earlier run, and
+the command exits with status 1 if a scenario got slower by more than the
+threshold ratio or issues more queries.
+"""
+from __future__ import print_function
+
+import datetime
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+
+from django.conf import settings
+
+MEDIA_ROOT = None
+
+if not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    MEDIA_ROOT = tempfile.mkdtemp(prefix='audiotracks-benchmarks-')
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django.contrib.auth', 'django.contrib.contenttypes',
+                        'django.contrib.sessions', 'django.contrib.sites',
+                        'audiotracks'),
+        ROOT_URLCONF='benchmarks.urls',
+        SITE_ID=1,
+        MEDIA_ROOT=MEDIA_ROOT,
+        MEDIA_URL='/media/',
+    )
+
+import django
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, reset_queries
+from django.test.client import Client
+from django.test.utils import setup_test_environment
+from django.utils import simplejson
+
+from benchmarks import catalogue
+from audiotracks.models import Track
+
+SCENARIOS = ('index', 'user_index', 'track_detail', 'all_tracks_feed',
+             'user_tracks_feed', 'upload_track', 'edit_track', 'thumbnails')
+
+
+class Scenarios(object):
+    """
+    Each scenario is a method run once per iteration
+    """
+
+    def __init__(self):
+        self.username = catalogue.get_username(0)
+        self.client = Client()
+        self.client.login(username=self.username,
+                          password=catalogue.PASSWORD)
+        self.uploaded = []
+
+    def get(self, url):
+        response = self.client.get(url)
+        if response.status_code != 200:
+            raise AssertionError("%s returned %s" % (url,
+                                                     response.status_code))
+        # Consume streamed responses
+        return response.content
+
+    def index(self):
+        self.get('/music')
+
+    def user_index(self):
+        self.get('/%s/music/tracks' % self.username)
+
+    def track_detail(self):
+        self.get('/%s/music/track/track-0' % self.username)
+
+    def all_tracks_feed(self):
+        self.get('/music/feed')
+
+    def user_tracks_feed(self):
+        self.get('/%s/music/feed' % self.username)
+
+    def upload_track(self):
+        f = open(catalogue.get_sample_path('audio_file.ogg'), 'rb')
+        try:
+            response = self.client.post('/music/upload', {'audio_file': f})
+        finally:
+            f.close()
+        if response.status_code != 302:
+            raise AssertionError("upload returned %s" % response.status_code)
+        self.uploaded.append(int(response['Location'].rstrip('/').split(
+                '/')[-1]))
+
+    def edit_track(self):
+        # Edit uploaded tracks, which have their own audio file
+        track = Track.objects.get(id=self.uploaded[-1])
+        response = self.client.post('/music/edit/%s' % track.id, {
+                'title': 'Edited %s' % time.time(), 'slug': track.slug,
+                'genre': 'Edited'})
+        if response.status_code != 302:
+            raise AssertionError("edit returned %s" % response.status_code)
+
+    def thumbnails(self):
+        track = Track.objects.get(id=self.uploaded[-1])
+        f = open(catalogue.get_sample_path(catalogue.IMAGE_SAMPLE), 'rb')
+        try:
+            content = ContentFile(f.read())
+        finally:
+            f.close()
+        track.image.save(catalogue.IMAGE_SAMPLE, content, save=False)
+
+    def clean_up(self):
+        for track in Track.objects.filter(id__in=self.uploaded):
+            track.delete()
+        self.uploaded = []
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def measure(func, iterations, warm=False):
+    """
+    Run ``func`` ``iterations`` times and return statistics of its duration
+    in milliseconds and of the number of queries it issued
+    """
+    durations = []
+    queries = []
+    connection.use_debug_cursor = True
+    try:
+        for i in range(iterations):
+            if not warm:
+                cache.clear()
+            reset_queries()
+            started = time.time()
+            func()
+            durations.append((time.time() - started) * 1000)
+            queries.append(len(connection.queries))
+    finally:
+        connection.use_debug_cursor = None
+    total = sum(durations)
+    return {
+        'iterations': iterations,
+        'mean_ms': total / iterations,
+        'median_ms': percentile(durations, 0.5),
+        'p95_ms': percentile(durations, 0.95),
+        'min_ms': min(durations),
+        'max_ms': max(durations),
+        'throughput': iterations / (total / 1000) if total else None,
+        'queries': max(queries),
+    }
+
+
+def run(sizes, user_count, iterations, warm=False, verbose=True):
+    samples = catalogue.store_samples()
+    results = {}
+    for size in sizes:
+        started = time.time()
+        catalogue.generate(user_count, size, samples)
+        if verbose:
+            print("Catalogue of %d tracks generated in %.1f s" % (
+                    size, time.time() - started))
+        scenarios = Scenarios()
+        results[str(size)] = size_results = {}
+        for name in SCENARIOS:
+            size_results[name] = stats = measure(getattr(scenarios, name),
+                                                 iterations, warm)
+            if verbose:
+                print("  %-18s %8.2f ms  %8.1f req/s  %3d queries" % (
+                        name, stats['mean_ms'], stats['throughput'] or 0,
+                        stats['queries']))
+        scenarios.clean_up()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Return a list of ``(size, scenario, message)`` tuples describing the
+    regressions of ``results`` compared with ``baseline``
+    """
+    regressions = []
+    for size, scenarios in sorted(results['results'].items()):
+        for name, stats in sorted(scenarios.items()):
+            try:
+                base = baseline['results'][size][name]
+            except KeyError:
+                continue
+            ratio = stats['mean_ms'] / base['mean_ms']
+            if ratio > threshold:
+                regressions.append((size, name, "%.2f ms instead of %.2f ms"
+                        % (stats['mean_ms'], base['mean_ms'])))
+            if stats['queries'] > base['queries']:
+                regressions.append((size, name, "%d queries instead of %d"
+                        % (stats['queries'], base['queries'])))
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--sizes', default='100,1000',
+                      help='Comma separated catalogue sizes')
+    parser.add_option('--users', type='int', default=20)
+    parser.add_option('--iterations', type='int', default=20)
+    parser.add_option('--warm', action='store_true', default=False,
+                      help="Don't clear caches before each request")
+    parser.add_option('--output', help='Write the results to this file')
+    parser.add_option('--baseline', help='Results to compare with')
+    parser.add_option('--threshold', type='float', default=1.2,
+                      help='Slowdown ratio reported as a regression')
+    options, args = parser.parse_args()
+    sizes = sorted(int(size) for size in options.sizes.split(','))
+
+    setup_test_environment()
+    try:
+        call_command('syncdb', interactive=False, verbosity=0)
+        results = {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'users': options.users,
+            'warm': options.warm,
+            'results': run(sizes, options.users, options.iterations,
+                           options.warm),
+        }
+    finally:
+        if MEDIA_ROOT:
+            shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    if options.output:
+        f = open(options.output, 'w')
+        try:
+            simplejson.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if options.baseline:
+        f = open(options.baseline)
+        try:
+            baseline = simplejson.load(f)
+        finally:
+            f.close()
+        regressions = compare(results, baseline, options.threshold)
+        for size, name, message in regressions:
+            print("Regression of %s with %s tracks: %s" % (name, size,
+                                                           message))
+        if regressions:
+            sys.exit(1)
+        print("No regression")
+
+
+if __name__ == '__main__':
+    main()
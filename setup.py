@@ -24,6 +24,9 @@ setup(
         'mutagen==1.20',
         'PIL'
         ],
+    extras_require = {
+        'waveform': ['numpy'],
+        },
     include_package_data=True,
     zip_safe=False,
 )
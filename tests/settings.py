@@ -5,6 +5,7 @@ MEDIA_ROOT = os.path.join(HERE_DIR, "site_media")
 
 DATABASE_ENGINE = 'sqlite3'
 ROOT_URLCONF = ''
+TEMPLATE_DIRS = (os.path.join(HERE_DIR, "templates"),)
 SITE_ID = 1
 INSTALLED_APPS = (
     "django.contrib.auth",
@@ -15,3 +16,15 @@ INSTALLED_APPS = (
 )
 
 AUDIOTRACKS_PER_PAGE = 3
+
+MIDDLEWARE_CLASSES = (
+    'django.middleware.common.CommonMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.csrf.CsrfViewMiddleware',
+    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'django.contrib.messages.middleware.MessageMiddleware',
+    'audiotracks.querydebug.DuplicateQueryMiddleware',
+)
+# Fail tests issuing the same query once per track
+AUDIOTRACKS_DETECT_DUPLICATE_QUERIES = True
+AUDIOTRACKS_DUPLICATE_QUERY_ERRORS = True